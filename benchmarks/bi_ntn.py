@@ -0,0 +1,104 @@
+"""
+Latency benchmark of the mlp_bi_ntn edge features against the batch size B.
+
+Compares the former edge-by-edge BiTensorNetworkModule scoring and row-by-row concatenation of
+utils.concat_node_respresentations_double_with_biNTN with the batched einsum version, and checks that both
+give the same features in both orientations.
+
+Run from the repository root as a module, not as a script:
+    python -m benchmarks.bi_ntn --batch_sizes 32 256 1024
+"""
+import argparse
+
+import torch
+
+import utils
+from benchmarks.common import time_call
+from layers import BiTensorNetworkModule
+
+
+def edge_ntn(ntn_layer, embedding_1, embedding_2):
+    """
+    Parameters
+    ----------
+    ntn_layer : layers.BiTensorNetworkModule
+        The module whose weights are used.
+    embedding_1, embedding_2 : torch.Tensor
+        Embeddings of the two nodes of one edge.
+    Returns
+    -------
+    scores : torch.Tensor
+        A (tensor_neurons x 1) similarity vector, computed the way the module used to.
+    """
+    d = ntn_layer.input_dim
+    embedding_1 = embedding_1[:, None]
+    embedding_2 = embedding_2[:, None]
+    scoring = torch.mm(torch.t(embedding_1), ntn_layer.weight_matrix.view(d, -1))
+    scoring = scoring.view(d, ntn_layer.tensor_neurons)
+    scoring = torch.mm(torch.t(scoring), embedding_2)
+    combined_representation = torch.cat((embedding_1, embedding_2))
+    block_scoring = torch.mm(ntn_layer.weight_matrix_block, combined_representation)
+    return scoring + block_scoring + ntn_layer.bias
+
+
+def loop_concat(features, edges, ntn_layer):
+    """
+    Parameters
+    ----------
+    features : torch.Tensor
+        features[i] is the representation of node i.
+    edges : torch.LongTensor
+        A (B x 2) tensor of edges.
+    ntn_layer : layers.BiTensorNetworkModule
+        The module whose weights are used.
+    Returns
+    -------
+    out1, out2 : torch.Tensor
+        The features of both orientations, built edge by edge as the function used to.
+    """
+    out1 = torch.FloatTensor()
+    out2 = torch.FloatTensor()
+    for node1, node2 in edges:
+        ntn_emd_1 = torch.reshape(edge_ntn(ntn_layer, features[node1], features[node2]), (-1,))
+        ntn_emd_2 = torch.reshape(edge_ntn(ntn_layer, features[node2], features[node1]), (-1,))
+        node12 = torch.cat((features[node1], features[node2], ntn_emd_1)).reshape(1, -1)
+        node21 = torch.cat((features[node2], features[node1], ntn_emd_2)).reshape(1, -1)
+        out1 = torch.cat((out1, node12), dim=0)
+        out2 = torch.cat((out2, node21), dim=0)
+    return out1, out2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='*', default=[32, 256, 1024],
+                        help='numbers of edges B, default: 32 256 1024')
+    parser.add_argument('--num_nodes', type=int, default=5000,
+                        help='number of nodes, default: 5000')
+    parser.add_argument('--dim', type=int, default=64,
+                        help='dimension of the node embeddings, default: 64')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='calls per measurement, the best is reported, default: 3')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    features = torch.randn(args.num_nodes, args.dim)
+    ntn_layer = BiTensorNetworkModule(input_dim=args.dim)
+
+    print('{:>6} {:>12} {:>12}'.format('B', 'loop (ms)', 'batch (ms)'))
+    for batch_size in args.batch_sizes:
+        edges = torch.randint(args.num_nodes, (batch_size, 2))
+        with torch.no_grad():
+            old = loop_concat(features, edges, ntn_layer)
+            new = utils.concat_node_respresentations_double_with_biNTN(features, edges, ntn_layer)
+            for o, n in zip(old, new):
+                assert torch.allclose(o, n, atol=1e-4), 'outputs differ for B={}'.format(batch_size)
+
+            loop_time = time_call(lambda: loop_concat(features, edges, ntn_layer), args.repeats)
+            batch_time = time_call(lambda: utils.concat_node_respresentations_double_with_biNTN(
+                features, edges, ntn_layer), args.repeats)
+
+        print('{:>6} {:>12.2f} {:>12.2f}'.format(batch_size, loop_time * 1000, batch_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Helpers shared by the benchmarks: random Delaunay graphs and a best-of timer.
+"""
+import time
+
+import numpy as np
+from scipy.spatial import Delaunay
+
+
+def delaunay_edges(points):
+    """
+    Parameters
+    ----------
+    points : numpy array
+        2d numpy array (n x 2) of node positions.
+    Returns
+    -------
+    edges : numpy array
+        2d numpy array (E x 2) of the edges of the Delaunay triangulation of the points, each edge once with
+        edges[e, 0] < edges[e, 1], sorted.
+    """
+    simplices = Delaunay(points).simplices
+    edges = np.vstack((simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [0, 2]]))
+    return np.unique(np.sort(edges, axis=1), axis=0)
+
+
+def time_call(fn, repeats):
+    """
+    Parameters
+    ----------
+    fn : callable
+        Function without arguments to time.
+    repeats : int
+        Number of calls.
+    Returns
+    -------
+    seconds : float
+        Best wall time of a single call.
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
@@ -0,0 +1,79 @@
+"""
+Throughput benchmark of the node-pair concatenation used by the "mlp" classifier.
+
+Compares the former row-by-row torch.cat loop with the indexed gather of
+utils.concat_node_representations_double, and checks that both give the same tensors.
+
+Run from the repository root as a module, not as a script:
+    python -m benchmarks.concat --batch_sizes 32 1000 100000
+"""
+import argparse
+
+import numpy as np
+import torch
+
+import utils
+from benchmarks.common import time_call
+
+
+def loop_concat_node_representations_double(features, edges, device="cpu"):
+    """
+    Parameters
+    ----------
+    features : torch.Tensor
+        features[i] is the representation of node i.
+    edges : numpy array
+        A (B x 2) array of edges.
+    device : string
+        'cpu' or 'cuda:0'. Default: 'cpu'.
+    Returns
+    -------
+    out1, out2 : torch.Tensor
+        Concatenated features of both orientations, built the way the helper used to.
+    """
+    out1 = torch.FloatTensor().to(device)
+    out2 = torch.FloatTensor().to(device)
+    for node1, node2 in edges:
+        node12 = torch.cat((features[node1], features[node2])).reshape(1, -1)
+        node21 = torch.cat((features[node2], features[node1])).reshape(1, -1)
+        out1 = torch.cat((out1, node12), dim=0)
+        out2 = torch.cat((out2, node21), dim=0)
+    return out1, out2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='*', default=[32, 1000, 100000],
+                        help='numbers of edges per call, default: 32 1000 100000')
+    parser.add_argument('--num_nodes', type=int, default=5000,
+                        help='number of nodes of the graph, default: 5000')
+    parser.add_argument('--dim', type=int, default=64,
+                        help='dimension of the node embeddings, default: 64')
+    parser.add_argument('--max_loop_edges', type=int, default=1000,
+                        help='largest batch the quadratic loop is timed on, default: 1000')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='calls per measurement, the best is reported, default: 5')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    features = torch.randn(args.num_nodes, args.dim)
+
+    print('{:>8} {:>16} {:>16} {:>10}'.format('edges', 'loop (edges/s)', 'gather (edges/s)', 'speed-up'))
+    for batch_size in args.batch_sizes:
+        edges = rng.integers(0, args.num_nodes, size=(batch_size, 2))
+
+        new_time = time_call(lambda: utils.concat_node_representations_double(features, edges), args.repeats)
+
+        old_time = float('nan')
+        if batch_size <= args.max_loop_edges:
+            old_time = time_call(lambda: loop_concat_node_representations_double(features, edges), args.repeats)
+            old, new = loop_concat_node_representations_double(features, edges), \
+                utils.concat_node_representations_double(features, edges)
+            assert all(torch.equal(a, b) for a, b in zip(old, new)), 'outputs differ for {} edges'.format(batch_size)
+
+        print('{:>8} {:>16.0f} {:>16.0f} {:>10.1f}'.format(batch_size, batch_size / old_time,
+                                                         batch_size / new_time, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Latency benchmark of EGNNCLayer.forward against the number of nodes N and of edge channels p.
+
+Compares the former per-channel torch.cat concatenation with the permute + reshape of
+layers.EGNNCLayer, with dense and sparse COO edge features built on random Delaunay graphs,
+and checks that all of them give the same output.
+
+Run from the repository root as a module, not as a script:
+    python -m benchmarks.egnnc_layer --num_nodes 500 1000 2000 --channels 1 4 8
+"""
+import argparse
+
+import numpy as np
+import torch
+
+from benchmarks.common import delaunay_edges, time_call
+from layers import EGNNCLayer
+
+
+def cat_forward(layer, features, edge_features):
+    """
+    Parameters
+    ----------
+    layer : layers.EGNNCLayer
+        The layer whose weights are used.
+    features : torch.Tensor
+        An (n x input_dim) tensor of input node features.
+    edge_features : torch.Tensor
+        A dense (p x n x n) tensor of edge features.
+    Returns
+    -------
+    out : torch.Tensor
+        The layer output, built the way the layer used to.
+    """
+    support0 = torch.matmul(features, layer.weight0)
+    support1 = torch.matmul(features, layer.weight1)
+    x = torch.matmul(edge_features, support1) + support0
+    output = torch.cat([xi for xi in x], dim=1)
+    return output + layer.bias
+
+
+def delaunay_edge_features(num_nodes, channels, rng):
+    """
+    Parameters
+    ----------
+    num_nodes : int
+        Number of nodes.
+    channels : int
+        Number of edge channels p.
+    rng : numpy.random.Generator
+        Random generator.
+    Returns
+    -------
+    edge_features : torch.Tensor
+        A sparse COO (p x n x n) tensor with random values on the edges of a random Delaunay graph.
+    """
+    edges = delaunay_edges(rng.random((num_nodes, 2)))
+    edges = np.vstack((edges, edges[:, ::-1]))
+    indices = np.vstack((np.repeat(np.arange(channels), len(edges)), np.tile(edges.T, channels)))
+    values = rng.random(indices.shape[1])
+    return torch.sparse_coo_tensor(torch.from_numpy(indices), torch.from_numpy(values).float(),
+                                   (channels, num_nodes, num_nodes)).coalesce()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_nodes', type=int, nargs='*', default=[500, 1000, 2000],
+                        help='numbers of nodes N, default: 500 1000 2000')
+    parser.add_argument('--channels', type=int, nargs='*', default=[1, 4, 8],
+                        help='numbers of edge channels p, default: 1 4 8')
+    parser.add_argument('--input_dim', type=int, default=64,
+                        help='dimension of the input node features, default: 64')
+    parser.add_argument('--output_dim', type=int, default=16,
+                        help='dimension of the output of each channel, default: 16')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='calls per measurement, the best is reported, default: 5')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    torch.manual_seed(0)
+
+    print('{:>6} {:>3} {:>12} {:>12} {:>12}'.format('N', 'p', 'cat (ms)', 'dense (ms)', 'sparse (ms)'))
+    for num_nodes in args.num_nodes:
+        features = torch.randn(num_nodes, args.input_dim)
+        for channels in args.channels:
+            layer = EGNNCLayer(args.input_dim, args.output_dim, channels)
+            torch.nn.init.normal_(layer.bias)
+            sparse = delaunay_edge_features(num_nodes, channels, rng)
+            dense = sparse.to_dense()
+
+            with torch.no_grad():
+                old = cat_forward(layer, features, dense)
+                assert torch.equal(old, layer(features, dense)), 'dense outputs differ for N={}, p={}'.format(
+                    num_nodes, channels)
+                assert torch.allclose(old, layer(features, sparse), atol=1e-5), \
+                    'sparse outputs differ for N={}, p={}'.format(num_nodes, channels)
+
+                cat_time = time_call(lambda: cat_forward(layer, features, dense), args.repeats)
+                dense_time = time_call(lambda: layer(features, dense), args.repeats)
+                sparse_time = time_call(lambda: layer(features, sparse), args.repeats)
+
+            print('{:>6} {:>3} {:>12.2f} {:>12.2f} {:>12.2f}'.format(num_nodes, channels, cat_time * 1000,
+                                                                   dense_time * 1000, sparse_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
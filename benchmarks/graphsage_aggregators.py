@@ -0,0 +1,156 @@
+"""
+Latency benchmark of the GraphSAGE aggregators against the number of nodes N and of sampled neighbours S.
+
+Compares the former per-node sampling and aggregation loop of layers.Aggregator.forward with the padded
+(N x S) batched path, on the neighbours of random Delaunay graphs, and checks that both aggregate the same
+samples to the same output.
+
+Run from the repository root as a module, not as a script:
+    python -m benchmarks.graphsage_aggregators --num_nodes 1000 5000 --num_samples 5 10
+"""
+import argparse
+
+import numpy as np
+import torch
+import scipy.sparse as sp
+
+from benchmarks.common import delaunay_edges, time_call
+from layers import sample_neighbours, MeanAggregator, MaxPoolAggregator, MeanPoolAggregator, LSTMAggregator
+
+
+def loop_sample(rows, num_samples):
+    """
+    Parameters
+    ----------
+    rows : numpy array
+        rows[i] is an array of neighbours of node i.
+    num_samples : int
+        Number of neighbours to sample per node.
+    Returns
+    -------
+    sampled_rows : list
+        The sampled neighbours of every node, drawn the way the aggregators used to.
+    """
+    return [np.array(row)[np.random.choice(len(row), min(len(row), num_samples), len(row) < num_samples)]
+            for row in rows]
+
+
+def loop_forward(aggregator, features, nodes, mapping, sampled_rows, dist, orders=None):
+    """
+    Parameters
+    ----------
+    aggregator : layers.Aggregator
+        The aggregator whose weights are used.
+    features : torch.Tensor
+        An (n' x input_dim) tensor of input node features.
+    nodes : numpy array
+        Nodes of the current layer of the computation graph.
+    mapping : numpy array
+        mapping[v] is the position of node v in features.
+    sampled_rows : list
+        The sampled neighbours of every node.
+    dist : torch.Tensor
+        An (n x n) tensor of node distances.
+    orders : list
+        Order in which the LSTM aggregator reads the samples of each node with samples. Default: random.
+    Returns
+    -------
+    out : torch.Tensor
+        The aggregated features, computed one node at a time as the aggregators used to.
+    """
+    name = aggregator.__class__.__name__
+    out = torch.zeros(len(nodes), (2 if name == 'LSTMAggregator' else 1) * aggregator.output_dim)
+    k = 0
+    for i in range(len(nodes)):
+        if len(sampled_rows[i]) == 0:
+            continue
+        neighbours = features[np.array([mapping[v] for v in sampled_rows[i]], dtype=np.int64), :]
+        if name == 'MeanAggregator':
+            weights = dist[nodes[i], sampled_rows[i]]
+            weights = torch.cat((torch.ones(1, dtype=torch.float64), torch.min(weights) / weights))
+            stacked = torch.cat((features[mapping[nodes[i]], :].view(1, -1), neighbours))
+            out[i, :] = torch.sum(stacked * weights.view(-1, 1), dim=0) / torch.sum(weights)
+        elif name == 'LSTMAggregator':
+            order = orders[k] if orders is not None else np.random.permutation(len(sampled_rows[i]))
+            lstm_out, _ = aggregator.lstm(neighbours[order, :].unsqueeze(0))
+            out[i, :] = torch.sum(lstm_out.squeeze(0), dim=0)
+        else:
+            pooled = aggregator.relu(aggregator.fc1(neighbours))
+            out[i, :] = torch.max(pooled, dim=0)[0] if name == 'MaxPoolAggregator' else torch.mean(pooled, dim=0)
+        k += 1
+    return out
+
+
+def delaunay_rows(num_nodes, rng):
+    """
+    Parameters
+    ----------
+    num_nodes : int
+        Number of nodes.
+    rng : numpy.random.Generator
+        Random generator.
+    Returns
+    -------
+    rows : numpy array
+        rows[i] is the list of Delaunay neighbours of node i.
+    dist : torch.Tensor
+        An (n x n) float64 tensor of the distances between the nodes.
+    """
+    points = rng.random((num_nodes, 2))
+    edges = delaunay_edges(points)
+    adjacency = sp.coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(num_nodes, num_nodes))
+    rows = (adjacency + adjacency.T).tolil().rows
+    dist = torch.from_numpy(np.linalg.norm(points[:, None, :] - points[None, :, :], axis=2))
+    return rows, dist
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_nodes', type=int, nargs='*', default=[1000, 5000],
+                        help='numbers of nodes N, default: 1000 5000')
+    parser.add_argument('--num_samples', type=int, nargs='*', default=[5, 10],
+                        help='numbers of sampled neighbours S, default: 5 10')
+    parser.add_argument('--dim', type=int, default=16,
+                        help='dimension of the node features, default: 16')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='calls per measurement, the best is reported, default: 3')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    print('{:>6} {:>3} {:>20} {:>12} {:>12}'.format('N', 'S', 'aggregator', 'loop (ms)', 'batch (ms)'))
+    for num_nodes in args.num_nodes:
+        rows, dist = delaunay_rows(num_nodes, rng)
+        nodes = np.arange(num_nodes, dtype=np.int64)
+        mapping = np.argsort(rng.permutation(num_nodes))
+        features = torch.randn(num_nodes, args.dim)
+        for num_samples in args.num_samples:
+            for agg_class in (MeanAggregator, MaxPoolAggregator, MeanPoolAggregator, LSTMAggregator):
+                aggregator = agg_class(args.dim, args.dim)
+                with torch.no_grad():
+                    # Replay the random draws of the batched path to aggregate the same samples in the loop.
+                    state = np.random.get_state()
+                    new = aggregator(features, nodes, mapping, rows, dist, mapping, num_samples)
+                    np.random.set_state(state)
+                    neighbours, _, mask = sample_neighbours(rows, mapping, num_samples)
+                    nonempty = mask.any(axis=1)
+                    keys = np.random.random_sample(mask[nonempty].shape)
+                    orders = [np.argsort(np.where(m, k, np.inf))[:m.sum()] for (k, m) in zip(keys, mask[nonempty])]
+                    sampled_rows = [row[m] for (row, m) in zip(neighbours, mask)]
+                    old = loop_forward(aggregator, features, nodes, mapping, sampled_rows, dist, orders)
+                    assert torch.allclose(old, new, atol=1e-5), '{} outputs differ for N={}, S={}'.format(
+                        agg_class.__name__, num_nodes, num_samples)
+
+                    loop_time = time_call(lambda: loop_forward(aggregator, features, nodes, mapping,
+                                                               loop_sample(rows, num_samples), dist), args.repeats)
+                    batch_time = time_call(lambda: aggregator(features, nodes, mapping, rows, dist, mapping,
+                                                              num_samples), args.repeats)
+
+                print('{:>6} {:>3} {:>20} {:>12.2f} {:>12.2f}'.format(num_nodes, num_samples, agg_class.__name__,
+                                                                      loop_time * 1000, batch_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Load-time benchmark of the CSV-to-graph ingestion used by the link prediction datasets.
+
+Compares the former DataFrame.iterrows cell-by-cell fill of the edge channels with
+read_graph_csv + get_edge_channels + edge_channels_to_dense, and checks that both give
+the same (p x n x n) edge features.
+
+Run from the repository root as a module, not as a script:
+    python -m benchmarks.ingestion --folder datasets/debug/Train
+"""
+import argparse
+import glob
+import time
+
+import numpy as np
+import pandas as pd
+
+from datasets.link_prediction import read_graph_csv, get_edge_channels, edge_channels_to_dense
+
+
+def iterrows_edge_channels(edge_path, node_path):
+    """
+    Parameters
+    ----------
+    edge_path : str
+        Path to the *_edges.csv file.
+    node_path : str
+        Path to the *_nodes.csv file.
+    Returns
+    -------
+    edge_features : numpy array
+        (4 x n x n) edge channels built the way the dataset constructors used to.
+    """
+    edges = pd.read_csv(edge_path)
+    nodes = pd.read_csv(node_path)
+    col_row_len = len(nodes['id'])
+
+    distances_close_to_edges = pd.DataFrame(0, index=np.arange(col_row_len), columns=np.arange(col_row_len))
+    delta_entropy_edges = pd.DataFrame(0, index=np.arange(col_row_len), columns=np.arange(col_row_len))
+    neighborhood_similarity_edges = pd.DataFrame(0, index=np.arange(col_row_len), columns=np.arange(col_row_len))
+
+    for i, row in edges.iterrows():
+        source = row['source']
+        target = row['target']
+        distances_close_to_edges[source][target] = float(row['distance'])
+        distances_close_to_edges[target][source] = float(row['distance'])
+        delta_entropy_edges[source][target] = float(row['Delta_Entropy'])
+        delta_entropy_edges[target][source] = float(row['Delta_Entropy'])
+        neighborhood_similarity_edges[source][target] = float(row['Sorenson_Similarity'])
+        neighborhood_similarity_edges[target][source] = float(row['Sorenson_Similarity'])
+
+    densities = nodes[["Cell_density"]].to_numpy()
+    edge_density = np.zeros((col_row_len, col_row_len))
+    for _, row in edges.iterrows():
+        source = int(row['source'])
+        target = int(row['target'])
+        edge_density[source][target] = float(densities[:, 0][target]) - float(densities[:, 0][source])
+        edge_density[target][source] = float(densities[:, 0][source]) - float(densities[:, 0][target])
+
+    return np.stack((edge_density, np.array(delta_entropy_edges), np.array(neighborhood_similarity_edges),
+                     np.array(distances_close_to_edges)))
+
+
+def vectorised_edge_channels(edge_path, node_path):
+    """
+    Parameters
+    ----------
+    edge_path : str
+        Path to the *_edges.csv file.
+    node_path : str
+        Path to the *_nodes.csv file.
+    Returns
+    -------
+    edge_features : numpy array
+        (4 x n x n) edge channels built with the shared ingestion functions.
+    """
+    edges, nodes = read_graph_csv(edge_path, node_path)
+    edge_index, edge_attr = get_edge_channels(edges, nodes)
+    return edge_channels_to_dense(edge_index, edge_attr, len(nodes))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folder', type=str, default='datasets/debug/Train',
+                        help='folder with *_edges.csv / *_nodes.csv pairs, default: datasets/debug/Train')
+    parser.add_argument('--skip_iterrows', action='store_true',
+                        help='only time the vectorised path, default: False')
+    args = parser.parse_args()
+
+    edge_paths = sorted(glob.glob(f'{args.folder}/*_edges.csv'))
+    total_old, total_new = 0.0, 0.0
+    print('{:<60} {:>7} {:>12} {:>12}'.format('graph', 'edges', 'iterrows (s)', 'vector (s)'))
+    for edge_path in edge_paths:
+        node_path = edge_path.replace('_edges.csv', '_nodes.csv')
+
+        start = time.perf_counter()
+        new = vectorised_edge_channels(edge_path, node_path)
+        new_time = time.perf_counter() - start
+        total_new += new_time
+
+        old_time = float('nan')
+        if not args.skip_iterrows:
+            start = time.perf_counter()
+            old = iterrows_edge_channels(edge_path, node_path)
+            old_time = time.perf_counter() - start
+            total_old += old_time
+            assert np.allclose(old, new), 'edge channels differ for {}'.format(edge_path)
+
+        name = edge_path.split('/')[-1].replace('_delaunay_orig_forGraphSAGE_edges.csv', '')
+        num_edges = int(np.count_nonzero(new[-1])) // 2
+        print('{:<60} {:>7} {:>12.3f} {:>12.3f}'.format(name, num_edges, old_time, new_time))
+
+    print('Total: iterrows {:.3f}s, vectorised {:.3f}s'.format(total_old, total_new))
+    if not args.skip_iterrows and total_new > 0:
+        print('Speed-up: {:.1f}x'.format(total_old / total_new))
+
+
+if __name__ == '__main__':
+    main()
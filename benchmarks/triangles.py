@@ -0,0 +1,134 @@
+"""
+Benchmark of the triangle search run by KIGraphDatasetSUBGCN on every graph.
+
+Compares the former networkx / pandas find_triangles_by_edge with the CSR implementation in
+datasets.link_prediction on random Delaunay graphs, and checks that both give the same
+triangles, triangles_dict and padding draws.
+
+Run from the repository root as a module, not as a script:
+    python -m benchmarks.triangles --num_nodes 2000 10000 50000
+"""
+import argparse
+import time
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+from benchmarks.common import delaunay_edges
+from datasets.link_prediction import find_triangles_by_edge
+
+
+def networkx_find_triangles_by_edge(nodes_df, edges_df):
+    """
+    Parameters
+    ----------
+    nodes_df : pandas DataFrame
+        Nodes of the graph.
+    edges_df : pandas DataFrame
+        Edges of the graph with source, target and distance.
+    Returns
+    -------
+    triangles, triangles_dict : set, dict
+        Built the way find_triangles_by_edge used to, without DROP_EDGES.
+    """
+    G = nx.Graph()
+    G.add_nodes_from(nodes_df['id'])
+    G.add_edges_from(edges_df[['source', 'target']].values)
+
+    triangles = set()
+    triangles_dict = dict()
+    for (u, v) in G.edges:
+        vertices = sorted(set(G.neighbors(u)).intersection(set(G.neighbors(v))))
+
+        if len(vertices) == 1:
+            triangles.add(frozenset((u, v, vertices[0])))
+            z = u if np.random.rand() < .5 else v
+            triangles_dict[frozenset((u, v))] = [vertices[0], z]
+
+        elif len(vertices) == 2:
+            triangles.add(frozenset((u, v, vertices[0])))
+            triangles.add(frozenset((u, v, vertices[1])))
+            triangles_dict[frozenset((u, v))] = vertices
+
+        elif len(vertices) > 2:
+            filtered_edges = edges_df[(edges_df['source'].isin([u, v, *vertices])) | (edges_df['target'].isin([u, v, *vertices]))]
+            filtered_edges['distance'] = filtered_edges['distance'].astype(float)
+            distances = filtered_edges.groupby(['source', 'target'])['distance'].min().reset_index()
+            neighbor_distances = distances[(distances['source'].isin(vertices)) & (distances['target'].isin([u, v])) |
+                                           (distances['target'].isin(vertices)) & (distances['source'].isin([u, v]))]
+            closest_nodes = []
+            for _, row in neighbor_distances.sort_values('distance').iterrows():
+                source, target = row['source'], row['target']
+                if (source in vertices) and (target == u or target == v) and (source not in closest_nodes):
+                    closest_nodes.append(source)
+                elif (target in vertices) and (source == u or source == v) and (target not in closest_nodes):
+                    closest_nodes.append(target)
+                if len(closest_nodes) >= 2:
+                    break
+            triangles_dict[frozenset((u, v))] = closest_nodes
+            triangles.add(frozenset((u, v, closest_nodes[0])))
+            triangles.add(frozenset((u, v, closest_nodes[1])))
+
+    return triangles, triangles_dict
+
+
+def delaunay_graph(num_nodes, seed=0):
+    """
+    Parameters
+    ----------
+    num_nodes : int
+        Number of cells.
+    seed : int
+        Seed of the cell positions. Default: 0.
+    Returns
+    -------
+    nodes_df, edges_df : pandas DataFrame
+        Delaunay graph of random integer positions, with each edge once in a random orientation.
+    """
+    rng = np.random.default_rng(seed)
+    points = rng.integers(0, 20 * int(np.sqrt(num_nodes)), size=(num_nodes, 2)).astype(float)
+    edges = delaunay_edges(points)
+    edges = edges[rng.permutation(len(edges))]
+    flip = rng.random(len(edges)) < .5
+    edges[flip] = edges[flip, ::-1]
+    distance = np.round(np.linalg.norm(points[edges[:, 0]] - points[edges[:, 1]], axis=1), 3)
+    edges_df = pd.DataFrame({'source': edges[:, 0], 'target': edges[:, 1], 'type': 0, 'distance': distance})
+    return pd.DataFrame({'id': np.arange(num_nodes)}), edges_df
+
+
+def main():
+    pd.options.mode.chained_assignment = None
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_nodes', type=int, nargs='*', default=[2000, 10000, 50000],
+                        help='graph sizes, default: 2000 10000 50000')
+    parser.add_argument('--skip_networkx', action='store_true',
+                        help='only time the CSR implementation, default: False')
+    args = parser.parse_args()
+
+    print('{:>8} {:>8} {:>14} {:>10}'.format('nodes', 'edges', 'networkx (s)', 'CSR (s)'))
+    for num_nodes in args.num_nodes:
+        nodes_df, edges_df = delaunay_graph(num_nodes)
+
+        np.random.seed(0)
+        start = time.perf_counter()
+        triangles, triangles_dict, _ = find_triangles_by_edge(nodes_df, edges_df)
+        new_time = time.perf_counter() - start
+        new_state = np.random.rand()
+
+        old_time = float('nan')
+        if not args.skip_networkx:
+            np.random.seed(0)
+            start = time.perf_counter()
+            old_triangles, old_triangles_dict = networkx_find_triangles_by_edge(nodes_df, edges_df)
+            old_time = time.perf_counter() - start
+            assert old_triangles == triangles, 'triangles differ for {} nodes'.format(num_nodes)
+            assert {k: [int(n) for n in t] for (k, t) in old_triangles_dict.items()} == triangles_dict, \
+                'triangles_dict differs for {} nodes'.format(num_nodes)
+            assert np.random.rand() == new_state, 'padding draws differ for {} nodes'.format(num_nodes)
+
+        print('{:>8} {:>8} {:>14.3f} {:>10.3f}'.format(num_nodes, len(edges_df), old_time, new_time))
+
+
+if __name__ == '__main__':
+    main()
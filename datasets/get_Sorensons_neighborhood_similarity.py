@@ -1,75 +1,80 @@
-
 import csv
-import os
-from tempfile import tempdir
-from tkinter import E
+import time
+import numpy as np
 import pandas as pd
-import math
+import scipy.sparse as sp
 
 
- 
-def get_sorenson_similarity(file_names, csv_path, outPath):
-    
-    for eachGraph in file_names:
-        edge_csv_file = eachGraph.strip()+'_edges.csv'
-        adj_list = {}
+def sorenson_similarity(source, target):
+    """
+    Parameters
+    ----------
+    source, target : list
+        Ids of the endpoints of the E edges.
+    Returns
+    -------
+    similarity : numpy array
+        similarity[e] is 2|N(u) & N(v)| / (|N(u)| + |N(v)|) for the endpoints u, v of edge e.
+    """
+    ids, ends = np.unique(np.column_stack((source, target)).ravel().astype(str), return_inverse=True)
+    u, v = ends[0::2], ends[1::2]
+
+    # Binary symmetric adjacency, parallel edges are counted once.
+    adjacency = sp.csr_matrix((np.ones(2 * len(u)), (np.concatenate((u, v)), np.concatenate((v, u)))),
+                              shape=(len(ids), len(ids)))
+    adjacency.data[:] = 1
+    degrees = np.diff(adjacency.indptr)
 
-        with open (csv_path + edge_csv_file) as edges:
-            edge_reader = csv.reader(edges, delimiter =',')
-            for eachEdge in edge_reader:
-                source , target = eachEdge[0], eachEdge[1]
-                if source != 'source' and target != 'target':
-                    if source in adj_list.keys():
-                        temp = []
-                        temp = list(adj_list[source])
-                        temp.append(target)
-                        adj_list[source] = temp
-                    else: 
-                        adj_list[source] = target
+    # (A.A)[u, v] is the number of common neighbours of u and v.
+    common = np.asarray((adjacency @ adjacency)[u, v]).ravel()
+    return 2 * common / (degrees[u] + degrees[v])
 
-                    if target in adj_list.keys():
-                        temp = []
-                        temp = list(adj_list[target])
-                        temp.append(source)
-                        adj_list[target] = temp
-                    else: 
-                        adj_list [target] = source
-        edges.close()
-        
-        with open (csv_path + edge_csv_file) as edgeFile:
-            edge_reader = csv.reader(edgeFile, delimiter =',')
-            writer = csv.writer(open(outPath+edge_csv_file, 'w', newline='')) 
-            for eachEdge in edge_reader:
-                #print(eachEdge)
-                source , target = eachEdge[0], eachEdge[1]
-                if source != 'source' and target != 'target':
-                    if source in adj_list.keys():
-                        source_list = list(adj_list[source])
-                        target_list = list(adj_list[target])
 
-                        source_set = set(source_list)
-                        common_elements = source_set.intersection(target_list)
-                        common_elements = list(common_elements)
-                        sorenson_similarity = float(2 * len(common_elements) / (len(source_list) + len(target_list)))
-                        #print(sorenson_similarity)
-                    else: 
-                        sorenson_similarity = 0.0
-                else: 
-                    sorenson_similarity = 'Sorenson_Similarity'
-                
-                print(edge_csv_file)
+def get_graph_sorenson_similarity(file, csv_path, outPath):
+    """
+    Parameters
+    ----------
+    file : str
+        Name of the graph, the files are <file>_edges.csv and <file>_nodes.csv.
+    csv_path : str
+        Folder of the input files.
+    outPath : str
+        Folder of the output files. A Sorenson_Similarity column is appended to the edges and the nodes are
+        copied.
+    """
+    edge_csv_file = file.strip() + '_edges.csv'
+    nodes_csv_file = file.strip() + '_nodes.csv'
 
-                eachEdge.append(sorenson_similarity)
-                writer.writerow(eachEdge)
+    with open(csv_path + edge_csv_file) as edges:
+        edge_rows = list(csv.reader(edges, delimiter=','))
 
-        edgeFile.close()
-        # copy the nodes file to the output folder
-        nodes_csv_file = eachGraph.strip()+'_nodes.csv'
-        df = pd.read_csv(csv_path + nodes_csv_file)
-        df.to_csv(outPath + nodes_csv_file, index=False)
+    is_edge = [row[0] != 'source' and row[1] != 'target' for row in edge_rows]
+    edge_ends = [row[:2] for (row, e) in zip(edge_rows, is_edge) if e]
+    similarity = iter(sorenson_similarity([e[0] for e in edge_ends], [e[1] for e in edge_ends]).tolist())
 
+    with open(outPath + edge_csv_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for eachEdge, e in zip(edge_rows, is_edge):
+            eachEdge.append(next(similarity) if e else 'Sorenson_Similarity')
+            writer.writerow(eachEdge)
 
- 
+    # copy the nodes file to the output folder
+    df = pd.read_csv(csv_path + nodes_csv_file)
+    df.to_csv(outPath + nodes_csv_file, index=False)
 
-            
-        
\ No newline at end of file
+
+def get_sorenson_similarity(file_names, csv_path, outPath):
+    """
+    Parameters
+    ----------
+    file_names : list
+        Names of the graphs to process.
+    csv_path : str
+        Folder of the input files.
+    outPath : str
+        Folder of the output files.
+    """
+    for eachGraph in file_names:
+        start = time.time()
+        get_graph_sorenson_similarity(eachGraph, csv_path, outPath)
+        print('{}: Sorenson similarity in {:.2f}s'.format(eachGraph.strip(), time.time() - start))
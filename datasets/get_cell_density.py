@@ -1,68 +1,87 @@
 import csv
-import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 
- 
-def get_cell_density(file_names, csv_path, outPath):
-    #graphs = graphList.readlines()
-    for file in file_names:
-        edge_csv_file = file.strip()+'_edges.csv'
-        node_csv_file = file.strip() + '_nodes.csv'
 
-        with open (csv_path + edge_csv_file) as edges:
-            edge_reader = csv.reader(edges, delimiter =',')
-            node_cell_density = {}
-            node_cell_count = {}
-            node_cell_distance = {}   
-            node_type_density = {}
-            
-            edge_writer = csv.writer(open(outPath+edge_csv_file, 'w', newline=''))
-            for eachEdge in edge_reader:
-                edge_writer.writerow(eachEdge) # copy the edges to the new folder
-            
-                source , target = eachEdge[0], eachEdge[1]
-                dist = eachEdge[3]
-                node_reader = csv.reader(open(csv_path+node_csv_file, 'r'))
-                if source != 'source':    
-                    for eachRow in node_reader:
-                        if source == eachRow[0]: 
-                            source_type = eachRow[7] #get cell-type of the source node
-                        if target == eachRow[0]:
-                            target_type = eachRow[7] #get cell-type of the target node                
-                    if source in node_cell_count.keys():
-                        node_cell_count[source] += 1
-                        node_cell_distance[source] = node_cell_distance[source] + float(dist)
-                    else: 
-                        node_cell_count[source] = 1
-                        node_cell_distance[source] = float(dist)
+def cell_density(node_ids, source, target, distance):
+    """
+    Parameters
+    ----------
+    node_ids : list
+        Ids of the n nodes, as written in the nodes file.
+    source, target : list
+        Ids of the endpoints of the E edges.
+    distance : numpy array
+        Length of the E edges.
+    Returns
+    -------
+    density : numpy array
+        density[i] is the mean length of the edges incident to node i, 0.0 for nodes without edges.
+    """
+    ids, inverse = np.unique(np.asarray(node_ids, dtype=str), return_inverse=True)
 
-                    if target in node_cell_count.keys():
-                        node_cell_count[target] += 1
-                        node_cell_distance[target] = node_cell_distance[target] + float(dist)
+    # Both endpoints of every edge, in edge order, so sums accumulate as the former per-edge loop did.
+    ends = pd.Index(ids).get_indexer(np.column_stack((source, target)).ravel().astype(str))
+    weights = np.repeat(distance, 2)
+    known = ends >= 0
 
-                    else: 
-                        node_cell_count[target] = 1  
-                        node_cell_distance[target] = float(dist)  
+    total = np.bincount(ends[known], weights=weights[known], minlength=len(ids))
+    count = np.bincount(ends[known], minlength=len(ids))
+    return np.divide(total, count, out=np.zeros(len(ids)), where=count > 0)[inverse]
 
-            for eachKey in node_cell_distance.keys():
-                node_cell_density[eachKey] = node_cell_distance[eachKey]/ node_cell_count[eachKey]
-            
-            node_reader = csv.reader(open(csv_path+node_csv_file, 'r'))
-            writer = csv.writer(open(outPath+node_csv_file, 'w', newline=''))   
-            for eachRow in node_reader: 
-                id = eachRow[0]
-                if id in node_cell_density.keys():
-                    cell_density = node_cell_density[id]
-                else:
-                    if id !='id':
-                        cell_density = 0.0 
-                    else:
-                        cell_density = 'Cell_density'
 
-                eachRow.append(cell_density)
-                writer.writerow(eachRow)
+def get_graph_cell_density(file, csv_path, outPath):
+    """
+    Parameters
+    ----------
+    file : str
+        Name of the graph, the files are <file>_edges.csv and <file>_nodes.csv.
+    csv_path : str
+        Folder of the input files.
+    outPath : str
+        Folder of the output files. The edges are copied and a Cell_density column is appended to the nodes.
+    """
+    edge_csv_file = file.strip() + '_edges.csv'
+    node_csv_file = file.strip() + '_nodes.csv'
 
-                 
-        edges.close()
+    with open(csv_path + edge_csv_file) as edges:
+        edge_rows = list(csv.reader(edges, delimiter=','))
+    with open(csv_path + node_csv_file) as nodes:
+        node_rows = list(csv.reader(nodes))
 
- 
\ No newline at end of file
+    with open(outPath + edge_csv_file, 'w', newline='') as f:
+        csv.writer(f).writerows(edge_rows)  # copy the edges to the new folder
+
+    edge_rows = [row for row in edge_rows if row[0] != 'source']
+    node_ids = [row[0] for row in node_rows]
+    density = cell_density(node_ids, [row[0] for row in edge_rows], [row[1] for row in edge_rows],
+                           np.fromiter((float(row[3]) for row in edge_rows), dtype=np.float64, count=len(edge_rows)))
+
+    with open(outPath + node_csv_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for eachRow, value in zip(node_rows, density.tolist()):
+            eachRow.append('Cell_density' if eachRow[0] == 'id' else value)
+            writer.writerow(eachRow)
+
+
+def get_cell_density(file_names, csv_path, outPath, workers=1):
+    """
+    Parameters
+    ----------
+    file_names : list
+        Names of the graphs to process.
+    csv_path : str
+        Folder of the input files.
+    outPath : str
+        Folder of the output files.
+    workers : int
+        Number of graphs processed in parallel. Default: 1.
+    """
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(get_graph_cell_density, file_names,
+                              [csv_path] * len(file_names), [outPath] * len(file_names)))
+    else:
+        for file in file_names:
+            get_graph_cell_density(file, csv_path, outPath)
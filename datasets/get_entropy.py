@@ -1,135 +1,115 @@
-
 import csv
-import os
-from tempfile import tempdir
-from tkinter import E
-import pandas as pd
 import math
+import numpy as np
+import pandas as pd
+
+
+CELL_TYPES = ['lymphocyte', 'epithelial', 'fibroblast and endothelial', 'inflammatory', 'apoptosis / civiatte body']
+
+
+def node_entropy(node_ids, node_types, source, target):
+    """
+    Parameters
+    ----------
+    node_ids : list
+        Ids of the n nodes, as written in the nodes file.
+    node_types : list
+        Cell type of the n nodes, one of CELL_TYPES.
+    source, target : list
+        Ids of the endpoints of the E edges.
+    Returns
+    -------
+    entropy : numpy array
+        Shannon entropy of the cell types of each node and its neighbours.
+    has_edges : numpy array
+        Whether each node has at least one edge. entropy is only defined for those nodes.
+    """
+    node_index = pd.Index(node_ids)
+    codes = pd.Index(CELL_TYPES).get_indexer(node_types)
+    ends = node_index.get_indexer(np.column_stack((source, target)).ravel())
+    neighbours = ends.reshape(-1, 2)[:, ::-1].ravel()
+
+    # type_count[i, c] is the number of neighbours of node i of type c, counted once per edge.
+    type_count = np.zeros((len(node_ids), len(CELL_TYPES)), dtype=np.int64)
+    typed = codes[neighbours] >= 0
+    np.add.at(type_count, (ends[typed], codes[neighbours][typed]), 1)
+
+    has_edges = np.bincount(ends, minlength=len(node_ids)) > 0
+    typed = has_edges & (codes >= 0)
+    type_count[typed, codes[typed]] += 1  # Add self node type for entropy calculation
+
+    prob = type_count / np.maximum(type_count.sum(axis=1, keepdims=True), 1)
+
+    # p * log(p) with math.log on the few distinct probabilities, as the former per-node loop.
+    values, inverse = np.unique(prob, return_inverse=True)
+    logs = np.array([math.log(p) if p > 0 else 0.0 for p in values.tolist()])
+    terms = np.abs(prob * logs[inverse].reshape(prob.shape))
+
+    # Sum in the order epithelial, fibroblast, inflammatory, lymphocyte, apoptosis.
+    entropy = terms[:, 1] + terms[:, 2]
+    for c in (3, 0, 4):
+        entropy = entropy + terms[:, c]
+    return entropy, has_edges
+
+
+def get_graph_entropy(file, csv_path, outPath):
+    """
+    Parameters
+    ----------
+    file : str
+        Name of the graph, the files are <file>_edges.csv and <file>_nodes.csv.
+    csv_path : str
+        Folder of the input files.
+    outPath : str
+        Folder of the output files. A Node_Entropy column is appended to the nodes and a Delta_Entropy
+        column, the absolute entropy difference of the endpoints, to the edges.
+    """
+    edge_csv_file = file.strip() + '_edges.csv'
+    node_csv_file = file.strip() + '_nodes.csv'
+    print(file)
+
+    with open(csv_path + edge_csv_file) as edges:
+        edge_rows = list(csv.reader(edges, delimiter=','))
+    with open(csv_path + node_csv_file, 'r', encoding='iso-8859-1') as nodes:
+        node_rows = list(csv.reader(nodes))
+
+    is_edge = [row[0] != 'source' and row[1] != 'target' for row in edge_rows]
+    edge_ends = [row[:2] for (row, e) in zip(edge_rows, is_edge) if e]
+    is_node = [row[0] != 'id' for row in node_rows]
+    node_data = [row for (row, n) in zip(node_rows, is_node) if n]
+
+    entropy, has_edges = node_entropy([row[0] for row in node_data], [row[7] for row in node_data],
+                                      [e[0] for e in edge_ends], [e[1] for e in edge_ends])
+
+    # Nodes without edges get the header value, as they always did.
+    node_values = iter([v if h else 'Node_Entropy' for (v, h) in zip(entropy.tolist(), has_edges.tolist())])
+    with open(outPath + node_csv_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for eachRow, n in zip(node_rows, is_node):
+            eachRow.append(next(node_values) if n else 'Node_Entropy')
+            writer.writerow(eachRow)
+
+    node_index = pd.Index([row[0] for row in node_data])
+    delta_entropy = np.abs(entropy[node_index.get_indexer([e[0] for e in edge_ends])] -
+                           entropy[node_index.get_indexer([e[1] for e in edge_ends])])
+    edge_values = iter(delta_entropy.tolist())
+    with open(outPath + edge_csv_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for eachEdge, e in zip(edge_rows, is_edge):
+            eachEdge.append(next(edge_values) if e else 'Delta_Entropy')
+            writer.writerow(eachEdge)
+
 
- 
 def get_entropy(file_names, csv_path, outPath):
-     
+    """
+    Parameters
+    ----------
+    file_names : list
+        Names of the graphs to process.
+    csv_path : str
+        Folder of the input files.
+    outPath : str
+        Folder of the output files.
+    """
     for file in file_names:
-        edge_csv_file = file.strip()+'_edges.csv'
-        node_csv_file = file.strip() + '_nodes.csv'
-        adj_list = {}
-        with open (csv_path + edge_csv_file) as edges:
-            print(file)
-            edge_reader = csv.reader(edges, delimiter =',')
-
-            node_cell_type_count = {}
-            for eachEdge in edge_reader:
-                source , target = eachEdge[0], eachEdge[1]
-
-                node_reader = csv.reader(open(csv_path+node_csv_file, 'r', encoding='iso-8859-1'))
-                if source != 'source':    
-                    for eachRow in node_reader:
-                        if source == eachRow[0]: 
-                            source_type = eachRow[7] #get cell-type of the source node
-                        if target == eachRow[0]:
-                            target_type = eachRow[7] #get cell-type of the target node   
-
-                    ### Add neighbours of source              
-                    if source in node_cell_type_count.keys():
-                        temp_source = node_cell_type_count[source]
-                    else: 
-                        temp_source = {'lymphocyte': 0, 'epithelial':0, 'fibroblast and endothelial': 0, 'inflammatory':0,'apoptosis / civiatte body':0, 'total': 0}
-
-                    for eachKey in temp_source.keys():
-                        if target_type == eachKey:
-                            temp_source[target_type] = int(temp_source[target_type]) + 1 # add the count of the node_type
-                            temp_source['total'] = int(temp_source['total']) + 1 # add the total count of all neighbours
-                    
-
-                    node_cell_type_count[source] = temp_source
-
-                    ### Add neighbours of target
-                    if target in node_cell_type_count.keys():
-                        temp = node_cell_type_count[target]
-                    else: 
-                        temp = {'lymphocyte': '0', 'epithelial':'0', 'fibroblast and endothelial': '0', 'inflammatory':'0','apoptosis / civiatte body':0,'total': '0'}
-
-                    for eachKey in temp.keys(): 
-                        if source_type == eachKey: 
-                            temp[source_type] = int(temp[source_type]) + 1
-                            temp['total'] = int(temp['total']) + 1
-                
-
-                    node_cell_type_count[target] = temp
-                        
-            
-            node_reader = csv.reader(open(csv_path+node_csv_file, 'r', encoding='iso-8859-1'))
-            writer = csv.writer(open(outPath+node_csv_file, 'w', newline=''))   
-            node_entropy_dict = {}
-            for eachRow in node_reader: 
-                eachRow = eachRow
-                node_entropy = 'Node_entropy'
-                id = eachRow[0]
-             
-                if id in node_cell_type_count.keys(): 
-                    
-                    id_type = eachRow[7]
-                    entropy_list = node_cell_type_count[id]
-
-                    ###Add self node type for entropy calculation
-                    entropy_list[id_type] = int(entropy_list[id_type]) +1
-                    entropy_list['total'] = int(entropy_list['total']) +1
-
-                    ###Calculate node type probabilities
-                    prob_epi = float(entropy_list['epithelial'])/ float(entropy_list['total'])
-                    prob_lym = float(entropy_list['lymphocyte'])/ float(entropy_list['total'])
-                    prob_fib = float(entropy_list['fibroblast and endothelial'])/ float(entropy_list['total'])
-                    prob_inf = float(entropy_list['inflammatory'])/ float(entropy_list['total'])
-                    prob_apop = float(entropy_list['apoptosis / civiatte body'])/float(entropy_list['total'])
-
-                    if prob_epi == 0.0: 
-                        entropy_epi = 0
-                    else: 
-                        entropy_epi = abs(prob_epi * math.log(prob_epi)) 
-
-                    if prob_lym == 0.0: 
-                        entropy_lym = 0
-                    else: 
-                        entropy_lym = abs(prob_lym * math.log(prob_lym)) 
-
-                    if prob_fib == 0.0: 
-                        entropy_fib = 0
-                    else: 
-                        entropy_fib = abs(prob_fib * math.log(prob_fib)) 
-
-                    if prob_inf == 0.0: 
-                        entropy_inf = 0
-                    else: 
-                        entropy_inf = abs(prob_inf * math.log(prob_inf)) 
-
-                    if prob_apop == 0.0:
-                        entropy_apop = 0.0
-                    else: 
-                        entropy_apop = abs(prob_apop * math.log(prob_apop)) 
-
-
-                    node_entropy = entropy_epi + entropy_fib + entropy_inf + entropy_lym + entropy_apop
-                    node_entropy_dict[id] = node_entropy
-                
-                else:
-                   node_entropy = 'Node_Entropy' 
-                
-                eachRow.append(node_entropy)
-                writer.writerow(eachRow)
-        edges.close()
-
-        with open (csv_path + edge_csv_file) as edges:
-            edge_reader = csv.reader(edges, delimiter =',')
-            edge_writer = csv.writer(open(outPath+edge_csv_file, 'w',newline=''))
-            delta_entropy = 'Delta_Entropy'
-            for eachEdge in edge_reader:
-                source , target = eachEdge[0], eachEdge[1]
-                if source != 'source' and target != 'target' and node_entropy_dict[source] != 'Node_Entropy' and node_entropy_dict[target] != 'Node_Entropy':
-                    delta_entropy = abs(float(node_entropy_dict[source]) - float(node_entropy_dict[target]))
-                else: 
-                    delta_entropy = 'Delta_Entropy'
-                eachEdge.append(delta_entropy)
-                edge_writer.writerow(eachEdge)
-        edges.close()
-
- 
\ No newline at end of file
+        get_graph_entropy(file, csv_path, outPath)
@@ -2,6 +2,7 @@ from __future__ import division
 from math import floor
 import math
 import os
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 pd.options.mode.chained_assignment = None  # default='warn'
@@ -30,6 +31,44 @@ class_map = {'inflammatory': 0, 'lymphocyte' : 1, 'fibroblast and endothelial':
                'epithelial': 3, 'apoptosis / civiatte body': 4}
 
 
+def form_computation_graph(adjacency, idx, num_layers):
+    """
+    Parameters
+    ----------
+    adjacency : scipy.sparse.csr_matrix
+        A (|V| x |V|) adjacency matrix, the neighbors of node v are the columns of its row v.
+    idx : int or list
+        Indices of the node for which the forward pass needs to be computed.
+    num_layers : int
+        Number of layers of the model, the computation graph covers the nodes within num_layers hops of idx.
+    Returns
+    -------
+    node_layers : list of numpy array
+        node_layers[i] is the sorted array of the nodes in the ith layer of the computation graph. node_layers[-1]
+        holds idx and every layer adds the neighbors of the next one.
+    mappings : list of numpy array
+        mappings[i] is a (|V|,) integer array, mappings[i][v] is the position of node v in node_layers[i] and -1 for
+        the nodes that are not in node_layers[i].
+    """
+    indptr, indices = adjacency.indptr.astype(np.int64), adjacency.indices
+    node_layers = [np.unique(np.asarray(idx, dtype=np.int64))]
+    for _ in range(num_layers):
+        prev = node_layers[-1]
+        # Positions in indices of the neighbors of the frontier, its rows of the CSR one after the other.
+        lengths = indptr[prev + 1] - indptr[prev]
+        offsets = np.repeat(indptr[prev] - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        node_layers.append(np.union1d(prev, indices[offsets]).astype(np.int64))
+    node_layers.reverse()
+
+    mappings = []
+    for arr in node_layers:
+        mapping = np.full(adjacency.shape[0], -1, dtype=np.int64)
+        mapping[arr] = np.arange(len(arr))
+        mappings.append(mapping)
+
+    return node_layers, mappings
+
+
 class KIGraphDataset2(Dataset):
 
     def __init__(self, path, mode='train',
@@ -63,8 +102,7 @@ class KIGraphDataset2(Dataset):
         node_path = path[2]
 
         # with glob
-        edges = pd.read_csv(edge_path)
-        nodes = pd.read_csv(node_path)
+        edges, nodes = read_graph_csv(edge_path, node_path)
 
         if add_self_edges:
             for i in range(len(nodes)):
@@ -78,16 +116,8 @@ class KIGraphDataset2(Dataset):
         edges['type'] = edges['type'].replace(1, 0)
 
         col_row_len = len(nodes['id'])
-        distances_close_to_edges = pd.DataFrame(0, index=np.arange(col_row_len), columns=np.arange(col_row_len))
-
-        for i, row in edges.iterrows():
-            source = row['source']
-            target = row['target']
-            distance = row['distance']
-            distances_close_to_edges[source][target] = distance
-            distances_close_to_edges[target][source] = distance
-
-        distances_close_to_edges = np.array(distances_close_to_edges)
+        edge_index, edge_attr = get_edge_channels(edges, nodes, columns=['distance'], density_types=[])
+        distances_close_to_edges = edge_channels_to_dense(edge_index, edge_attr, col_row_len)[0]
 
         # coords
         coords = nodes[["x", "y"]].to_numpy()
@@ -100,23 +130,9 @@ class KIGraphDataset2(Dataset):
         #nuclei_feat = nodes[["area", "perim"]].to_numpy()
 
         all_labels_cell_types = nodes["gt"].to_numpy()
-        nodes_with_types_zero_one = nodes.copy()
-        nodes_with_types_prob = nodes.copy()
-        for i, row in nodes.iterrows():
-            ##The iloc positions are based on the csv cell positions
-            # if row['gt'] == 'null':
-            nodes_with_types_zero_one.iloc[i, 3] = 1 if row['gt'] == 2 else 0
-            nodes_with_types_zero_one.iloc[i, 4] = 1 if row['gt'] == 0 else 0
-            nodes_with_types_zero_one.iloc[i, 1] = 1 if row['gt'] == 1 else 0
-            nodes_with_types_zero_one.iloc[i, 2] = 1 if row['gt'] == 3 else 0
-    
-        print('<<<<<<<<<<<<<', nodes_with_types_zero_one)
 
-        
         # cell_types_scores
-        cell_types_scores = nodes_with_types_zero_one[['inf', 'lym', 'fib', 'epi']] #One-hot encoding of GT data
-
-        cell_types_scores = cell_types_scores.to_numpy()
+        cell_types_scores = get_cell_type_scores(nodes) #One-hot encoding of GT data
         print(cell_types_scores.shape)
 
         # adjacency_matrix_close_to_edges
@@ -158,6 +174,7 @@ class KIGraphDataset2(Dataset):
         self.adjacency_matrix_close_to_edges_as_coo_to_lil = adjacency_matrix_close_to_edges.tolil()
 
         self.node_neighbors = self.adjacency_matrix_close_to_edges_as_coo_to_lil.rows  # Neighbors
+        self.neighbor_adjacency = adjacency_matrix_close_to_edges.tocsr()  # Neighbors, for the computation graphs
 
         cell_density = nodes['Cell_density'].to_numpy() 
         cell_density = np.array(cell_density)
@@ -190,10 +207,7 @@ class KIGraphDataset2(Dataset):
 
         # Generate negative examples not in cell edges crossing path
         neg_examples_close_to_edges = []
-        cur = 0
-        n_count, _choice = self.nodes_count, np.random.choice
         neg_seen = set(tuple(e[:2]) for e in edge_list_crossing_edges)  # Dont sample positive edges
-        adj_tuple = set(tuple(e[:2]) for e in edge_list_close_to_edge)  # List all edges
 
         if self.mode != 'train':  # Add all edges except positive edges if validation/test
             print("self.mode != 'train'")
@@ -204,13 +218,8 @@ class KIGraphDataset2(Dataset):
             neg_examples_close_to_edges = np.array(neg_examples_close_to_edges, dtype=np.int64)
         else:  # Undersample negative samples from adjacency edges not in positive
             num_neg_examples = pos_examples_crossing_edges.shape[0]
-            while cur < num_neg_examples:
-                u, v = _choice(n_count, 2, replace=False)
-                if (u, v) in neg_seen or (u, v) not in adj_tuple:
-                    continue
-                cur += 1
-                neg_examples_close_to_edges.append([u, v])
-            neg_examples_close_to_edges = np.array(neg_examples_close_to_edges, dtype=np.int64)
+            sampler = NegativeSampler(edge_list_close_to_edge, edge_list_crossing_edges)
+            neg_examples_close_to_edges = sampler.sample(num_neg_examples)
 
         x = np.vstack((pos_examples_crossing_edges, neg_examples_close_to_edges))
         y = np.concatenate((np.ones(pos_examples_crossing_edges.shape[0]),
@@ -252,29 +261,13 @@ class KIGraphDataset2(Dataset):
         node_layers : list of numpy array
             node_layers[i] is an array of the nodes in the ith layer of the
             computation graph.
-        mappings : list of dictionary
-            mappings[i] is a dictionary mapping node v (labelled 0 to |V|-1)
+        mappings : list of numpy array
+            mappings[i] is an integer array mapping node v (labelled 0 to |V|-1)
             in node_layers[i] to its position in node_layers[i]. For example,
             if node_layers[i] = [2,5], then mappings[i][2] = 0 and
             mappings[i][5] = 1.
         """
-        _list, _set = list, set
-        if type(idx) is int:
-            node_layers = [np.array([idx], dtype=np.int64)]
-        elif type(idx) is list:
-            node_layers = [np.array(idx, dtype=np.int64)]
-
-        for _ in range(self.num_layers):
-            prev = node_layers[-1]
-            arr = [node for node in prev]
-            arr.extend([e for node in arr for e in self.node_neighbors[node]])  # add neighbors to graph
-            arr = np.array(_list(_set(arr)), dtype=np.int64)
-            node_layers.append(arr)
-        node_layers.reverse()
-
-        mappings = [{j: i for (i, j) in enumerate(arr)} for arr in node_layers]
-
-        return node_layers, mappings
+        return form_computation_graph(self.neighbor_adjacency, idx, self.num_layers)
 
     def collate_wrapper(self, batch):
         """
@@ -291,8 +284,8 @@ class KIGraphDataset2(Dataset):
         node_layers : list of numpy array
             node_layers[i] is an array of the nodes in the ith layer of the
             computation graph.
-        mappings : list of dictionary
-            mappings[i] is a dictionary mapping node v (labelled 0 to |V|-1)
+        mappings : list of numpy array
+            mappings[i] is an integer array mapping node v (labelled 0 to |V|-1)
             in node_layers[i] to its position in node_layers[i]. For example,
             if node_layers[i] = [2,5], then mappings[i][2] = 0 and
             mappings[i][5] = 1.
@@ -311,7 +304,7 @@ class KIGraphDataset2(Dataset):
         dist = torch.from_numpy(self.am_close_to_edges_including_distances)
         labels = torch.FloatTensor([sample[1] for sample in batch])
         edges = np.array([sample[0].numpy() for sample in batch])
-        edges = np.array([mappings[-1][v] for v in edges.flatten()]).reshape(edges.shape)
+        edges = mappings[-1][edges]
 
         # TODO: Pin memory. Change type of node_layers, mappings and rows to
         # tensor?
@@ -411,8 +404,7 @@ class KIGraphDatasetGCN(Dataset):
         node_path = path[2]
 
         # with glob
-        edges = pd.read_csv(edge_path)
-        nodes = pd.read_csv(node_path)
+        edges, nodes = read_graph_csv(edge_path, node_path)
 
         if add_self_edges:
             for i in range(len(nodes)):
@@ -426,54 +418,13 @@ class KIGraphDatasetGCN(Dataset):
         edges['type'] = edges['type'].replace(1, 0)
 
         col_row_len = len(nodes['id'])
-        distances_close_to_edges = pd.DataFrame(0, index=np.arange(col_row_len), columns=np.arange(col_row_len))
-        delta_entropy_edges = pd.DataFrame(0, index=np.arange(col_row_len), columns=np.arange(col_row_len))
-        neighborhood_similarity_edges = pd.DataFrame(0, index=np.arange(col_row_len), columns=np.arange(col_row_len))
-
-        for i, row in edges.iterrows():
-            source = row['source']
-            target = row['target']
-            
-            distance = float(row['distance'])
-           
-            delta_entropy = float(row['Delta_Entropy'])
-            sorenson_neigh_similarity = float(row['Sorenson_Similarity'])
-        
-            distances_close_to_edges[source][target] = distance
-            distances_close_to_edges[target][source] = distance
-
-            delta_entropy_edges[source][target] = delta_entropy
-            delta_entropy_edges[target][source] = delta_entropy
-
-            neighborhood_similarity_edges[source][target] = sorenson_neigh_similarity
-            neighborhood_similarity_edges[target][source] = sorenson_neigh_similarity
-
-
-        distances_close_to_edges = np.array(distances_close_to_edges)
-        delta_entropy_edges = np.array(delta_entropy_edges)
-        neighborhood_similarity_edges = np.array(neighborhood_similarity_edges)
-
         # coords
         coords = nodes[["x", "y"]].to_numpy()
 
-        # process neighborhood densities
-        density_types = ["Cell_density"]
-        #entropy_types = ["Node_Entropy"]
-
-        densities = nodes[density_types].to_numpy()
-        edge_density = np.zeros((col_row_len, col_row_len))
-        edge_densities = np.empty((0, col_row_len, col_row_len))
-
-        
-        for i in range(len(density_types)):
-            for _, row in edges.iterrows():
-                source = int(row['source'])
-                target = int(row['target'])
-
-                edge_density[source][target] = float(densities[:, i][target]) - float(densities[:, i][source])
-                edge_density[target][source] = float(densities[:, i][source]) - float(densities[:, i][target])
-
-            edge_densities = np.append(edge_densities, edge_density.reshape(-1, col_row_len, col_row_len), axis=0)
+        # edge channels: neighborhood densities, Delta_Entropy, Sorenson_Similarity, distance
+        edge_index, edge_attr = get_edge_channels(edges, nodes)
+        edge_densities, delta_entropy_edges, neighborhood_similarity_edges, distances_close_to_edges = \
+            np.split(edge_channels_to_dense(edge_index, edge_attr, col_row_len), edge_attr.shape[0])
 
         #print('*************')
         #print('Edge_density Shape : ' + str(edge_densities.shape))
@@ -518,23 +469,9 @@ class KIGraphDatasetGCN(Dataset):
 
         all_labels_cell_types = nodes["gt"].to_numpy()
 
-        nodes_with_types_zero_one = nodes.copy()
-        nodes_with_types_prob = nodes.copy()
-        for i, row in nodes.iterrows():
-            ##The iloc positions are based on the csv cell positions
-            # if row['gt'] == 'null':
-            nodes_with_types_zero_one.iloc[i, 3] = 1 if row['gt'] == 2 else 0
-            nodes_with_types_zero_one.iloc[i, 4] = 1 if row['gt'] == 0 else 0
-            nodes_with_types_zero_one.iloc[i, 1] = 1 if row['gt'] == 1 else 0
-            nodes_with_types_zero_one.iloc[i, 2] = 1 if row['gt'] == 3 else 0
-    
-        #print('<<<<<<<<<<<<<', nodes_with_types_zero_one)
 
-        
         # cell_types_scores
-        cell_types_scores = nodes_with_types_zero_one[['inf', 'lym', 'fib', 'epi']] #One-hot encoding of GT data
-
-        cell_types_scores = cell_types_scores.to_numpy()
+        cell_types_scores = get_cell_type_scores(nodes) #One-hot encoding of GT data
         #print(cell_types_scores.shape)
 
         # adjacency_matrix_close_to_edges
@@ -577,6 +514,7 @@ class KIGraphDatasetGCN(Dataset):
         self.adjacency_matrix_close_to_edges_as_coo_to_lil = adjacency_matrix_close_to_edges.tolil()
 
         self.node_neighbors = self.adjacency_matrix_close_to_edges_as_coo_to_lil.rows  # Neighbors
+        self.neighbor_adjacency = adjacency_matrix_close_to_edges.tocsr()  # Neighbors, for the computation graphs
 
         #### Code to add node features ### 
 
@@ -613,10 +551,7 @@ class KIGraphDatasetGCN(Dataset):
 
         # Generate negative examples not in cell edges crossing path
         neg_examples_close_to_edges = []
-        cur = 0
-        n_count, _choice = self.nodes_count, np.random.choice
         neg_seen = set(tuple(e[:2]) for e in edge_list_crossing_edges)  # Dont sample positive edges
-        adj_tuple = set(tuple(e[:2]) for e in edge_list_close_to_edge)  # List all edges
 
         if self.mode != 'train':  # Add all edges except positive edges if validation/test
             print("self.mode != 'train'")
@@ -632,13 +567,8 @@ class KIGraphDatasetGCN(Dataset):
             #If using Focal Loss function use the next line else comment it and uncomment the line above for BCE loss 
             #num_neg_examples = int(pos_examples_crossing_edges.shape[0]) # Increasing the size of neg_samples for focal loss function as it can handle class imbalance 
             
-            while cur < num_neg_examples:
-                u, v = _choice(n_count, 2, replace=False)
-                if (u, v) in neg_seen or (u, v) not in adj_tuple:
-                    continue
-                cur += 1
-                neg_examples_close_to_edges.append([u, v])
-            neg_examples_close_to_edges = np.array(neg_examples_close_to_edges, dtype=np.int64)
+            sampler = NegativeSampler(edge_list_close_to_edge, edge_list_crossing_edges)
+            neg_examples_close_to_edges = sampler.sample(num_neg_examples)
 
         x = np.vstack((pos_examples_crossing_edges, neg_examples_close_to_edges))
         y = np.concatenate((np.ones(pos_examples_crossing_edges.shape[0]),
@@ -680,29 +610,13 @@ class KIGraphDatasetGCN(Dataset):
         node_layers : list of numpy array
             node_layers[i] is an array of the nodes in the ith layer of the
             computation graph.
-        mappings : list of dictionary
-            mappings[i] is a dictionary mapping node v (labelled 0 to |V|-1)
+        mappings : list of numpy array
+            mappings[i] is an integer array mapping node v (labelled 0 to |V|-1)
             in node_layers[i] to its position in node_layers[i]. For example,
             if node_layers[i] = [2,5], then mappings[i][2] = 0 and
             mappings[i][5] = 1.
         """
-        _list, _set = list, set
-        if type(idx) is int:
-            node_layers = [np.array([idx], dtype=np.int64)]
-        elif type(idx) is list:
-            node_layers = [np.array(idx, dtype=np.int64)]
-
-        for _ in range(self.num_layers):
-            prev = node_layers[-1]
-            arr = [node for node in prev]
-            arr.extend([e for node in arr for e in self.node_neighbors[node]])  # add neighbors to graph
-            arr = np.array(_list(_set(arr)), dtype=np.int64)
-            node_layers.append(arr)
-        node_layers.reverse()
-
-        mappings = [{j: i for (i, j) in enumerate(arr)} for arr in node_layers]
-
-        return node_layers, mappings
+        return form_computation_graph(self.neighbor_adjacency, idx, self.num_layers)
 
     def collate_wrapper(self, batch):
         """
@@ -818,127 +732,299 @@ def find_triangles_old(nodes_df, edges_df):
     return set(map(tuple, triangles))
     #return [list(x) for x in set(tuple(x) for x in triangles)]
 
+def get_common_neighbors(edge_u, edge_v, adjacency):
+    """
+    Parameters
+    ----------
+    edge_u, edge_v : numpy array
+        Endpoints of the E edges.
+    adjacency : scipy.sparse.csr_matrix
+        Symmetric (n x n) adjacency matrix with sorted indices.
+    Returns
+    -------
+    common : numpy array
+        Common neighbours of every edge, grouped by edge and sorted within each edge.
+    counts : numpy array
+        counts[e] is the number of common neighbours of edge e.
+    """
+    indptr, indices = adjacency.indptr, adjacency.indices.astype(np.int64)
+    degrees = np.diff(indptr)
+
+    # Scan the neighbours of the lower degree endpoint and look them up in the row of the other one.
+    swap = degrees[edge_u] > degrees[edge_v]
+    scan, other = np.where(swap, edge_v, edge_u), np.where(swap, edge_u, edge_v)
+
+    lengths = degrees[scan]
+    edge_id = np.repeat(np.arange(len(scan)), lengths)
+    starts = np.repeat(indptr[scan] - np.cumsum(lengths) + lengths, lengths)
+    candidates = indices[starts + np.arange(len(edge_id))]
+
+    num_nodes = adjacency.shape[0]
+    adjacency_keys = np.repeat(np.arange(num_nodes, dtype=np.int64), degrees) * num_nodes + indices
+    candidate_keys = other[edge_id] * num_nodes + candidates
+    pos = np.minimum(np.searchsorted(adjacency_keys, candidate_keys), len(adjacency_keys) - 1)
+    hit = adjacency_keys[pos] == candidate_keys
+
+    return candidates[hit], np.bincount(edge_id[hit], minlength=len(scan))
+
+
 def find_triangles_by_edge(nodes_df, edges_df, DROP_EDGES=False):
-    # Create a NetworkX graph from the nodes and edges DataFrames
-    G = nx.Graph()
-    G.add_nodes_from(nodes_df['id'])
-    G.add_edges_from(edges_df[['source', 'target']].values)
+    """
+    Parameters
+    ----------
+    nodes_df : pandas DataFrame
+        Nodes of the graph.
+    edges_df : pandas DataFrame
+        Edges of the graph with source, target and distance.
+    DROP_EDGES : bool
+        Whether to drop the edges closing a single triangle instead of padding them. Default: False.
+    Returns
+    -------
+    triangles : set
+        Triangles of the graph as frozensets of their three nodes.
+    triangles_dict : dict
+        triangles_dict[frozenset((u, v))] are the two nodes [z, w] closing a triangle with edge (u, v). With more
+        than two common neighbours the two nearest to u or v are kept, with a single one the second node is u or v at random.
+    edges_df : pandas DataFrame
+        edges_df without the dropped edges.
+    """
+    node_ids = nodes_df['id'].to_numpy(dtype=np.int64)
+    source = edges_df['source'].to_numpy(dtype=np.int64)
+    target = edges_df['target'].to_numpy(dtype=np.int64)
+    distance = edges_df['distance'].to_numpy(dtype=np.float64)
+    num_nodes = int(max(node_ids.max(initial=-1), source.max(initial=-1), target.max(initial=-1))) + 1
+
+    # Position of every node in the node order of a networkx Graph built from nodes_df and edges_df.
+    pos = np.full(num_nodes, -1, dtype=np.int64)
+    pos[node_ids] = np.arange(len(node_ids))
+    stream = np.column_stack((source, target)).ravel()
+    missing = stream[pos[stream] < 0]
+    _, first = np.unique(missing, return_index=True)
+    pos[missing[np.sort(first)]] = len(node_ids) + np.arange(len(first))
+
+    # Undirected edges (u, v) in the order networkx iterates G.edges: by position of u, then by first
+    # appearance of the edge. The padding draws np.random.rand in that order.
+    swap = pos[source] > pos[target]
+    row_keys = np.where(swap, target, source) * num_nodes + np.where(swap, source, target)
+    keys, first_row = np.unique(row_keys, return_index=True)
+    order = np.lexsort((first_row, pos[keys // num_nodes]))
+    u, v = keys[order] // num_nodes, keys[order] % num_nodes
+
+    adjacency = sp.csr_matrix((np.ones(2 * len(u)), (np.concatenate((u, v)), np.concatenate((v, u)))),
+                              shape=(num_nodes, num_nodes))
+    adjacency.sum_duplicates()
+    adjacency.sort_indices()
+    common, counts = get_common_neighbors(u, v, adjacency)
+    offsets = np.concatenate(([0], np.cumsum(counts)))[:-1]
+
+    # z, w of every edge, for two common neighbours and the first one of the others.
+    z = common[np.minimum(offsets, len(common) - 1)] if len(common) > 0 else np.zeros(len(u), dtype=np.int64)
+    w = common[np.minimum(offsets + 1, len(common) - 1)] if len(common) > 0 else np.zeros(len(u), dtype=np.int64)
+
+    single = counts == 1
+    kept = counts > 0
+    if DROP_EDGES:
+        dropped_at = np.full(len(keys), len(keys))  # iteration step at which each edge is dropped, by position in keys
+        dropped_at[order[single]] = np.flatnonzero(single)
+        for (a, b) in zip(u[single].tolist(), v[single].tolist()):
+            print("Dropping edge ({},{})".format(a, b))
+        kept &= ~single
+    else:
+        # MAYBE WE CAN DEAL WITH PADDING LATER IN THE CODE
+        #PADDING: add random vertex = u,v or z
+        rand = np.random.rand(int(single.sum()))
+        w[single] = np.where(rand < .5, u[single], v[single])
+
+    # Minimum distance of every directed (source, target) pair, sorted by (source, target) as a pandas groupby.
+    directed_keys = source * num_nodes + target
+    sorted_rows = np.argsort(directed_keys, kind='stable')
+    directed_keys, starts = np.unique(directed_keys[sorted_rows], return_index=True)
+    directed_distance = np.minimum.reduceat(distance[sorted_rows], starts) if len(starts) > 0 else distance
+
+    for e in np.flatnonzero(counts > 2):
+        # Keep the two common neighbours nearest to u or v, breaking ties as the former pandas sort_values did.
+        vertices = common[offsets[e]:offsets[e] + counts[e]]
+        ends = np.array([u[e], v[e]])
+        pairs = np.concatenate((np.add.outer(vertices * num_nodes, ends).ravel(),
+                                np.add.outer(ends * num_nodes, vertices).ravel()))
+        pairs = np.unique(pairs)
+        found = np.minimum(np.searchsorted(directed_keys, pairs), len(directed_keys) - 1)
+        found = found[directed_keys[found] == pairs]
+        if DROP_EDGES:
+            pair_s, pair_t = directed_keys[found] // num_nodes, directed_keys[found] % num_nodes
+            flip = pos[pair_s] > pos[pair_t]
+            undirected = np.where(flip, pair_t, pair_s) * num_nodes + np.where(flip, pair_s, pair_t)
+            found = found[dropped_at[np.searchsorted(keys, undirected)] >= e]
+
+        closest_nodes = []
+        for k in found[np.argsort(directed_distance[found], kind='quicksort')]:
+            s, t = divmod(int(directed_keys[k]), num_nodes)
+            node = s if s in vertices else t
+            if node not in closest_nodes:
+                closest_nodes.append(node)
+            if len(closest_nodes) >= 2:
+                break
+        z[e], w[e] = closest_nodes
+
+    u, v, z, w = u[kept], v[kept], z[kept], w[kept]
+    triangles_dict = dict(zip(map(frozenset, zip(u.tolist(), v.tolist())), np.column_stack((z, w)).tolist()))
+
+    closing = np.vstack((np.column_stack((u, v, z)), np.column_stack((u, v, w))[counts[kept] > 1]))
+    triangles = set(map(frozenset, closing.tolist()))
+
+    if DROP_EDGES:
+        edges_df = edges_df[~np.isin(row_keys, keys[dropped_at < len(keys)])]
 
-    # Find triangles
-    triangles = set()
-    triangles_dict = dict()
-    for (u,v) in G.edges:
-        tmp = set()
-        neighbors_u = set(G.neighbors(u))
-        neighbors_v = set(G.neighbors(v))
-
-        vertices = sorted(neighbors_u.intersection(neighbors_v))
-
-        if len(vertices) == 1: 
-            if DROP_EDGES:
-                print("Dropping edge ({},{})".format(u,v))
-                # drop edge from df
-                edges_df = edges_df.drop(edges_df[(edges_df['source'] == u) & (edges_df['target'] == v)].index)
-                edges_df = edges_df.drop(edges_df[(edges_df['source'] == v) & (edges_df['target'] == u)].index)
-                continue
-            else:
-                #triangles_dict[frozenset((u,v))] = 
-                t1 = frozenset((u,v,vertices[0]))
-                tmp.add(t1)
-                triangles.add(t1)
-                # MAYBE WE CAN DEAL WITH PADDING LATER IN THE CODE
-                #PADDING: add random vertex = u,v or z    
-                rand = np.random.rand()
-                if rand < .5:
-                    tmp.add((u,v,u))
-                    z=u
-                else:
-                    tmp.add((u,v,v)) # we cannot use frozenset with 2 equal nodes
-                    z=v
-                #else: tmp.add(frozenset(u,v,vertices[0]))
-
-                triangles_dict[frozenset((u,v))] = [vertices[0], z]
-
-        elif len(vertices) == 2:
-            t1, t2 = frozenset((u,v,vertices[0])), frozenset((u,v,vertices[1]))
-            tmp.add(t1)
-            tmp.add(t2)
-            triangles.add(t1)
-            triangles.add(t2)
-
-            triangles_dict[frozenset((u,v))] = vertices
-
-
-
-        elif len(vertices) > 2:
-            #print("More than 2 neighbors for edge ({},{})".format(u,v))
-            #print("Neighbors: ", vertices)
-            # Get the edges information
-            filtered_edges = edges_df[(edges_df['source'].isin([u, v, *vertices])) | (edges_df['target'].isin([u, v, *vertices]))]
-            # convert distance to float
-            filtered_edges['distance'] = filtered_edges['distance'].astype(float)
-            distances = filtered_edges.groupby(['source', 'target'])['distance'].min().reset_index()
-            #print("ok1")
-            neighbor_distances = distances[(distances['source'].isin(vertices)) & (distances['target'].isin([u,v])) |
-                                            (distances['target'].isin(vertices)) & (distances['source'].isin([u,v]))]
-            #print("Neighbor distances: ", neighbor_distances)
-            #print("ok2")
-            sorted_distances = neighbor_distances.sort_values('distance')
-            #print("Sorted distances: ", sorted_distances)
-            #print("ok3")
-            
-            closest_nodes = []
+    return triangles, triangles_dict, edges_df
 
-            # Iterate through the sorted distances
-            for _, row in sorted_distances.iterrows():
-                source, target = row['source'], row['target']
 
-                # append the closest nodes to the list if in vertices and common neighbors of u and v
-                if (source in vertices) and (target == u or target == v) and (source not in closest_nodes):
-                    closest_nodes.append(source)
-                elif (target in vertices) and (source == u or source == v) and (target not in closest_nodes):
-                    closest_nodes.append(target)
+EDGE_DTYPES = {'source': np.int64, 'target': np.int64, 'type': np.int64, 'distance': np.float64,
+               'Delta_Entropy': np.float64, 'Sorenson_Similarity': np.float64}
+NODE_DTYPES = {'id': np.int64, 'lym': np.float64, 'epi': np.float64, 'fib': np.float64, 'inf': np.float64,
+               'Cell_density': np.float64, 'Node_Entropy': np.float64}
 
 
-               # Break the loop if we have found the required number of closest nodes
-                if len(closest_nodes) >= 2:
-                    break
-            
-            #print("ok4")
-            #print("Closest nodes: ", closest_nodes)
-            t1, t2 = frozenset((u,v,closest_nodes[0])), frozenset((u,v,closest_nodes[1]))
-            triangles_dict[frozenset((u,v))] = closest_nodes
-            #print("Triangles: ", t1, t2)
+def read_graph_csv(edge_path, node_path):
+    """
+    Parameters
+    ----------
+    edge_path : str
+        Path to the *_edges.csv file.
+    node_path : str
+        Path to the *_nodes.csv file.
+    Returns
+    -------
+    edges_df : pandas DataFrame
+        Edges of the graph, with typed columns.
+    nodes_df : pandas DataFrame
+        Nodes of the graph, with typed columns.
+    """
+    edges_df = pd.read_csv(edge_path, dtype=EDGE_DTYPES)
+    nodes_df = pd.read_csv(node_path, dtype=NODE_DTYPES)
+    return edges_df, nodes_df
 
-            triangles.add(t1)
-            triangles.add(t2)
 
+def get_cell_type_scores(nodes_df):
+    """
+    Parameters
+    ----------
+    nodes_df : pandas DataFrame
+        Nodes of the graph, with the gt column already mapped to the class_map codes.
+    Returns
+    -------
+    cell_types_scores : numpy array
+        An (n x 4) one-hot encoding of the cell types, in the order inf, lym, fib, epi.
+    """
+    gt = nodes_df['gt'].to_numpy()
+    return np.stack([gt == c for c in range(4)], axis=1).astype(np.float64)
 
-        """elif len(vertices) == 0:
-            
-            print("-------------ERROR--------------------")
-            # This shpuldn't happen - SKIPP this part for now, i just kept this code for later 
-            t1, t2, t3 = frozenset((u,v,vertices[0])), frozenset((u,v,vertices[1])), frozenset((u,v,vertices[2]))
-            tmp.add(t1)
-            tmp.add(t2)
-            tmp.add(t3)
-
-            for n in vertices:
-                if G.degree(n) == 3:
-                    print("------ Removing outer triangles -------")
-                    try: 
-                        tmp.remove(frozenset(G.neighbors(n)))
-                        vertices.remove(n)
-                    except:
-                        print("------No Outer Triangle for: ", list(G.neighbors(n)), " ----------")
-
-            triangles.add(list(tmp)[0])
-            triangles.add(list(tmp)[1])
-
-            triangles_dict[frozenset((u,v))] = vertices    """        
 
-    
-    return triangles, triangles_dict, edges_df
+class NegativeSampler:
+    """
+    Draws negative examples uniformly, with replacement, among the adjacency edges that are not positive. This is
+    the distribution of the former rejection loop on np.random.choice, drawn straight from the candidate edges.
+    """
+
+    def __init__(self, adjacency_edges, positive_edges, seed=None):
+        """
+        Parameters
+        ----------
+        adjacency_edges : numpy array
+            (E x 2) edges of the graph, the negatives are drawn among them.
+        positive_edges : numpy array
+            (P x 2) positive edges, never drawn.
+        seed : int
+            Seed of the sampler's own RNG, None to draw from the global numpy RNG. Default: None.
+        """
+        adjacency_edges = np.unique(np.asarray(adjacency_edges)[:, :2].astype(np.int64), axis=0)
+        positive_edges = np.asarray(positive_edges).reshape(len(positive_edges), -1)[:, :2].astype(np.int64)
+
+        num_nodes = int(max(adjacency_edges.max(initial=0), positive_edges.max(initial=0))) + 1
+        negative = ~np.isin(adjacency_edges[:, 0] * num_nodes + adjacency_edges[:, 1],
+                            positive_edges[:, 0] * num_nodes + positive_edges[:, 1])
+        negative &= adjacency_edges[:, 0] != adjacency_edges[:, 1]  # a node is never paired with itself
+        self.candidates = adjacency_edges[negative]
+        self.rng = np.random if seed is None else np.random.RandomState(seed)
+
+    def sample(self, num):
+        """
+        Parameters
+        ----------
+        num : int
+            Number of negative examples.
+        Returns
+        -------
+        negatives : numpy array
+            (num x 2) negative edges, empty if the graph has no candidate.
+        """
+        if len(self.candidates) == 0:
+            print('No negative candidate edges, no negative examples sampled.')
+            return np.empty((0, 2), dtype=np.int64)
+        return self.candidates[self.rng.randint(len(self.candidates), size=num)]
+
+
+def get_edge_channels(edges_df, nodes_df, columns=['Delta_Entropy', 'Sorenson_Similarity', 'distance'],
+                      density_types=["Cell_density"]):
+    """
+    Parameters
+    ----------
+    edges_df : pandas DataFrame
+        Edges of the graph with source, target and the given columns.
+    nodes_df : pandas DataFrame
+        Nodes of the graph with the density_types columns.
+    columns : list
+        Edge columns turned into symmetric channels. Default: ['Delta_Entropy', 'Sorenson_Similarity', 'distance'].
+    density_types : list
+        Node columns turned into (target - source) edge channels. Default: ["Cell_density"].
+    Returns
+    -------
+    edge_index : numpy array
+        A (2 x E) array with both orientations of every edge. edge_index[:, e] is the (row, column) of the eth entry.
+    edge_attr : numpy array
+        A (p x E) array of edge features, the density channels first followed by columns.
+    """
+    source = edges_df['source'].to_numpy(dtype=np.int64)
+    target = edges_df['target'].to_numpy(dtype=np.int64)
+
+    # Interleave (source, target) and (target, source) so that duplicated entries keep the
+    # value of the last write, as the former cell-by-cell fill did.
+    rows = np.column_stack((source, target)).ravel()
+    cols = np.column_stack((target, source)).ravel()
+
+    channels = []
+    densities = nodes_df[density_types].to_numpy(dtype=np.float64)
+    for i in range(len(density_types)):
+        channels.append(densities[cols, i] - densities[rows, i])
+    for column in columns:
+        values = edges_df[column].to_numpy(dtype=np.float64)
+        channels.append(np.repeat(values, 2))
+    edge_attr = np.vstack(channels)
+
+    keys = rows * len(nodes_df) + cols
+    _, last = np.unique(keys[::-1], return_index=True)
+    keep = len(keys) - 1 - last
+
+    return np.vstack((rows[keep], cols[keep])), edge_attr[:, keep]
+
+
+def edge_channels_to_dense(edge_index, edge_attr, num_nodes):
+    """
+    Parameters
+    ----------
+    edge_index : numpy array
+        A (2 x E) array of unique (row, column) entries.
+    edge_attr : numpy array
+        A (p x E) array of edge features.
+    num_nodes : int
+        Number of nodes of the graph.
+    Returns
+    -------
+    edge_features : numpy array
+        A dense (p x n x n) array, zero where there is no edge.
+    """
+    edge_features = np.zeros((edge_attr.shape[0], num_nodes, num_nodes))
+    edge_features[:, edge_index[0], edge_index[1]] = edge_attr
+    return edge_features
 
 
 def extract_features(xc, yc, patch_size, image, model):
@@ -1037,12 +1123,83 @@ ADD_NODE_FEATURES = False
 ADD_EDGE_FEATURES = False #Result in out of memory error
 ADD_MOTIF_FEATURES = False
 TRIANGLES_ext = True
+EDGE_CHANNEL_COLUMNS = ['Delta_Entropy', 'Sorenson_Similarity', 'distance']
+EDGE_DENSITY_TYPES = ["Cell_density"]
+
+
+def triangles_dict_to_arrays(triangles_dict):
+    """
+    Parameters
+    ----------
+    triangles_dict : dict
+        triangles_dict[frozenset((u, v))] are the two nodes [z, w] closing a triangle with edge (u, v).
+    Returns
+    -------
+    tri_edges : numpy array
+        A (T x 2) array of the (u, v) keys, u < v.
+    tri_nodes : numpy array
+        A (T x 2) array of the [z, w] values, in the same order.
+    """
+    tri_edges = np.array([sorted(k) for k in triangles_dict.keys()], dtype=np.int64).reshape(-1, 2)
+    tri_nodes = np.array([[int(z) for z in t] for t in triangles_dict.values()], dtype=np.int64).reshape(-1, 2)
+    return tri_edges, tri_nodes
+
+
+def arrays_to_triangles_dict(tri_edges, tri_nodes):
+    """
+    Parameters
+    ----------
+    tri_edges : numpy array
+        A (T x 2) array of edges, see triangles_dict_to_arrays.
+    tri_nodes : numpy array
+        A (T x 2) array of the nodes closing a triangle with each edge.
+    Returns
+    -------
+    triangles_dict : dict
+        triangles_dict[frozenset((u, v))] = [z, w].
+    """
+    return {frozenset(e): t for e, t in zip(np.asarray(tri_edges).tolist(), np.asarray(tri_nodes).tolist())}
+
+
+class GraphResidency:
+    """
+    Keeps the edge features of at most max_resident KIGraphDatasetSUBGCN built, the least recently used dataset
+    releases them when another one needs its own.
+    """
+
+    def __init__(self, max_resident):
+        """
+        Parameters
+        ----------
+        max_resident : int
+            Maximum number of datasets with their edge features built at the same time.
+        """
+        self.max_resident = max_resident
+        self.resident = OrderedDict()
+
+    def acquire(self, dataset):
+        """
+        Parameters
+        ----------
+        dataset : KIGraphDatasetSUBGCN
+            Dataset whose edge features are about to be used.
+        """
+        if dataset in self.resident:
+            self.resident.move_to_end(dataset)
+            return
+        while len(self.resident) >= self.max_resident:
+            evicted, _ = self.resident.popitem(last=False)
+            evicted.release_edge_features()
+        dataset.load_edge_features()
+        self.resident[dataset] = None
+
 
 class KIGraphDatasetSUBGCN(Dataset):
 
     def __init__(self, path, mode='train',
                  num_layers=2,
-                 data_split=[0.8, 0.2], add_self_edges=False):
+                 data_split=[0.8, 0.2], add_self_edges=False, sparse=False, cache_dir=None, graph=None,
+                 residency=None):
         """
         Parameters
         ----------
@@ -1054,6 +1211,16 @@ class KIGraphDatasetSUBGCN(Dataset):
             Number of layers in the computation graph. Default: 2.
         data_split: list
             Fraction of edges to use for graph construction / train / val / test. Default: [0.85, 0.08, 0.02, 0.03].
+        sparse : bool
+            Whether to keep edge_features, dist and adj as sparse COO tensors instead of dense (p x n x n) arrays,
+            with the same shapes. Not supported with ADD_EDGE_FEATURES. Default: False.
+        cache_dir : str
+            Directory of the preprocessed graph cache, see utils.load_graph_cache. None disables the cache. Default: None.
+        graph : dict
+            The graph returned by load_graph, None to read it here. Default: None.
+        residency : GraphResidency
+            If given, edge_features, dist and adj are only built while the dataset is resident in it, see
+            load_edge_features. Default: None, they are built here and kept.
         """
         super().__init__()
 
@@ -1061,31 +1228,106 @@ class KIGraphDatasetSUBGCN(Dataset):
         self.mode = mode
         self.num_layers = num_layers
         self.data_split = data_split
+        self.sparse = sparse
+        if sparse and ADD_EDGE_FEATURES:
+            raise ValueError('sparse edge features do not support ADD_EDGE_FEATURES, the morph channels are only '
+                             'added to the dense (p x n x n) edge features')
+        self.residency = residency
+        self.device = 'cpu'
 
         print('--------------------------------')
         print('Reading edge dataset from {}'.format(self.path[0]))
 
+        if graph is None:
+            graph = self._load_graph(add_self_edges, cache_dir)
+        self._setup_graph(graph)
+
+        num_pos = int(np.sum(graph['y'] == 1))
+        print('Dataset properties:')
+        print('Mode: {}'.format(self.mode))
+        print('Number of vertices: {}'.format(self.nodes_count))
+        print('Number of edges: {}'.format(self.edges_count))
+        print('Number of triangles: {}'.format(len(self.triangles)))
+        print('Number of positive/negative datapoints: {}/{}'.format(num_pos, len(graph['y']) - num_pos))
+        print('Number of examples/datapoints: {}'.format(self.x.shape[0]))
+
+        print('--------------------------------')
+
+    @classmethod
+    def load_graph(cls, path, mode='train', data_split=[0.8, 0.2], add_self_edges=False, cache_dir=None):
+        """
+        Reads the graph of a dataset without setting it up, so that it can be done in another process and passed
+        to the constructor. The parameters are the ones of the constructor.
+
+        Returns
+        -------
+        graph : dict
+            The preprocessed graph, see _read_graph.
+        """
+        reader = cls.__new__(cls)
+        reader.path, reader.mode, reader.data_split = path, mode, data_split
+        return reader._load_graph(add_self_edges, cache_dir)
+
+    def _load_graph(self, add_self_edges, cache_dir):
+        """
+        Parameters
+        ----------
+        add_self_edges : bool
+            Whether to add a (v, v) edge for every node.
+        cache_dir : str
+            Directory of the preprocessed graph cache, None to always read the CSV files.
+        Returns
+        -------
+        graph : dict
+            The preprocessed graph, from the cache when available, see _read_graph.
+        """
+        # Image based features need the slide image and are never cached.
+        use_cache = cache_dir is not None and not (ADD_NODE_FEATURES or ADD_EDGE_FEATURES or ADD_MOTIF_FEATURES)
+        graph = None
+        if use_cache:
+            cache_path = utils.get_graph_cache_path(cache_dir, self.path, mode=self.mode, data_split=self.data_split,
+                                                    add_self_edges=add_self_edges, triangles=TRIANGLES_ext,
+                                                    columns=EDGE_CHANNEL_COLUMNS, density_types=EDGE_DENSITY_TYPES)
+            graph = utils.load_graph_cache(cache_path)
+        if graph is None:
+            graph = self._read_graph(add_self_edges)
+            if use_cache:
+                utils.save_graph_cache(cache_path, graph)
+        else:
+            print('Loaded cached graph from {}'.format(cache_path))
+        return graph
+
+    def _read_graph(self, add_self_edges):
+        """
+        Parameters
+        ----------
+        add_self_edges : bool
+            Whether to add a (v, v) edge for every node.
+        Returns
+        -------
+        graph : dict
+            The preprocessed graph as numpy arrays, see _setup_graph. This is what the graph cache stores.
+        """
         ########## MINE ###########
         # Cells, distance_close_to_edges
-        edge_path = path[1]
-        node_path = path[2]
+        edge_path = self.path[1]
+        node_path = self.path[2]
     
 
         # with glob
-        edges = pd.read_csv(edge_path)
-        nodes = pd.read_csv(node_path)
+        edges, nodes = read_graph_csv(edge_path, node_path)
 
 
         if TRIANGLES_ext:
-            self.triangles, self.triangles_dict, edges = find_triangles_by_edge(nodes, edges)
+            triangles, triangles_dict, edges = find_triangles_by_edge(nodes, edges)
         else:
-            self.triangles = set()
-            self.triangles_dict = dict()
+            triangles = set()
+            triangles_dict = dict()
 
         ## TODO: ADD a condintion to check if the node features are required or not
         if ADD_NODE_FEATURES or ADD_EDGE_FEATURES or ADD_MOTIF_FEATURES:
             #image_path = '..\\..\\intelligraph\\slides\\' + path[0].split('\\')[1] + '.tif'
-            image_path = 'datasets\\images\\' + path[0].split('\\')[1] + '.tif'
+            image_path = 'datasets\\images\\' + self.path[0].split('\\')[1] + '.tif'
             image = Image.open(image_path)
             image = image.convert('RGB')
             image = np.array(image)
@@ -1107,71 +1349,14 @@ class KIGraphDatasetSUBGCN(Dataset):
         edges['type'] = edges['type'].replace(1, 0)
 
         col_row_len = len(nodes['id'])
-        
-         
-
-       
-
-        distances_close_to_edges = pd.DataFrame(0, index=np.arange(col_row_len), columns=np.arange(col_row_len))
-        delta_entropy_edges = pd.DataFrame(0, index=np.arange(col_row_len), columns=np.arange(col_row_len))
-        neighborhood_similarity_edges = pd.DataFrame(0, index=np.arange(col_row_len), columns=np.arange(col_row_len))
-
-        for i, row in edges.iterrows():
-            source = row['source']
-            target = row['target']
-            
-            distance = float(row['distance'])
-           
-            delta_entropy = float(row['Delta_Entropy'])
-            sorenson_neigh_similarity = float(row['Sorenson_Similarity'])
-        
-            distances_close_to_edges[source][target] = distance
-            distances_close_to_edges[target][source] = distance
-
-            delta_entropy_edges[source][target] = delta_entropy
-            delta_entropy_edges[target][source] = delta_entropy
-
-            neighborhood_similarity_edges[source][target] = sorenson_neigh_similarity
-            neighborhood_similarity_edges[target][source] = sorenson_neigh_similarity
-
-
-        distances_close_to_edges = np.array(distances_close_to_edges)
-        delta_entropy_edges = np.array(delta_entropy_edges)
-        neighborhood_similarity_edges = np.array(neighborhood_similarity_edges)
 
         # coords
         coords = nodes[["x", "y"]].to_numpy()
 
-        # process neighborhood densities
-        density_types = ["Cell_density"]
-        #entropy_types = ["Node_Entropy"]
-
-        densities = nodes[density_types].to_numpy()
-        edge_density = np.zeros((col_row_len, col_row_len))
-        edge_densities = np.empty((0, col_row_len, col_row_len))
-
-        
-        for i in range(len(density_types)):
-            for _, row in edges.iterrows():
-                source = int(row['source'])
-                target = int(row['target'])
-
-                edge_density[source][target] = float(densities[:, i][target]) - float(densities[:, i][source])
-                edge_density[target][source] = float(densities[:, i][source]) - float(densities[:, i][target])
-
-            edge_densities = np.append(edge_densities, edge_density.reshape(-1, col_row_len, col_row_len), axis=0)
-
-        #print('*************')
-        #print('Edge_density Shape : ' + str(edge_densities.shape))
-        
-        distances_close_to_edges = distances_close_to_edges.reshape(-1, col_row_len, col_row_len)
-        delta_entropy_edges = delta_entropy_edges.reshape(-1, col_row_len, col_row_len)
-        neighborhood_similarity_edges = neighborhood_similarity_edges.reshape(-1, col_row_len, col_row_len)
-
-        #print('Edge_entropy Shape : ' + str(delta_entropy_edges.shape))
-        #print('Edge_distance Shape : ' + str(distances_close_to_edges.shape))
-        #print('Neighborhood Similarity Shape : ' + str(neighborhood_similarity_edges.shape))
+        # edge channels: neighborhood densities, Delta_Entropy, Sorenson_Similarity, distance
+        edge_index, edge_attr = get_edge_channels(edges, nodes, EDGE_CHANNEL_COLUMNS, EDGE_DENSITY_TYPES)
 
+        graph = dict()
         if ADD_EDGE_FEATURES:
             edges['morph_features'] = None
 
@@ -1187,40 +1372,13 @@ class KIGraphDatasetSUBGCN(Dataset):
                 features = torch.from_numpy(features)
                 source = row['source']
                 target = row['target']
-                
+            
                 morph_features[source][target] = features
                 morph_features[target][source] = features
 
             #edge_morph_features = edges['morph_features'].to_numpy()
             #edge_morph_features = np.array(edge_morph_features)
-
-
-            
-            edge_features = np.concatenate((edge_densities, delta_entropy_edges, neighborhood_similarity_edges, distances_close_to_edges, morph_features.permute(2, 0, 1)), axis=0)
-        
-        else:
-            #edge_features = distances_close_to_edges #e1
-            #edge_features = np.concatenate((edge_densities, distances_close_to_edges), axis=0) #E12
-            #edge_features = np.concatenate((edge_densities, delta_entropy_edges, distances_close_to_edges), axis=0) #E123
-            edge_features = np.concatenate((edge_densities, delta_entropy_edges, neighborhood_similarity_edges, distances_close_to_edges), axis=0)
-        
-        #edge_features = delta_entropy_edges
-        #print(edge_features)
-        # self.edge_features = utils.normalize_edge_feature_doubly_stochastic(edge_features) ### not to be used
-        self.edge_features = utils.normalize_edge_features_rows(edge_features) ### Use it to normalise the edge features
-        #self.edge_features = edge_features  ### Use only if not using the normalization feature above
-
-
-        ## To DO 
-
-        # Change utils.normalize_edge_features_rows to log function to the base e
-
-        #####
-
-        self.channel = edge_features.shape[0]
-
-        self.dist = utils.normalize_edge_features_rows(distances_close_to_edges.reshape(-1, col_row_len, col_row_len))
-
+            graph['morph_features'] = morph_features
 
         # all_labels_cell_types
         nodes["gt"].replace({'inflammatory': 0, 'lymphocyte': 1, 'fibroblast and endothelial': 2, 'epithelial': 3}, inplace=True) # hover-net
@@ -1231,30 +1389,11 @@ class KIGraphDatasetSUBGCN(Dataset):
 
         all_labels_cell_types = nodes["gt"].to_numpy()
 
-        nodes_with_types_zero_one = nodes.copy()
-        nodes_with_types_prob = nodes.copy()
-        for i, row in nodes.iterrows():
-            ##The iloc positions are based on the csv cell positions
-            # if row['gt'] == 'null':
-            nodes_with_types_zero_one.iloc[i, 3] = 1 if row['gt'] == 2 else 0
-            nodes_with_types_zero_one.iloc[i, 4] = 1 if row['gt'] == 0 else 0
-            nodes_with_types_zero_one.iloc[i, 1] = 1 if row['gt'] == 1 else 0
-            nodes_with_types_zero_one.iloc[i, 2] = 1 if row['gt'] == 3 else 0
-    
-        #print('<<<<<<<<<<<<<', nodes_with_types_zero_one)
 
-        
         # cell_types_scores
-        cell_types_scores = nodes_with_types_zero_one[['inf', 'lym', 'fib', 'epi']] #One-hot encoding of GT data
-
-        cell_types_scores = cell_types_scores.to_numpy()
+        cell_types_scores = get_cell_type_scores(nodes) #One-hot encoding of GT data
         #print(cell_types_scores.shape)
 
-        # adjacency_matrix_close_to_edges
-        adjacency_matrix_close_to_edges = np.copy(distances_close_to_edges)
-        adjacency_matrix_close_to_edges[adjacency_matrix_close_to_edges != 0] = 1
-        self.adj = adjacency_matrix_close_to_edges
-
         # edge_list_close_to_edge
         edge_list_close_to_edge = edges[["source", "target"]]
         edge_list_close_to_edge = edge_list_close_to_edge.to_numpy()
@@ -1262,35 +1401,8 @@ class KIGraphDatasetSUBGCN(Dataset):
         # edge_list_crossing_edges
         edge_list_crossing_edges = edges_crossing.to_numpy()
 
-        self.am_close_to_edges_including_distances = distances_close_to_edges
-        self.classes = all_labels_cell_types
-        self.class_scores = cell_types_scores
-        self.coords = coords
-
         print('Finished reading data.')
 
-        print('Setting up graph.')
-        vertex_id = {j: i for (i, j) in enumerate(range(len(coords)))}
-
-        idxs = [floor(v * edge_list_crossing_edges.shape[0]) for v in np.cumsum(data_split)]
-
-        edges_t, pos_examples_crossing_edges = edge_list_close_to_edge, edge_list_crossing_edges
-
-        edges_t[:, :2] = np.array([vertex_id[u] for u in edges_t[:, :2].flatten()]).reshape(edges_t[:, :2].shape)
-        edges_t_no_duplicates = np.unique(edges_t[:, :2], axis=0)  # Filter duplicate edges
-
-        self.nodes_count = len(vertex_id)  # Count vertices
-        self.edges_count = edges_t_no_duplicates.shape[0]  # Count edges
-
-        adjacency_matrix_close_to_edges = sp.coo_matrix(
-            (np.ones(self.edges_count), (edges_t_no_duplicates[:, 0], edges_t_no_duplicates[:, 1])),
-            shape=(self.nodes_count, self.nodes_count),
-            dtype=np.float32)
-
-        self.adjacency_matrix_close_to_edges_as_coo_to_lil = adjacency_matrix_close_to_edges.tolil()
-
-        self.node_neighbors = self.adjacency_matrix_close_to_edges_as_coo_to_lil.rows  # Neighbors
-
         #### Code to add node features ### 
 
         cell_density = nodes['Cell_density'].to_numpy() 
@@ -1324,14 +1436,14 @@ class KIGraphDatasetSUBGCN(Dataset):
     
 
             graph_node_features = np.concatenate((cell_types_scores,  np.stack(cell_morph_features, axis=0).astype(np.float64)), axis=1 )  ### Concatenate all features 
-            self.features = torch.from_numpy(graph_node_features).float()  # Cell features 
+            node_features = graph_node_features  # Cell features 
         ###### Code to add node features ends here ##### 
         else:
             ### Use this self feature if only one-hot embedding is required as node feature set
-            self.features = torch.from_numpy(cell_types_scores).float()  # Cell features with just one-hot encoding 
-            #self.features = torch.from_numpy(graph_node_features).float()  # Cell features 
+            node_features = cell_types_scores  # Cell features with just one-hot encoding 
+            #node_features = graph_node_features  # Cell features 
 
-        self.triangle_morph_features = dict()
+        triangle_morph_features = dict()
         if ADD_MOTIF_FEATURES:
             edges['morph_features'] = None
 
@@ -1343,19 +1455,23 @@ class KIGraphDatasetSUBGCN(Dataset):
                 edges.at[_, 'morph_features'] = features
                 u,v = int(row['source']), int(row['target'])
                 
-                self.triangle_morph_features[frozenset((u,v))] =torch.from_numpy( features).float()
+                triangle_morph_features[frozenset((u,v))] =torch.from_numpy( features).float()
                  
 
             #triangle_morph_features = edges['morph_features'].to_numpy()
             #self.triangle_morph_features = np.stack( np.array(triangle_morph_features), axis=0).astype(np.float64)
             #self.triangle_morph_features = torch.from_numpy(self.triangle_morph_features).float()  # Cell features
+            graph['triangle_morph_features'] = triangle_morph_features
 
-        print('self.features.shape:', self.features.shape)
-        # [2] end
+        print('Setting up examples.')
 
-        print('Finished setting up graph.')
+        vertex_id = {j: i for (i, j) in enumerate(range(len(coords)))}
 
-        print('Setting up examples.')
+        idxs = [floor(v * edge_list_crossing_edges.shape[0]) for v in np.cumsum(self.data_split)]
+
+        edges_t, pos_examples_crossing_edges = edge_list_close_to_edge, edge_list_crossing_edges
+
+        edges_t[:, :2] = np.array([vertex_id[u] for u in edges_t[:, :2].flatten()]).reshape(edges_t[:, :2].shape)
 
         if len(pos_examples_crossing_edges) > 0:
             pos_examples_crossing_edges = pos_examples_crossing_edges[:, :2]
@@ -1363,10 +1479,7 @@ class KIGraphDatasetSUBGCN(Dataset):
 
         # Generate negative examples not in cell edges crossing path
         neg_examples_close_to_edges = []
-        cur = 0
-        n_count, _choice = self.nodes_count, np.random.choice
         neg_seen = set(tuple(e[:2]) for e in edge_list_crossing_edges)  # Dont sample positive edges
-        adj_tuple = set(tuple(e[:2]) for e in edge_list_close_to_edge)  # List all edges
 
         if self.mode != 'train':  # Add all edges except positive edges if validation/test
             print("self.mode != 'train'")
@@ -1382,13 +1495,8 @@ class KIGraphDatasetSUBGCN(Dataset):
             #If using Focal Loss function use the next line else comment it and uncomment the line above for BCE loss 
             #num_neg_examples = int(pos_examples_crossing_edges.shape[0]) # Increasing the size of neg_samples for focal loss function as it can handle class imbalance 
             
-            while cur < num_neg_examples:
-                u, v = _choice(n_count, 2, replace=False)
-                if (u, v) in neg_seen or (u, v) not in adj_tuple:
-                    continue
-                cur += 1
-                neg_examples_close_to_edges.append([u, v])
-            neg_examples_close_to_edges = np.array(neg_examples_close_to_edges, dtype=np.int64)
+            sampler = NegativeSampler(edge_list_close_to_edge, edge_list_crossing_edges)
+            neg_examples_close_to_edges = sampler.sample(num_neg_examples)
 
         x = np.vstack((pos_examples_crossing_edges, neg_examples_close_to_edges))
         y = np.concatenate((np.ones(pos_examples_crossing_edges.shape[0]),
@@ -1396,21 +1504,193 @@ class KIGraphDatasetSUBGCN(Dataset):
         perm = np.random.permutation(x.shape[0])
         x, y = x[perm, :], y[perm]  # ERROR HERE -> IndexError: too many indices for array: array is 1-dimensional,
         # but 2 were indexed
-        x, y = torch.from_numpy(x).long(), torch.from_numpy(y).long()
-        self.x, self.y = x, y
 
         print('Finished setting up examples.')
 
-        print('Dataset properties:')
-        print('Mode: {}'.format(self.mode))
-        print('Number of vertices: {}'.format(self.nodes_count))
-        print('Number of edges: {}'.format(self.edges_count))
-        print('Number of triangles: {}'.format(len(self.triangles)))
-        print('Number of positive/negative datapoints: {}/{}'.format(pos_examples_crossing_edges.shape[0],
-                                                                     neg_examples_close_to_edges.shape[0]))
-        print('Number of examples/datapoints: {}'.format(self.x.shape[0]))
+        tri_edges, tri_nodes = triangles_dict_to_arrays(triangles_dict)
+        graph.update(edge_index=edge_index, edge_attr=edge_attr, edge_list=edges_t[:, :2].astype(np.int64),
+                     coords=coords, classes=all_labels_cell_types, class_scores=cell_types_scores,
+                     features=node_features, triangles=np.array([sorted(t) for t in triangles], dtype=np.int64).reshape(-1, 3),
+                     tri_edges=tri_edges, tri_nodes=tri_nodes, x=x.astype(np.int64), y=y)
+        return graph
 
-        print('--------------------------------')
+    def _setup_graph(self, graph):
+        """
+        Parameters
+        ----------
+        graph : dict
+            The arrays returned by _read_graph or loaded from the graph cache: edge_index and edge_attr
+            (edge channels), edge_list (n_edges x 2), coords, classes, class_scores, features (node features),
+            triangles (triangle vertices), tri_edges and tri_nodes (triangles_dict), x and y (examples).
+        """
+        print('Setting up graph.')
+
+        # Only the edge list of the channels is kept, the (p x n x n) features are built from it when needed.
+        self.edge_graph = {k: graph[k] for k in ('edge_index', 'edge_attr', 'morph_features') if k in graph}
+        self.edge_features, self.dist, self.adj, self.am_close_to_edges_including_distances = None, None, None, None
+        self.channel = graph['edge_attr'].shape[0]
+        if ADD_EDGE_FEATURES:
+            self.channel += graph['morph_features'].shape[2]
+
+        col_row_len = len(graph['coords'])
+        self.classes = np.array(graph['classes'])
+        self.class_scores = np.array(graph['class_scores'])
+        self.coords = np.array(graph['coords'])
+
+        edges_t_no_duplicates = np.unique(graph['edge_list'], axis=0)  # Filter duplicate edges
+
+        self.nodes_count = col_row_len  # Count vertices
+        self.edges_count = edges_t_no_duplicates.shape[0]  # Count edges
+
+        adjacency_matrix_close_to_edges = sp.coo_matrix(
+            (np.ones(self.edges_count), (edges_t_no_duplicates[:, 0], edges_t_no_duplicates[:, 1])),
+            shape=(self.nodes_count, self.nodes_count),
+            dtype=np.float32)
+
+        self.adjacency_matrix_close_to_edges_as_coo_to_lil = adjacency_matrix_close_to_edges.tolil()
+
+        self.node_neighbors = self.adjacency_matrix_close_to_edges_as_coo_to_lil.rows  # Neighbors
+        self.neighbor_adjacency = adjacency_matrix_close_to_edges.tocsr()  # Neighbors, for the computation graphs
+
+        self.features = torch.from_numpy(np.array(graph['features'])).float()
+        self.triangle_morph_features = graph.get('triangle_morph_features', dict())
+        self.triangles = set(frozenset(t) for t in graph['triangles'].tolist())
+        self.triangles_dict = arrays_to_triangles_dict(graph['tri_edges'], graph['tri_nodes'])
+        self.triangle_index = utils.get_triangle_index(graph['tri_edges'], graph['tri_nodes'])
+
+        if self.residency is None:
+            self.load_edge_features()
+
+        print('self.features.shape:', self.features.shape)
+        # [2] end
+
+        print('Finished setting up graph.')
+
+        self.x, self.y = torch.from_numpy(np.array(graph['x'])).long(), torch.from_numpy(np.array(graph['y'])).long()
+
+        # Same candidates as the sampler of _read_graph: edge_list is the adjacency and x[y == 1] the positives.
+        if self.mode == 'train':
+            self.negative_sampler = NegativeSampler(graph['edge_list'], self.x[self.y == 1].numpy())
+        else:
+            self.negative_sampler = None
+
+    def resample_negatives(self):
+        """
+        Replaces the negative examples of a training dataset by fresh ones, as many as the positive examples. The
+        positive examples and the graph tensors are kept.
+        """
+        if self.negative_sampler is None:
+            return
+        positives = self.x[self.y == 1]
+        negatives = torch.from_numpy(self.negative_sampler.sample(len(positives)))
+        x = torch.cat((positives, negatives))
+        y = torch.cat((torch.ones(len(positives)), torch.zeros(len(negatives)))).long()
+        perm = torch.from_numpy(np.random.permutation(len(x)))
+        self.x, self.y = x[perm], y[perm]
+
+    def load_edge_features(self):
+        """
+        Builds edge_features, dist and adj from the edge channels if they are not built yet.
+        """
+        if self.edge_features is not None:
+            return
+        graph = self.edge_graph
+        edge_index, edge_attr = np.array(graph['edge_index']), np.array(graph['edge_attr'])
+        col_row_len = self.nodes_count
+
+        if self.sparse:
+            self.edge_features = utils.to_sparse_edge_features(
+                edge_index, utils.normalize_sparse_edge_features_rows(edge_index, edge_attr, col_row_len), col_row_len)
+
+            distances = edge_attr[-1:]  # distance is the last channel
+            self.dist = utils.to_sparse_edge_features(
+                edge_index, utils.normalize_sparse_edge_features_rows(edge_index, distances, col_row_len), col_row_len)
+            distances_close_to_edges = utils.to_sparse_edge_features(edge_index, distances, col_row_len)
+
+        else:
+            edge_densities, delta_entropy_edges, neighborhood_similarity_edges, distances_close_to_edges = \
+                np.split(edge_channels_to_dense(edge_index, edge_attr, col_row_len), edge_attr.shape[0])
+
+            #print('*************')
+            #print('Edge_density Shape : ' + str(edge_densities.shape))
+        
+            distances_close_to_edges = distances_close_to_edges.reshape(-1, col_row_len, col_row_len)
+            delta_entropy_edges = delta_entropy_edges.reshape(-1, col_row_len, col_row_len)
+            neighborhood_similarity_edges = neighborhood_similarity_edges.reshape(-1, col_row_len, col_row_len)
+
+            #print('Edge_entropy Shape : ' + str(delta_entropy_edges.shape))
+            #print('Edge_distance Shape : ' + str(distances_close_to_edges.shape))
+            #print('Neighborhood Similarity Shape : ' + str(neighborhood_similarity_edges.shape))
+
+            if ADD_EDGE_FEATURES:
+                morph_features = graph['morph_features']
+                edge_features = np.concatenate((edge_densities, delta_entropy_edges, neighborhood_similarity_edges, distances_close_to_edges, morph_features.permute(2, 0, 1)), axis=0)
+        
+            else:
+                #edge_features = distances_close_to_edges #e1
+                #edge_features = np.concatenate((edge_densities, distances_close_to_edges), axis=0) #E12
+                #edge_features = np.concatenate((edge_densities, delta_entropy_edges, distances_close_to_edges), axis=0) #E123
+                edge_features = np.concatenate((edge_densities, delta_entropy_edges, neighborhood_similarity_edges, distances_close_to_edges), axis=0)
+        
+            #edge_features = delta_entropy_edges
+            #print(edge_features)
+            # self.edge_features = utils.normalize_edge_feature_doubly_stochastic(edge_features) ### not to be used
+            self.edge_features = utils.normalize_edge_features_rows(edge_features) ### Use it to normalise the edge features
+            #self.edge_features = edge_features  ### Use only if not using the normalization feature above
+
+
+            ## To DO 
+
+            # Change utils.normalize_edge_features_rows to log function to the base e
+
+            #####
+
+            self.dist = utils.normalize_edge_features_rows(distances_close_to_edges.reshape(-1, col_row_len, col_row_len))
+
+        # adjacency_matrix_close_to_edges
+        if self.sparse:
+            adjacent = distances[0] != 0
+            self.adj = utils.to_sparse_edge_features(edge_index[:, adjacent], np.ones((1, int(adjacent.sum()))),
+                                                     col_row_len)
+        else:
+            adjacency_matrix_close_to_edges = np.copy(distances_close_to_edges)
+            adjacency_matrix_close_to_edges[adjacency_matrix_close_to_edges != 0] = 1
+            self.adj = adjacency_matrix_close_to_edges
+
+        self.am_close_to_edges_including_distances = distances_close_to_edges
+
+        # Converted once here, collate_wrapper hands out these very tensors with every batch.
+        if not self.sparse:
+            self.adj = torch.from_numpy(self.adj).float()
+            self.edge_features = torch.from_numpy(self.edge_features).float()
+            self.dist = torch.from_numpy(self.dist).float()
+        self.adj, self.edge_features, self.dist = \
+            self.adj.to(self.device), self.edge_features.to(self.device), self.dist.to(self.device)
+
+    def to(self, device):
+        """
+        Moves the graph tensors to device, the ones built later by load_edge_features are built there.
+
+        Parameters
+        ----------
+        device : string
+            'cpu' or 'cuda:0'.
+        Returns
+        -------
+        self : KIGraphDatasetSUBGCN
+        """
+        self.device = device
+        self.features = self.features.to(device)
+        if self.edge_features is not None:
+            self.adj, self.edge_features, self.dist = \
+                self.adj.to(device), self.edge_features.to(device), self.dist.to(device)
+        return self
+
+    def release_edge_features(self):
+        """
+        Drops edge_features, dist and adj, load_edge_features builds them again.
+        """
+        self.edge_features, self.dist, self.adj, self.am_close_to_edges_including_distances = None, None, None, None
 
     def __len__(self):
         return len(self.x)
@@ -1432,29 +1712,13 @@ class KIGraphDatasetSUBGCN(Dataset):
         node_layers : list of numpy array
             node_layers[i] is an array of the nodes in the ith layer of the
             computation graph.
-        mappings : list of dictionary
-            mappings[i] is a dictionary mapping node v (labelled 0 to |V|-1)
+        mappings : list of numpy array
+            mappings[i] is an integer array mapping node v (labelled 0 to |V|-1)
             in node_layers[i] to its position in node_layers[i]. For example,
             if node_layers[i] = [2,5], then mappings[i][2] = 0 and
             mappings[i][5] = 1.
         """
-        _list, _set = list, set
-        if type(idx) is int:
-            node_layers = [np.array([idx], dtype=np.int64)]
-        elif type(idx) is list:
-            node_layers = [np.array(idx, dtype=np.int64)]
-
-        for _ in range(self.num_layers):
-            prev = node_layers[-1]
-            arr = [node for node in prev]
-            arr.extend([e for node in arr for e in self.node_neighbors[node]])  # add neighbors to graph
-            arr = np.array(_list(_set(arr)), dtype=np.int64)
-            node_layers.append(arr)
-        node_layers.reverse()
-
-        mappings = [{j: i for (i, j) in enumerate(arr)} for arr in node_layers]
-
-        return node_layers, mappings
+        return form_computation_graph(self.neighbor_adjacency, idx, self.num_layers)
 
     def collate_wrapper(self, batch):
         """
@@ -1469,23 +1733,27 @@ class KIGraphDatasetSUBGCN(Dataset):
         features : torch.FloatTensor
             A (n' x input_dim) tensor of input node features.
         edge_features : torch.FloatTensor
-            A 3d tensor of edge features.
+            A 3d tensor of edge features, sparse COO if the dataset is sparse.
         edges : numpy array
             The edges in the batch.
-        labels : torch.LongTensor
+        labels : torch.FloatTensor
             Labels (1 or 0) for the edges in the batch.
-        dist : torch.Tensor
+        dist : torch.FloatTensor
             A distance matrix
+        triangle_index : numpy array
+            Table of the triangles of every edge, see utils.get_triangle_index.
+        triangle_morph_features : dict
+            Image features of the edges, empty unless ADD_MOTIF_FEATURES.
         """
-        adj = torch.from_numpy(self.adj).float()
+        if self.residency is not None:
+            self.residency.acquire(self)
 
-        features = self.features
-        edge_features = torch.from_numpy(self.edge_features).float()
-        edges = np.array([sample[0].numpy() for sample in batch])
-        labels = torch.FloatTensor([sample[1] for sample in batch])
-        dist = torch.from_numpy(self.dist)
+        # The graph tensors are the dataset's own, only the edges and labels are built per batch.
+        edges = torch.stack([sample[0] for sample in batch]).numpy()
+        labels = torch.stack([sample[1] for sample in batch]).float()
 
-        return adj, features, edge_features, edges, labels, dist, self.triangles_dict, self.triangle_morph_features
+        return (self.adj, self.features, self.edge_features, edges, labels, self.dist, self.triangle_index,
+                self.triangle_morph_features)
 
     def get_dims(self):
         print("self.features.shape: {}".format(self.features.shape))
@@ -1,39 +1,183 @@
+import argparse
+import csv
 import os
-import shutil
-import get_cell_density, get_entropy, get_Sorensons_neighborhood_similarity 
-
-source = 'datasets/extended_dataset/'
-folder = 'Train/'
-csv_path = source + folder
-tmp1_path = source + 'tmp1/'
-tmp2_path = source + 'tmp2/'
-outPath = source + 'out/' + folder
-
-
-# create tmp1, tmp2 and out folders
-if not os.path.exists(tmp1_path):
-    os.makedirs(tmp1_path)
-if not os.path.exists(tmp2_path):
-    os.makedirs(tmp2_path)
-if not os.path.exists(outPath):
-    os.makedirs(outPath)
-
-# get file names in the path
-files = os.listdir(csv_path)
-# remove the file extension from the file names and _edges, _nodes
-file_names = [file.split('.')[0] for file in files if file.endswith('.csv')]
-file_names = [file.split('_edges')[0] for file in file_names]
-file_names = [file.split('_nodes')[0] for file in file_names]
-# remove duplicates
-file_names = list(set(file_names))
-
-get_cell_density.get_cell_density(file_names, csv_path, tmp1_path)
-get_entropy.get_entropy(file_names, tmp1_path, tmp2_path)
-get_Sorensons_neighborhood_similarity.get_sorenson_similarity(file_names, tmp2_path, outPath)
-
-# remove tmp1 and tmp2 folders
-if os.path.exists(tmp1_path):
-    shutil.rmtree(tmp1_path)
-if os.path.exists(tmp2_path):
-    shutil.rmtree(tmp2_path)
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from get_cell_density import cell_density
+from get_entropy import node_entropy
+from get_Sorensons_neighborhood_similarity import sorenson_similarity
 
+
+def prepare_graph(file, csv_path, outPath):
+    """
+    Reads the edges and nodes of a graph once and writes them with all the derived features: Cell_density and
+    Node_Entropy for the nodes, Delta_Entropy and Sorenson_Similarity for the edges.
+
+    Parameters
+    ----------
+    file : str
+        Name of the graph, the files are <file>_edges.csv and <file>_nodes.csv.
+    csv_path : str
+        Folder of the input files.
+    outPath : str
+        Folder of the output files.
+    """
+    edge_csv_file = file.strip() + '_edges.csv'
+    node_csv_file = file.strip() + '_nodes.csv'
+
+    with open(csv_path + edge_csv_file) as edges:
+        edge_rows = list(csv.reader(edges, delimiter=','))
+    with open(csv_path + node_csv_file) as nodes:
+        node_rows = list(csv.reader(nodes))
+
+    is_edge = [row[0] != 'source' and row[1] != 'target' for row in edge_rows]
+    edge_data = [row for (row, e) in zip(edge_rows, is_edge) if e]
+    source, target = [row[0] for row in edge_data], [row[1] for row in edge_data]
+    is_node = [row[0] != 'id' for row in node_rows]
+    node_data = [row for (row, n) in zip(node_rows, is_node) if n]
+    node_ids = [row[0] for row in node_data]
+
+    density = cell_density(node_ids, source, target,
+                           np.fromiter((float(row[3]) for row in edge_data), dtype=np.float64, count=len(edge_data)))
+    entropy, has_edges = node_entropy(node_ids, [row[7] for row in node_data], source, target)
+    node_index = pd.Index(node_ids)
+    delta_entropy = np.abs(entropy[node_index.get_indexer(source)] - entropy[node_index.get_indexer(target)])
+    similarity = sorenson_similarity(source, target)
+
+    # Both files are written under a temporary name and renamed once complete, nodes first and edges last, so
+    # that an interrupted run never leaves outputs that is_prepared takes as up to date.
+    node_values = iter(zip(density.tolist(),
+                           [v if h else 'Node_Entropy' for (v, h) in zip(entropy.tolist(), has_edges.tolist())]))
+    with open(outPath + node_csv_file + '.tmp', 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')  # same line endings as the former pandas copy
+        for eachRow, n in zip(node_rows, is_node):
+            eachRow.extend(next(node_values) if n else ('Cell_density', 'Node_Entropy'))
+            writer.writerow(eachRow)
+
+    edge_values = iter(zip(delta_entropy.tolist(), similarity.tolist()))
+    with open(outPath + edge_csv_file + '.tmp', 'w', newline='') as f:
+        writer = csv.writer(f)
+        for eachEdge, e in zip(edge_rows, is_edge):
+            eachEdge.extend(next(edge_values) if e else ('Delta_Entropy', 'Sorenson_Similarity'))
+            writer.writerow(eachEdge)
+
+    os.replace(outPath + node_csv_file + '.tmp', outPath + node_csv_file)
+    os.replace(outPath + edge_csv_file + '.tmp', outPath + edge_csv_file)
+
+
+def get_file_names(csv_path):
+    """
+    Parameters
+    ----------
+    csv_path : str
+        Folder with the <name>_edges.csv and <name>_nodes.csv files.
+    Returns
+    -------
+    file_names : list
+        Names of the graphs in the folder.
+    """
+    # get file names in the path
+    files = os.listdir(csv_path)
+    # remove the file extension from the file names and _edges, _nodes
+    file_names = [file.split('.')[0] for file in files if file.endswith('.csv')]
+    file_names = [file.split('_edges')[0] for file in file_names]
+    file_names = [file.split('_nodes')[0] for file in file_names]
+    # remove duplicates
+    return list(set(file_names))
+
+
+def is_prepared(file, csv_path, outPath):
+    """
+    Parameters
+    ----------
+    file : str
+        Name of the graph.
+    csv_path : str
+        Folder of the input files.
+    outPath : str
+        Folder of the output files.
+    Returns
+    -------
+    prepared : bool
+        True if both output files exist and are newer than both input files.
+    """
+    outputs = [outPath + file.strip() + suffix for suffix in ('_edges.csv', '_nodes.csv')]
+    if not all(os.path.exists(path) for path in outputs):
+        return False
+    inputs = [csv_path + file.strip() + suffix for suffix in ('_edges.csv', '_nodes.csv')]
+    return min(os.path.getmtime(path) for path in outputs) > max(os.path.getmtime(path) for path in inputs)
+
+
+def timed_prepare_graph(file, csv_path, outPath):
+    """
+    Runs prepare_graph and returns its duration in seconds.
+    """
+    start = time.time()
+    prepare_graph(file, csv_path, outPath)
+    return time.time() - start
+
+
+def prepare_dataset(csv_path, outPath, workers=1, force=False):
+    """
+    Prepares every graph of a folder, skipping the ones whose outputs are newer than their inputs. A graph that
+    fails is reported and does not stop the others.
+
+    Parameters
+    ----------
+    csv_path : str
+        Folder of the input files.
+    outPath : str
+        Folder of the output files.
+    workers : int
+        Number of graphs processed in parallel. Default: 1.
+    force : bool
+        Prepare all the graphs, even the ones that are up to date. Default: False.
+    Returns
+    -------
+    failed : dict
+        Name of the graphs that failed and their exception.
+    """
+    file_names = sorted(get_file_names(csv_path))
+    todo = [file for file in file_names if force or not is_prepared(file, csv_path, outPath)]
+    print('Preparing {} of {} graphs ({} up to date)'.format(len(todo), len(file_names), len(file_names) - len(todo)))
+
+    failed = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(timed_prepare_graph, file, csv_path, outPath): file for file in todo}
+        for i, future in enumerate(as_completed(futures), 1):
+            file = futures[future]
+            try:
+                print('[{}/{}] {}: {:.2f}s'.format(i, len(todo), file, future.result()))
+            except Exception as e:
+                failed[file] = e
+                print('[{}/{}] {}: failed with {!r}'.format(i, len(todo), file, e))
+                # drop partial outputs, so that the graph is not considered up to date on the next run
+                for suffix in ('_edges.csv', '_nodes.csv', '_edges.csv.tmp', '_nodes.csv.tmp'):
+                    if os.path.exists(outPath + file.strip() + suffix):
+                        os.remove(outPath + file.strip() + suffix)
+
+    if failed:
+        print('Failed graphs: {}'.format(', '.join(sorted(failed))))
+    return failed
+
+
+if __name__ == '__main__':
+    source = 'datasets/extended_dataset/'
+    folder = 'Train/'
+
+    parser = argparse.ArgumentParser(description='Adds the derived node and edge features to the graphs')
+    parser.add_argument('--csv_path', default=source + folder, help='Folder of the input graphs')
+    parser.add_argument('--out_path', default=source + 'out/' + folder, help='Folder of the prepared graphs')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of graphs prepared in parallel')
+    parser.add_argument('--force', action='store_true', help='Prepare also the graphs that are up to date')
+    args = parser.parse_args()
+
+    # create out folder
+    if not os.path.exists(args.out_path):
+        os.makedirs(args.out_path)
+
+    failed = prepare_dataset(args.csv_path, args.out_path, workers=args.workers, force=args.force)
+    sys.exit(1 if failed else 0)
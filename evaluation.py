@@ -0,0 +1,220 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+from sklearn.metrics import roc_auc_score, roc_curve, classification_report
+import torch
+
+import utils
+
+
+def score_batch(combined_model, batch, device, embeddings=None, key=None):
+    """
+    Parameters
+    ----------
+    combined_model : models.CombinedModel
+        The model scoring the edges.
+    batch : tuple
+        A batch returned by the collate_wrapper of the dataset.
+    device : string
+        'cpu' or 'cuda:0'.
+    embeddings : dict or None
+        If a dict, the node embeddings of the graph are computed once under
+        torch.no_grad, stored in embeddings[key] and reused by every later
+        batch of the same graph. If None, the GNN runs on every batch. Default: None.
+    key : hashable
+        Identifies the graph the batch comes from.
+    Returns
+    -------
+    scores : torch.Tensor
+        Scores of the edges in the batch.
+    """
+    adj, features, edge_features, edges, labels, dist, triangles, dnn_features = batch
+    if embeddings is None:
+        features, edge_features = features.to(device), edge_features.to(device)
+        return combined_model(features, edge_features, edges, triangles, dnn_features)
+    with torch.no_grad():
+        if key not in embeddings:
+            features, edge_features = features.to(device), edge_features.to(device)
+            embeddings[key] = combined_model.embed(features, edge_features)
+        return combined_model.score(embeddings[key], edges, triangles, dnn_features)
+
+
+def stack_results(results):
+    """
+    Parameters
+    ----------
+    results : list of dict
+        Scores of the graphs, see Evaluator.score.
+    Returns
+    -------
+    y_true : numpy array
+        Labels of the edges of all the graphs.
+    y_scores : numpy array
+        Scores of the edges of all the graphs.
+    """
+    return (np.concatenate([result['labels'] for result in results]),
+            np.concatenate([result['scores'] for result in results]))
+
+
+def roc_threshold(y_true, y_scores):
+    """
+    Parameters
+    ----------
+    y_true : numpy array
+        Labels (1 or 0) of the edges.
+    y_scores : numpy array
+        Scores of the edges.
+    Returns
+    -------
+    threshold : float
+        Threshold of the ROC curve maximising TPR - FPR (Youden's J).
+    """
+    fpr, tpr, thresholds = roc_curve(y_true, y_scores)
+    return float(thresholds[np.argmax(tpr - fpr)])
+
+
+class Evaluator:
+    """
+    Scores every edge of a list of graphs once per phase and derives the metrics of any number of thresholds
+    from the stored scores. Shared by the evaluations of main_ablation.py, it keeps the time spent in each phase.
+    """
+    def __init__(self, combined_model, criterion, device, stats_per_batch, forward='batch'):
+        """
+        Parameters
+        ----------
+        combined_model : models.CombinedModel
+            The model scoring the edges.
+        criterion : torch.nn.modules._Loss
+            Loss function, see utils.get_criterion.
+        device : string
+            'cpu' or 'cuda:0'.
+        stats_per_batch : int
+            Print the loss after how many batches.
+        forward : str
+            'graph' to compute the node embeddings once per graph and phase, 'batch' to run the GNN on every
+            batch. Default: 'batch'.
+        """
+        self.combined_model = combined_model
+        self.criterion = criterion
+        self.device = device
+        self.stats_per_batch = stats_per_batch
+        self.forward = forward
+        self.timings = OrderedDict()
+
+    def score(self, loaders, phase):
+        """
+        Parameters
+        ----------
+        loaders : list of DataLoader
+            One loader per graph.
+        phase : str
+            Name of the phase in the timing report.
+        Returns
+        -------
+        results : list of dict
+            results[i] holds the scores, labels and edges (u, v) of the examples of loaders[i], in loader order,
+            and losses the loss of each of its batches.
+        """
+        start = time.time()
+        embeddings = {} if self.forward == 'graph' else None
+        results = []
+        for i in range(len(loaders)):
+            num_examples, num_batches = len(loaders[i].dataset), len(loaders[i])
+            # Filled batch by batch on the device and copied back once per graph.
+            scores = torch.empty(num_examples, device=self.device)
+            labels = torch.empty(num_examples, device=self.device)
+            losses = torch.empty(num_batches, dtype=torch.float64, device=self.device)
+            edges = np.empty((num_examples, 2), dtype=np.int64)
+            offset = 0
+            # The batches are collated outside inference mode, the graph tensors built by a lazy dataset are
+            # still used for training afterwards.
+            for (idx, batch) in enumerate(loaders[i]):
+                with torch.inference_mode():
+                    batch_scores = score_batch(self.combined_model, batch, self.device, embeddings, i)
+                    batch_labels = batch[4].to(self.device)
+                    losses[idx] = self.criterion(batch_scores, batch_labels.float())
+                    end = offset + len(batch_labels)
+                    scores[offset:end] = batch_scores.reshape(-1)
+                    labels[offset:end] = batch_labels.reshape(-1)
+                edges[offset:end] = np.asarray(batch[3])[:, :2]
+                offset = end
+                if (idx + 1) % self.stats_per_batch == 0:
+                    print('    Batch {} / {}, Graph {} / {}: loss {:.4f}'.format(
+                        idx+1, num_batches, i+1, len(loaders), losses[idx+1-self.stats_per_batch:idx+1].mean().item()))
+            results.append({'scores': scores[:offset].cpu().numpy(), 'labels': labels[:offset].cpu().numpy(),
+                            'edges': edges[:offset], 'losses': losses.cpu().numpy()})
+        self._add_timing(phase, time.time() - start)
+        return results
+
+    def roc_auc(self, results):
+        """
+        Parameters
+        ----------
+        results : list of dict
+            Scores of the graphs, see score.
+        Returns
+        -------
+        area : float
+            ROC-AUC score of the edges of all the graphs.
+        """
+        area = roc_auc_score(*stack_results(results))
+        print('ROC-AUC score: {:.4f}'.format(area))
+        return area
+
+    def report(self, results, datasets, thresholds, mode, config):
+        """
+        Prints the loss, accuracy, ROC-AUC score and classification report of every threshold and exports the
+        predicted edges of every graph.
+
+        Parameters
+        ----------
+        results : list of dict
+            Scores of the graphs, see score.
+        datasets : list of Dataset
+            The graphs, in the order of results.
+        thresholds : list of float
+            Scores at or above a threshold are predicted as crossing edges.
+        mode : str
+            Name of the evaluation in the exported files: 'train_val', 'validation' or 'testing'.
+        config : dict
+            Uses results_dir and model_id for the exported files, and roc_threshold to evaluate the ROC-derived
+            threshold too.
+        """
+        start = time.time()
+        y_true, y_scores = stack_results(results)
+        total_loss = np.concatenate([result['losses'] for result in results]).mean()
+        area = roc_auc_score(y_true, y_scores)
+
+        thresholds = list(thresholds)
+        if config['roc_threshold']:
+            thresholds.append(roc_threshold(y_true, y_scores))
+            print('ROC threshold (max TPR - FPR): {:.4f}'.format(thresholds[-1]))
+
+        for t in thresholds:
+            for i in range(len(results)):
+                predictions = results[i]['scores'] >= t
+                edges = results[i]['edges']
+                # export as json for visualization in IntelliGraph JORGE
+                utils.export_prediction_as_json(datasets[i].path[0].replace("_forGraphSAGE_edges.csv", ""), mode,
+                                                edges[predictions].tolist(), edges[~predictions].tolist(),
+                                                config['results_dir'], config['model_id'])
+
+            y_pred = (y_scores >= t).astype(np.int64)
+            report = classification_report(y_true, y_pred, digits=4)
+            print('Loss {:.4f}, accuracy {:.4f}'.format(total_loss, np.mean(y_pred == y_true)))
+            print('ROC-AUC score: {:.4f}'.format(area))
+            print("Threshold: ", t)
+            print('Classification report\n', report)
+        self._add_timing('{} report'.format(mode), time.time() - start)
+
+    def _add_timing(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    def print_timings(self):
+        """
+        Prints the time spent in every phase.
+        """
+        print('Evaluation time per phase:')
+        for (phase, seconds) in self.timings.items():
+            print('    {}: {:.2f}s'.format(phase, seconds))
@@ -1,5 +1,6 @@
 from ast import Param
 from inspect import Parameter
+import itertools
 import math
 
 import numpy as np
@@ -11,6 +12,47 @@ from torch.nn.parameter import Parameter
 np.random.seed(0)
 
 
+def sample_neighbours(rows, mapping, num_samples):
+    """
+    Parameters
+    ----------
+    rows : numpy array
+        rows[i] is an array of neighbors of node i.
+    mapping : numpy array
+        mapping[v] is the position of node v in the layer of the computation graph before the nodes, see
+        datasets.link_prediction.form_computation_graph.
+    num_samples : int
+        Number of neighbors to sample per node, -1 to keep all of them. Nodes with at least num_samples neighbors
+        are sampled without replacement, the others draw as many neighbors as they have with replacement.
+    Returns
+    -------
+    neighbours : numpy array
+        An (n x S) array of the sampled neighbors, S is the largest number of samples of a node.
+    positions : numpy array
+        An (n x S) array, positions[i, s] = mapping[neighbours[i, s]].
+    mask : numpy array
+        An (n x S) boolean array, False on the padding after the samples of each node.
+    """
+    lengths = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+    flat = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=lengths.sum())
+    offsets = np.cumsum(lengths) - lengths
+
+    sizes = lengths if num_samples == -1 else np.minimum(lengths, num_samples)
+    columns = np.arange(sizes.max(initial=0))
+    mask = columns < sizes[:, None]
+    if num_samples == -1:
+        picks = np.broadcast_to(columns, mask.shape)
+    else:
+        # The first columns of a random permutation of each row are a sample without replacement.
+        keys = np.random.random_sample((len(rows), lengths.max(initial=0)))
+        keys[np.arange(keys.shape[1]) >= lengths[:, None]] = np.inf
+        picks = np.argsort(keys, axis=1)[:, :len(columns)]
+        short = lengths < num_samples
+        picks[short] = (np.random.random_sample((short.sum(), len(columns))) * lengths[short, None]).astype(np.int64)
+    neighbours = flat[np.where(mask, offsets[:, None] + picks, 0)] if len(flat) else np.zeros(mask.shape, np.int64)
+    return neighbours, mapping[neighbours], mask
+
+
 class Aggregator(nn.Module):
 
     def __init__(self, input_dim=None, output_dim=None, device='cpu'):
@@ -40,8 +82,8 @@ class Aggregator(nn.Module):
             An (n' x input_dim) tensor of input node features.
         nodes : numpy array
             nodes is a numpy array of nodes in the current layer of the computation graph.
-        mapping : dict
-            mapping is a dictionary mapping node v (labelled 0 to |V|-1) to
+        mapping : numpy array
+            mapping is an integer array mapping node v (labelled 0 to |V|-1) to
             its position in the layer of nodes in the computationn graph
             before nodes. For example, if the layer before nodes is [2,5],
             then mapping[2] = 0 and mapping[5] = 1.
@@ -55,34 +97,31 @@ class Aggregator(nn.Module):
             An (len(nodes) x output_dim) tensor of output node features.
             Currently only works when output_dim = input_dim.
         """
-        _choice, _len, _min = np.random.choice, len, min
-        mapped_rows = [np.array([mapping[v] for v in row], dtype=np.int64) for row in rows]
-        #init_mapped_rows = [np.array([init_mapping[v] for v in row], dtype=np.int64) for row in rows]
-        if num_samples == -1:
-            sampled_rows = mapped_rows
-        else:
-            sampled_rows = []
-            init_sampled_rows = []
-            inds = [_choice(len(row), _min(_len(row), num_samples), _len(row) < num_samples) for row in mapped_rows] # len(rows) x num_samples
-            for i in range(len(inds)):
-                sampled_rows.append(mapped_rows[i][inds[i]])
-                init_sampled_rows.append(np.array(rows[i])[inds[i]])
-        n = _len(nodes)
+        neighbours, positions, mask = sample_neighbours(rows, mapping, num_samples)
+        n = len(nodes)
         if self.__class__.__name__ == 'LSTMAggregator':
             out = torch.zeros(n, 2*self.output_dim).to(self.device)
         else:
             out = torch.zeros(n, self.output_dim).to(self.device)
 
-        for i in range(n):
-            if _len(sampled_rows[i]) != 0:
-                if self.__class__.__name__ == 'MeanAggregator':
-                    out[i, :] = self._aggregate(torch.cat((features[mapping[nodes[i]], :].view(1,-1), features[sampled_rows[i], :])), dist[nodes[i], init_sampled_rows[i]])#
-                else:
-                    out[i, :] = self._aggregate(features[sampled_rows[i], :])
-                    #out[i, :] = self._aggregate(torch.cat((features[sampled_rows[i], :], dist[nodes[i], init_sampled_rows[i]].view(-1,1).float()),1))
+        # Nodes without neighbors keep a zero output.
+        nonempty = mask.any(axis=1)
+        if not nonempty.any():
+            return out
+        device = features.device
+        positions = torch.from_numpy(positions[nonempty]).to(device)
+        mask = torch.from_numpy(mask[nonempty]).to(device)
+        if self.__class__.__name__ == 'MeanAggregator':
+            centre = torch.from_numpy(mapping[nodes[nonempty]]).to(device)
+            neighbour_dist = dist[torch.from_numpy(nodes[nonempty]).unsqueeze(1), torch.from_numpy(neighbours[nonempty])]
+            agg = self._aggregate(torch.cat((features[centre].unsqueeze(1), features[positions]), dim=1), mask,
+                                  neighbour_dist.to(device))
+        else:
+            agg = self._aggregate(features[positions], mask)
+        out[torch.from_numpy(nonempty).to(out.device)] = agg.to(out.dtype)
         return out
 
-    def _aggregate(self, features):
+    def _aggregate(self, features, mask):
         """
         Parameters
         ----------
@@ -93,23 +132,27 @@ class Aggregator(nn.Module):
 
 class MeanAggregator(Aggregator):
 
-    def _aggregate(self, features, dist):
+    def _aggregate(self, features, mask, dist):
         """
         Parameters
         ----------
         features : torch.Tensor
-            Input features.
+            An (m x 1+S x input_dim) tensor, the features of each node followed by the ones of its sampled neighbors.
+        mask : torch.Tensor
+            An (m x S) boolean tensor of the sampled neighbors.
+        dist : torch.Tensor
+            An (m x S) tensor of the distance of each node to its sampled neighbors.
         Returns
         -------
         Aggregated feature.
         """
-        min_dist = torch.min(dist)
-        dist = torch.div(min_dist, dist)
-        dist = torch.cat((dist, torch.ones(1, dtype=torch.float64)))
-        sum_dist = torch.sum(dist)
+        dist = dist.masked_fill(~mask, float('inf'))
+        min_dist = torch.min(dist, dim=1, keepdim=True)[0]
+        dist = torch.div(min_dist, dist)    # Padding gets a zero weight
+        dist = torch.cat((torch.ones(len(dist), 1, dtype=dist.dtype, device=dist.device), dist), dim=1)
+        sum_dist = torch.sum(dist, dim=1, keepdim=True)
 
-        return torch.div(torch.sum(torch.mul(features, dist.view(-1, 1)), dim=0), sum_dist)    # Return weighted average
-        #return torch.mean(features, dim=0) # Return mean of features
+        return torch.div(torch.sum(torch.mul(features, dist.unsqueeze(2)), dim=1), sum_dist)    # Return weighted average
 
 class PoolAggregator(Aggregator):
 
@@ -128,21 +171,23 @@ class PoolAggregator(Aggregator):
         self.fc1 = nn.Linear(input_dim, output_dim)
         self.relu = nn.ReLU()
 
-    def _aggregate(self, features):
+    def _aggregate(self, features, mask):
         """
         Parameters
         ----------
         features : torch.Tensor
-            Input features.
+            An (m x S x input_dim) tensor of the features of the sampled neighbors.
+        mask : torch.Tensor
+            An (m x S) boolean tensor of the sampled neighbors.
         Returns
         -------
         Aggregated feature.
         """
         # print('features.shape', features.shape)
         out = self.relu(self.fc1(features))
-        return self._pool_fn(out)
+        return self._pool_fn(out, mask.unsqueeze(2))
 
-    def _pool_fn(self, features):
+    def _pool_fn(self, features, mask):
         """
         Parameters
         ----------
@@ -153,31 +198,35 @@ class PoolAggregator(Aggregator):
 
 class MaxPoolAggregator(PoolAggregator):
 
-    def _pool_fn(self, features):
+    def _pool_fn(self, features, mask):
         """
         Parameters
         ----------
         features : torch.Tensor
-            Input features.
+            An (m x S x output_dim) tensor of input features.
+        mask : torch.Tensor
+            An (m x S x 1) boolean tensor of the sampled neighbors.
         Returns
         -------
         Aggregated feature.
         """
-        return torch.max(features, dim=0)[0]
+        return torch.max(features.masked_fill(~mask, float('-inf')), dim=1)[0]
 
 class MeanPoolAggregator(PoolAggregator):
 
-    def _pool_fn(self, features):
+    def _pool_fn(self, features, mask):
         """
         Parameters
         ----------
         features : torch.Tensor
-            Input features.
+            An (m x S x output_dim) tensor of input features.
+        mask : torch.Tensor
+            An (m x S x 1) boolean tensor of the sampled neighbors.
         Returns
         -------
         Aggregated feature.
         """
-        return torch.mean(features, dim=0)[0]
+        return torch.sum(features.masked_fill(~mask, 0), dim=1) / torch.sum(mask, dim=1)
 
 class LSTMAggregator(Aggregator):
 
@@ -195,23 +244,28 @@ class LSTMAggregator(Aggregator):
 
         self.lstm = nn.LSTM(input_dim, output_dim, bidirectional=True, batch_first=True)
 
-    def _aggregate(self, features):
+    def _aggregate(self, features, mask):
         """
         Parameters
         ----------
         features : torch.Tensor
-            Input features.
+            An (m x S x input_dim) tensor of the features of the sampled neighbors.
+        mask : torch.Tensor
+            An (m x S) boolean tensor of the sampled neighbors.
         Returns
         -------
         Aggregated feature.
         """
-        perm = np.random.permutation(np.arange(features.shape[0]))
-        features = features[perm, :]
-        features = features.unsqueeze(0)
+        # Shuffle the neighbors of each node, the padding stays at the end.
+        keys = torch.from_numpy(np.random.random_sample(tuple(mask.shape))).to(mask.device)
+        perm = torch.argsort(keys.masked_fill(~mask, float('inf')), dim=1)
+        features = torch.gather(features, 1, perm.unsqueeze(2).expand_as(features))
 
-        out, _ = self.lstm(features)
-        out = out.squeeze(0)
-        out = torch.sum(out, dim=0)
+        lengths = torch.sum(mask, dim=1).cpu()
+        packed = nn.utils.rnn.pack_padded_sequence(features, lengths, batch_first=True, enforce_sorted=False)
+        out, _ = self.lstm(packed)
+        out, _ = nn.utils.rnn.pad_packed_sequence(out, batch_first=True)    # Zeros after each sequence
+        out = torch.sum(out, dim=1)
 
         return out
 
@@ -303,21 +357,23 @@ class EGNNCLayer(nn.Module):
         features : torch.Tensor
             An (n x input_dim) tensor of input node features.
         edge_features : torch.Tensor
-            An (p x n x n) tensor of edge features.
+            An (p x n x n) tensor of edge features, dense or sparse COO.
         Returns
         -------
         out : torch.Tensor
-            An (len(nodes) x output_dim) tensor of output node features.
-            Currently only works when output_dim = input_dim.
+            An (n x p*output_dim) tensor of output node features, the p channels side by side.
         """
         support0 = torch.matmul(features, self.weight0)
         support1 = torch.matmul(features, self.weight1)
 
-        x = torch.matmul(edge_features, support1) + support0
-        
+        if edge_features.is_sparse:
+            x = self._sparse_matmul(edge_features, support1) + support0
+        else:
+            x = torch.matmul(edge_features, support1) + support0
+
+        # (p x n x output_dim) -> (n x p*output_dim) in a single copy, the channels side by side.
+        output = x.permute(1, 0, 2).reshape(x.shape[1], -1)
 
-        output = torch.cat([xi for xi in x], dim=1)
-        
         # x = torch.matmul(features, self.weight)
         # x = torch.matmul(edge_features, x)
         # output = torch.cat([xi for xi in x], dim=1)
@@ -328,6 +384,26 @@ class EGNNCLayer(nn.Module):
             return output
 
 
+    def _sparse_matmul(self, edge_features, support):
+        """
+        Parameters
+        ----------
+        edge_features : torch.Tensor
+            A sparse COO (p x n x n) tensor of edge features.
+        support : torch.Tensor
+            An (n x output_dim) tensor.
+        Returns
+        -------
+        out : torch.Tensor
+            A (p x n x output_dim) tensor, equal to torch.matmul(edge_features.to_dense(), support).
+        """
+        channel, n = edge_features.shape[0], edge_features.shape[1]
+        edge_features = edge_features.coalesce()
+        p, row, col = edge_features.indices()
+        # Stack the channels into a single (p*n x n) matrix so one sparse mm covers all of them
+        stacked = torch.sparse_coo_tensor(torch.stack((p * n + row, col)), edge_features.values(), (channel * n, n))
+        return torch.sparse.mm(stacked, support).view(channel, n, -1)
+
     def __repr__(self):
         return self.__class__.__name__ + ' (' \
                 + str(self.input_dim) + ' -> ' \
@@ -394,6 +470,54 @@ class DGNNConvolutionLayer(nn.Module):
                + str(self.output_dim) + ')'
 
 
+def relative_cos_to_pairs(adj_relative_cos):
+    """
+    Parameters
+    ----------
+    adj_relative_cos : Dict[int, Dict[tuple, torch.Tensor]]
+        adj_relative_cos[i][(j, k)] is the cosine value between a pair of relative vectors node(i -> j) and node(i -> k).
+    Returns
+    -------
+    pairs : dict
+        The same angles as flat tensors. nodes holds the N centre nodes, in the order of adj_relative_cos. For each
+        of the P neighbour pairs, center is the position of its centre node in nodes, first and second are the
+        neighbours j and k and cos is the cosine value.
+    """
+    nodes = list(adj_relative_cos.keys())
+    center = [c for (c, node) in enumerate(nodes) for _ in adj_relative_cos[node]]
+    neighbours = [pair for node in nodes for pair in adj_relative_cos[node]]
+    cos = [value for node in nodes for value in adj_relative_cos[node].values()]
+    neighbours = torch.tensor(neighbours, dtype=torch.long).reshape(-1, 2)
+    return {'nodes': torch.tensor(nodes, dtype=torch.long), 'center': torch.tensor(center, dtype=torch.long),
+            'first': neighbours[:, 0], 'second': neighbours[:, 1],
+            'cos': torch.stack(cos).float() if cos else torch.zeros(0)}
+
+
+def aggregate_pairs(features, pairs, pair_weights=None):
+    """
+    Parameters
+    ----------
+    features : torch.Tensor
+        An (n' x input_dim) tensor of input node features.
+    pairs : dict
+        Neighbour pair angles, see relative_cos_to_pairs.
+    pair_weights : torch.Tensor
+        Optional (P,) extra weight of every pair. Default: None.
+    Returns
+    -------
+    agg : torch.Tensor
+        An (N x input_dim) tensor, agg[c] is the sum of (features[j] + features[k]) * cos over the pairs of the
+        cth centre node, accumulated in float64.
+    """
+    device = features.device
+    first, second = pairs['first'].to(device), pairs['second'].to(device)
+    contrib = (features[first] + features[second]) * pairs['cos'].to(device).unsqueeze(1)
+    if pair_weights is not None:
+        contrib = contrib * pair_weights.unsqueeze(1)
+    agg = torch.zeros(len(pairs['nodes']), features.shape[1], dtype=torch.float64, device=device)
+    return agg.index_add(0, pairs['center'].to(device), contrib.double()).float()
+
+
 class AAAgregationLayer(nn.Module):
     def __init__(self, input_dim=None, output_dim=None, bias=True, device='cpu'):
         """
@@ -430,24 +554,16 @@ class AAAgregationLayer(nn.Module):
             A list of nodes
         features : torch.Tensor
             An (n' x input_dim) tensor of input node features.
-        adj_relative_cos : Dict[int, Dict[tuple, torch.Tensor]]
-            adj_relative_cos[i][(j, k)] is the cosine value between a pair of relative vectors node(i -> j) and node(i -> k).
+        adj_relative_cos : Dict[int, Dict[tuple, torch.Tensor]] or dict
+            adj_relative_cos[i][(j, k)] is the cosine value between a pair of relative vectors node(i -> j) and node(i -> k),
+            or the same angles as flat tensors, see relative_cos_to_pairs.
         Returns
         -------
         out : torch.Tensor
             An (len(nodes) x output_dim) tensor of output node features.
         """
-        nodes = list(adj_relative_cos.keys())
-        for ind, node in enumerate(nodes):
-            agg = torch.zeros(self.input_dim, dtype=float)
-            for i, j in adj_relative_cos[node]:
-                agg += (features[i] + features[j]) * adj_relative_cos[node][i, j]
-            agg = agg.float()
-            if ind == 0:
-                output = torch.reshape(agg, (1, -1))
-            else:
-                output = torch.cat((output, torch.reshape(agg, (1, -1))), 0)
-        output = torch.mm(output, self.weight)
+        pairs = adj_relative_cos if 'cos' in adj_relative_cos else relative_cos_to_pairs(adj_relative_cos)
+        output = torch.mm(aggregate_pairs(features, pairs), self.weight)
         if self.bias is not None:
             return output + self.bias
         else:
@@ -499,24 +615,18 @@ class DAAAgregationLayer(nn.Module):
         dist : torch.Tensor
             An (n x n) tensor of the graph.
             dist[i][j] contain the distance between node i and j if they are adjacent, otherwise 0.
-        adj_relative_cos : Dict[int, Dict[tuple, torch.Tensor]]
-            adj_relative_cos[i][(j, k)] is the cosine value between a pair of relative vectors node(i -> j) and node(i -> k).
+        adj_relative_cos : Dict[int, Dict[tuple, torch.Tensor]] or dict
+            adj_relative_cos[i][(j, k)] is the cosine value between a pair of relative vectors node(i -> j) and node(i -> k),
+            or the same angles as flat tensors, see relative_cos_to_pairs.
         Returns
         -------
         out : torch.Tensor
             An (len(nodes) x output_dim) tensor of output node features.
         """
-        nodes = list(adj_relative_cos.keys())
-        for ind, node in enumerate(nodes):
-            agg = torch.zeros(self.input_dim, dtype=float)
-            for i, j in adj_relative_cos[node]:
-                agg += (features[i] + features[j]) * adj_relative_cos[node][i, j] * dist[node, i] * dist[node, j]
-            agg = agg.float()
-            if ind == 0:
-                output = torch.reshape(agg, (1, -1))
-            else:
-                output = torch.cat((output, torch.reshape(agg, (1, -1))), 0)
-        output = torch.mm(output, self.weight)
+        pairs = adj_relative_cos if 'cos' in adj_relative_cos else relative_cos_to_pairs(adj_relative_cos)
+        node = pairs['nodes'].to(dist.device)[pairs['center'].to(dist.device)]
+        pair_dist = dist[node, pairs['first'].to(dist.device)] * dist[node, pairs['second'].to(dist.device)]
+        output = torch.mm(aggregate_pairs(features, pairs, pair_dist.to(features.device)), self.weight)
         if self.bias is not None:
             return output + self.bias
         else:
@@ -573,12 +683,15 @@ class BiTensorNetworkModule(torch.nn.Module):
     """
      Bi-directional Tensor Network module to calculate similarity vector.
     """
-    def __init__(self):
+    def __init__(self, input_dim=64, tensor_neurons=64):
         """
-        :param args: Arguments object.
+        :param input_dim: Dimension of the node embeddings.
+        :param tensor_neurons: Dimension of the similarity vector.
         """
         super(BiTensorNetworkModule, self).__init__()
         #self.args = args
+        self.input_dim = input_dim
+        self.tensor_neurons = tensor_neurons
         self.setup_weights()
         self.init_parameters()
 
@@ -586,16 +699,14 @@ class BiTensorNetworkModule(torch.nn.Module):
         """
         Defining weights.
         """
-        self.filters_3 = 64
-        self.tensor_neurons =64
-        self.weight_matrix = torch.nn.Parameter(torch.Tensor(64,
-                                                             64,
-                                                             64))
+        self.weight_matrix = torch.nn.Parameter(torch.Tensor(self.input_dim,
+                                                             self.input_dim,
+                                                             self.tensor_neurons))
 
-        self.weight_matrix_block = torch.nn.Parameter(torch.Tensor(64,2*64))
+        self.weight_matrix_block = torch.nn.Parameter(torch.Tensor(self.tensor_neurons, 2*self.input_dim))
         #self.weight_matrix_block_1 = torch.nn.Parameter(torch.Tensor(64,2*64))
         #self.weight_matrix_block_2 = torch.nn.Parameter(torch.Tensor(64,2*64))        
-        self.bias = torch.nn.Parameter(torch.Tensor(64, 1))
+        self.bias = torch.nn.Parameter(torch.Tensor(self.tensor_neurons, 1))
 
     def init_parameters(self):
         """
@@ -609,27 +720,20 @@ class BiTensorNetworkModule(torch.nn.Module):
 
     def forward(self, embedding_1, embedding_2):
         """
-        Making a forward propagation pass to create a similarity vector.
-        :param embedding_1: Result of the 1st embedding after attention.
-        :param embedding_2: Result of the 2nd embedding after attention.
-        :return scores: A similarity score vector.
-        """
-        #print('>>>>>> Self weight matrix shape : ' + str(self.weight_matrix.view(64, -1).shape))
-        embedding_1 = embedding_1[:, None]
-        embedding_2 = embedding_2[:,None]
-                
-        #print('>>>>>> embedding shape : ' + str(torch.t(embedding_1).shape))
-
-        scoring = torch.mm(torch.t(embedding_1), self.weight_matrix.view(64, -1))
-        scoring = scoring.view(64, 64)
-        scoring = torch.mm(torch.t(scoring), embedding_2)
-        combined_representation = torch.cat((embedding_1, embedding_2))
-        block_scoring = torch.mm(self.weight_matrix_block, combined_representation)
+        Making a forward propagation pass to create a similarity vector for a batch of node pairs.
+        :param embedding_1: (B x input_dim) embeddings of the first nodes of the pairs.
+        :param embedding_2: (B x input_dim) embeddings of the second nodes of the pairs.
+        :return scores: A (B x tensor_neurons) similarity score matrix.
+        """
+        # scoring[n, k] = embedding_1[n] . weight_matrix[:, :, k] . embedding_2[n]
+        scoring = torch.einsum('na,abk,nb->nk', embedding_1, self.weight_matrix, embedding_2)
+        combined_representation = torch.cat((embedding_1, embedding_2), dim=1)
+        block_scoring = torch.mm(combined_representation, torch.t(self.weight_matrix_block))
         #combined_representation_1 = torch.cat((embedding_1, embedding_2))
         #combined_representation_2 = torch.cat((embedding_2, embedding_1))
         #block_scoring_1 = torch.mm(self.weight_matrix_block_1, combined_representation_1)
         #block_scoring_2 = torch.mm(self.weight_matrix_block_2, combined_representation_2)
-        scores = scoring + block_scoring + self.bias
+        scores = scoring + block_scoring + torch.t(self.bias)
         #scores = torch.nn.functional.relu(scoring + block_scoring + self.bias)
         return scores
 
@@ -6,14 +6,14 @@ import random
 
 import matplotlib.pyplot as plt
 import numpy as np
-from sklearn.metrics import roc_auc_score, roc_curve, classification_report
+from sklearn.metrics import roc_auc_score, roc_curve
 import torch
-import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader
 
 from datasets import link_prediction
-from layers import MeanAggregator, LSTMAggregator, MaxPoolAggregator, MeanPoolAggregator
+from evaluation import Evaluator, stack_results
+from layers import MeanAggregator, LSTMAggregator, MaxPoolAggregator, MeanPoolAggregator, BiTensorNetworkModule
 import models
 from models import DGNN, AAGNN, EGNNC
 from models_variants import EAAGNN, EAACGNN
@@ -43,11 +43,13 @@ def main():
     if config['test']:
         dataset_args = ('test', config['num_layers'])
     
-    datasets = utils.get_dataset_gcn(dataset_args, config['dataset_folder'], is_debug=config["is_debug"])
+    datasets = utils.get_dataset_gcn(dataset_args, config['dataset_folder'], is_debug=config["is_debug"], sparse=config['sparse'], cache_dir=config['cache_dir'], workers=config['load_workers'],
+                                     max_resident=config['max_resident_graphs'])
 
     
     loaders = []
     for i in range(len(datasets)):
+        datasets[i].to(device)
         loaders.append(DataLoader(dataset=datasets[i], batch_size=config['batch_size'],
                         shuffle=True, collate_fn=datasets[i].collate_wrapper))
 
@@ -77,8 +79,10 @@ def main():
         mlp = models.MLPTwoLayers(input_dim=channel_dim*output_dim*4, hidden_dim=output_dim*2, output_dim=1, dropout=0.5)
         mlp.to(config["device"])
 
+    ntn = None
     if config["classifier"] == "mlp_bi_ntn":
         ntn_embedding_size = 64
+        ntn = BiTensorNetworkModule(input_dim=channel_dim*output_dim, tensor_neurons=ntn_embedding_size)
         mlp = models.MLPTwoLayers(input_dim=channel_dim*output_dim*2 + ntn_embedding_size, hidden_dim=output_dim*2, output_dim=1, dropout=0.5)
         mlp.to(config["device"])             
 
@@ -90,8 +94,8 @@ def main():
         cnn = models.TriangularMotifsCNN(num_channels = 4)
         cnn.to(config["device"])
 
-    classifier = mlp if config["classifier"] == "mlp" else cnn
-    combined_model = models.CombinedModel(model, classifier, config["classifier"], config["device"])
+    classifier = mlp if config["classifier"] in ("mlp", "mlp_bi_ntn") else cnn
+    combined_model = models.CombinedModel(model, classifier, config["classifier"], config["device"], ntn=ntn)
     combined_model.to(config["device"])
 
 
@@ -109,34 +113,16 @@ def main():
 
     criterion = utils.get_criterion(config['task'])
 
-    sigmoid = nn.Sigmoid()
+    # Shared by every evaluation below, it reports the time spent in each of them at the end.
+    evaluator = Evaluator(combined_model, criterion, device, stats_per_batch, config['forward'])
 
     # =================== training ===================
     # Compute ROC-AUC score for the untrained model.
     if not config['val'] and not config['test']:
         print('--------------------------------')
         print('Computing ROC-AUC score for the training dataset before training.')
-        y_true, y_scores = [], []
-        for i in range(len(datasets)):
-            num_batches = int(ceil(len(datasets[i]) / config['batch_size']))
-            with torch.no_grad():
-                for (idx, batch) in enumerate(loaders[i]):
-                    adj, features, edge_features, edges, labels, dist, triangles, dnn_features = batch
-                    labels = labels.to(device)
-
-                    
-                    features, edge_features = features.to(device), edge_features.to(device)
-                    scores = combined_model(features, edge_features, edges, triangles, dnn_features)
-                    
-
-                    y_true.extend(labels.detach().cpu().numpy())
-                    y_scores.extend(scores.detach().cpu().numpy())
-                    if (idx + 1) % stats_per_batch == 0:
-                        print('    Batch {} / {}, Graph {} / {}'.format(idx+1, num_batches, i+1, len(datasets)))
-        y_true = np.array(y_true).flatten()
-        y_scores = np.array(y_scores).flatten()
-        area = roc_auc_score(y_true, y_scores)
-        print('ROC-AUC score: {:.4f}'.format(area))
+        results = evaluator.score(loaders, 'training set before training')
+        evaluator.roc_auc(results)
         print('--------------------------------')
 
     # Train.
@@ -159,6 +145,11 @@ def main():
             _epoch_loss = []
             print('Epoch {} / {}'.format(epoch+1, epochs))
 
+            # Fresh negative examples for every epoch after the first one, the graphs are not rebuilt.
+            if config['resample_negatives'] and epoch > 0:
+                for dataset in datasets:
+                    dataset.resample_negatives()
+
             epoch_loss = 0.0
             epoch_roc = 0.0
             epoch_batches = 0
@@ -169,27 +160,41 @@ def main():
                 epoch_batches += num_batches
                 graph_roc = 0.0
                 running_loss = 0.0
+                # Minibatches scored against a single GNN forward before each optimiser step.
+                if config['forward'] == 'graph' and config['batches_per_step'] != -1:
+                    batches_per_step = config['batches_per_step']
+                elif config['forward'] == 'graph':
+                    batches_per_step = num_batches
+                else:
+                    batches_per_step = 1
+                out, step_scores, step_labels = None, [], []
                 for (idx, batch) in enumerate(loaders[i]):
                     adj, features, edge_features, edges, labels, dist, triangles, dnn_features = batch
-                    labels = labels.to(device)
-                    optimizer.zero_grad()
-                     
-                    features, edge_features = features.to(device), edge_features.to(device)
-                    scores = combined_model(features, edge_features, edges, triangles, dnn_features)
-                     
+                    if out is None:
+                        optimizer.zero_grad()
+                        features, edge_features = features.to(device), edge_features.to(device)
+                        out = combined_model.embed(features, edge_features)
+                    step_scores.append(combined_model.score(out, edges, triangles, dnn_features))
+                    step_labels.append(labels.to(device))
+                    if (idx + 1) % batches_per_step != 0 and (idx + 1) != num_batches:
+                        continue
+
+                    step_batches = len(step_scores)
+                    scores, labels = torch.cat(step_scores), torch.cat(step_labels)
+                    out, step_scores, step_labels = None, [], []
 
                     loss = criterion(scores, labels.float()) # Loss function for BCE loss
                     #loss = utils.get_focal_loss_criterion(scores, labels.float())  # Loss function for Focal Loss 
                     loss.backward()
                     optimizer.step()
                     with torch.no_grad():
-                        running_loss += loss.item()
-                        epoch_loss += loss.item()
+                        running_loss += loss.item() * step_batches
+                        epoch_loss += loss.item() * step_batches
                         _epoch_loss.append(loss.item())
                         if (torch.sum(labels.long() == 0).item() > 0) and (torch.sum(labels.long() == 1).item() > 0):
                             area = roc_auc_score(labels.detach().cpu().numpy(), scores.detach().cpu().numpy())
-                            epoch_roc += area
-                            graph_roc += area
+                            epoch_roc += area * step_batches
+                            graph_roc += area * step_batches
                 running_loss /= num_batches
                 print('    Graph {} / {}: loss {:.4f}'.format(
                     i+1, len(datasets), running_loss))
@@ -198,6 +203,8 @@ def main():
             scheduler.step()
             print("Epoch avg loss: {}".format(epoch_loss / epoch_batches))
             print("Epoch avg ROC_AUC score: {}".format(epoch_roc / epoch_batches))
+            if utils.get_peak_memory() is not None:
+                print('Peak resident memory: {:.0f} MB'.format(utils.get_peak_memory()))
             loss_vals.append(sum(_epoch_loss)/len(_epoch_loss))
 
         plt.plot(np.linspace(1, epochs, epochs).astype(int), loss_vals)
@@ -237,36 +244,18 @@ def main():
         if not config['val']:
             dataset_args = ('val', config['num_layers'])
             
-            datasets = utils.get_dataset_gcn(dataset_args, config['dataset_folder'], is_debug=config["is_debug"])
+            datasets = utils.get_dataset_gcn(dataset_args, config['dataset_folder'], is_debug=config["is_debug"], sparse=config['sparse'], cache_dir=config['cache_dir'], workers=config['load_workers'],
+                                             max_resident=config['max_resident_graphs'])
             
             loaders = []
             for i in range(len(datasets)):
+                datasets[i].to(device)
                 loaders.append(DataLoader(dataset=datasets[i], batch_size=config['batch_size'],
                                     shuffle=False, collate_fn=datasets[i].collate_wrapper))
-        y_true, y_scores = [], []
-        for i in range(len(datasets)):
-            num_batches = int(ceil(len(datasets[i]) / config['batch_size']))
-            with torch.no_grad():
-                for (idx, batch) in enumerate(loaders[i]):
-                    adj, features, edge_features, edges, labels, dist, triangles, dnn_features = batch
-                    labels = labels.to(device)
-                    
-                     
-                    features, edge_features = features.to(device), edge_features.to(device)
-                    scores = combined_model(features, edge_features, edges, triangles, dnn_features)
-                     
-
-                    y_true.extend(labels.detach().cpu().numpy())
-                    y_scores.extend(scores.detach().cpu().numpy())
-             
-
-                    if (idx + 1) % stats_per_batch == 0:
-                        print('    Batch {} / {}, Graph {} / {}'.format(idx+1, num_batches, i+1, len(datasets)))
-        y_true = np.array(y_true).flatten()
-        y_scores = np.array(y_scores).flatten()
- 
-        area = roc_auc_score(y_true, y_scores)
-        print('ROC-AUC score: {:.4f}'.format(area))
+        # The model is frozen from here on, the edges are scored once for the ROC curve and every threshold.
+        results = evaluator.score(loaders, 'validation set after training')
+        evaluator.roc_auc(results)
+        y_true, y_scores = stack_results(results)
         print('--------------------------------')
 
     # Plot the true positive rate and true negative rate vs threshold.
@@ -282,276 +271,37 @@ def main():
         plt.show(block=False)
         plt.close()
 
-        # Choose an appropriate threshold and generate classification report on the validation set.
-        idx1 = np.where(tpr <= tnr)[0]
-        idx2 = np.where(tpr >= tnr)[0]
-        t = config['threshold']#thresholds[idx1[-1]]
-        _thres = config['threshold']
-        for t in _thres:
-            running_loss, total_loss = 0.0, 0.0
-            num_correct, num_examples = 0, 0
-            total_correct, total_examples, total_batches = 0, 0, 0
-            y_true, y_scores, y_pred = [], [], []
-            for i in range(len(datasets)):
-                num_batches = int(ceil(len(datasets[i]) / config['batch_size']))
-                total_batches += num_batches
-                # Added by Jorge
-                edge_pred, neg_pred, classes, coords = [], [], None, None
-                # --------------
-                with torch.no_grad():
-                    for (idx, batch) in enumerate(loaders[i]):
-                        adj, features, edge_features, edges, labels, dist, triangles, dnn_features = batch
-                        labels = labels.to(device)
-                        
-                         
-                        features, edge_features = features.to(device), edge_features.to(device)
-                        scores = combined_model(features, edge_features, edges, triangles, dnn_features)
-                         
-
-                        loss = criterion(scores, labels.float()) # Loss function for BCE Loss 
-                        #loss = utils.get_focal_loss_criterion(scores, labels.float())  # Loss function for Focal Loss 
-
-                        running_loss += loss.item()
-                        total_loss += loss.item()
-                        predictions = (scores >= t).long()
-
-                        # added by Jorge
-                        preds = edges[torch.nonzero(predictions).detach().cpu().numpy(), :]
-                        neg_preds = edges[(predictions == 0).detach().cpu().nonzero(), :]
-                        if neg_preds.shape == (2,):
-                            neg_preds = neg_preds.reshape(1, 1, -1)
-
-                        if len(preds) > 0:
-                            for pred in preds:
-                                edge_pred.append([pred[0][0], pred[0][1]])
-                        
-                        if len(neg_preds) > 0:
-                            for pred in neg_preds:
-                                neg_pred.append([pred[0][0], pred[0][1]])
-                        # ---------------
-
-                        num_correct += torch.sum(predictions == labels.long()).item()
-                        total_correct += torch.sum(predictions == labels.long()).item()
-                        num_examples += len(labels)
-                        total_examples += len(labels)
-                        y_true.extend(labels.detach().cpu().numpy())
-                        y_scores.extend(scores.detach().cpu().numpy())
-                        y_pred.extend(predictions.detach().cpu().numpy())
-                        if (idx + 1) % stats_per_batch == 0:
-                            running_loss /= stats_per_batch
-                            accuracy = num_correct / num_examples
-                            print('    Batch {} / {}, Graph {} / {}: loss {:.4f}, accuracy {:.4f}'.format(
-                                idx+1, num_batches, i+1, len(datasets), running_loss, accuracy))
-                            if (torch.sum(labels.long() == 0).item() > 0) and (torch.sum(labels.long() == 1).item() > 0):
-                                area = roc_auc_score(labels.detach().cpu().numpy(), scores.detach().cpu().numpy())
-                                print('    ROC-AUC score: {:.4f}'.format(area))
-                            running_loss = 0.0
-                            num_correct, num_examples = 0, 0
-                    running_loss = 0.0
-                    num_correct, num_examples = 0, 0
-
-                    # export as json for visualization in IntelliGraph JORGE
-                    utils.export_prediction_as_json(datasets[i].path[0].replace("_forGraphSAGE_edges.csv", ""), 'train_val', edge_pred, neg_pred, config['results_dir'], config['model_id'])
-
-            total_loss /= total_batches
-            total_accuracy = total_correct / total_examples
-            print('Loss {:.4f}, accuracy {:.4f}'.format(total_loss, total_accuracy))
-            print('Threshold: {:.4f}, accuracy: {:.4f}'.format(t, total_correct / total_examples))
-            y_true = np.array(y_true).flatten()
-            y_scores = np.array(y_scores).flatten()
-            y_pred = np.array(y_pred).flatten()
-            report = classification_report(y_true, y_pred, digits=4)
-            area = roc_auc_score(y_true, y_scores)
-            print('ROC-AUC score: {:.4f}'.format(area))
-            print("Threshold: ", t)
-            print('Classification report\n', report)
+        # Generate classification reports on the validation set for the configured thresholds.
+        evaluator.report(results, datasets, config['threshold'], 'train_val', config)
         print('Finished validating.')
         print('--------------------------------')
 
     # =================== Validation ===================
     if config['val']:
-        criterion = utils.get_criterion(config['task'])
-        stats_per_batch = config['stats_per_batch']
-
-        t = config['threshold']
-         
         combined_model.eval()
         print('--------------------------------')
         print('Computing ROC-AUC score for the validation dataset after training.')
-        _thres = config['threshold']
-        for t in _thres:
-            
-            running_loss, total_loss = 0.0, 0.0
-            num_correct, num_examples = 0, 0
-            total_correct, total_examples, total_batches = 0, 0, 0
-            y_true, y_scores, y_pred = [], [], []
-
-            for i in range(len(datasets)):
-                num_batches = int(ceil(len(datasets[i]) / config['batch_size']))
-                total_batches += num_batches
-                # Added by Jorge
-                edge_pred, neg_pred, classes, coords = [], [], None, None
-                # --------------
-                for (idx, batch) in enumerate(loaders[i]):
-                    adj, features, edge_features, edges, labels, dist, triangles, dnn_features = batch
-                    labels = labels.to(device)
-                    
-                    features, edge_features = features.to(device), edge_features.to(device)
-                    scores = combined_model(features, edge_features, edges, triangles, dnn_features)
-                     
-
-                    loss = criterion(scores, labels.float()) # Loss function for BCE Loss 
-                    #loss = utils.get_focal_loss_criterion(scores, labels.float()) # Loss function for Focal Loss 
-
-                    running_loss += loss.item()
-                    total_loss += loss.item()
-                    predictions = (scores >= t).long()
-                    # added by Jorge
-                    preds = edges[torch.nonzero(predictions).detach().cpu().numpy(), :]
-                    neg_preds = edges[(predictions == 0).detach().cpu().nonzero(), :]
-                    if neg_preds.shape == (2,):
-                        neg_preds = neg_preds.reshape(1, 1, -1)
-                    # print(neg_preds)
-                    # print(type(neg_preds))
-                    # print(neg_preds.shape)
-                    if len(preds) > 0:
-                        for pred in preds:
-                            edge_pred.append([pred[0][0], pred[0][1]])
-                    if len(neg_preds) > 0:
-                        for pred in neg_preds:
-                            neg_pred.append([pred[0][0], pred[0][1]])
-                    # ---------------
-
-                    num_correct += torch.sum(predictions == labels.long()).item()
-                    total_correct += torch.sum(predictions == labels.long()).item()
-                    num_examples += len(labels)
-                    total_examples += len(labels)
-                    y_true.extend(labels.detach().cpu().numpy())
-                    y_scores.extend(scores.detach().cpu().numpy())
-                    y_pred.extend(predictions.detach().cpu().numpy())
-                    if (idx + 1) % stats_per_batch == 0:
-                        running_loss /= stats_per_batch
-                        accuracy = num_correct / num_examples
-                        print('    Batch {} / {}: loss {:.4f}, accuracy {:.4f}'.format(
-                            idx+1, num_batches, running_loss, accuracy))
-                        if (torch.sum(labels.long() == 0).item() > 0) and (torch.sum(labels.long() == 1).item() > 0):
-                            area = roc_auc_score(labels.detach().cpu().numpy(), scores.detach().cpu().numpy())
-                            print('    ROC-AUC score: {:.4f}'.format(area))
-                        running_loss = 0.0
-                        num_correct, num_examples = 0, 0
-
-                running_loss = 0.0
-                num_correct, num_examples = 0, 0
-
-                # export as json for visualization in IntelliGraph JORGE
-                utils.export_prediction_as_json(datasets[i].path[0].replace("_forGraphSAGE_edges.csv", ""), 'validation', edge_pred, neg_pred, config['results_dir'], config['model_id'])
-
-            total_loss /= total_batches
-            total_accuracy = total_correct / total_examples
-            print('Loss {:.4f}, accuracy {:.4f}'.format(total_loss, total_accuracy))
-            y_true = np.array(y_true).flatten()
-            y_scores = np.array(y_scores).flatten()
-            y_pred = np.array(y_pred).flatten()
-            report = classification_report(y_true, y_pred, digits=4)
-            area = roc_auc_score(y_true, y_scores)
-            print('ROC-AUC score: {:.4f}'.format(area))
-            print("Threshold: ", t)
-            print('Classification report\n', report)
-            print('Finished Validation Set')
-            print('--------------------------------')
+        results = evaluator.score(loaders, 'validation set')
+        evaluator.report(results, datasets, config['threshold'], 'validation', config)
+        print('Finished Validation Set')
+        print('--------------------------------')
 
 
     # =================== Test ===================
         # Evaluate on test set.
     if config['test']:
-        criterion = utils.get_criterion(config['task'])
-        stats_per_batch = config['stats_per_batch']
-
-        #t = config['threshold']
-        _thres = config['threshold']
-        for t in _thres:
-               
-            combined_model.eval()
-             
-            print('--------------------------------')
-            print('Computing ROC-AUC score for the test dataset after training.')
-            running_loss, total_loss = 0.0, 0.0
-            num_correct, num_examples = 0, 0
-            total_correct, total_examples, total_batches = 0, 0, 0
-            y_true, y_scores, y_pred = [], [], []
-            for i in range(len(datasets)):
-                num_batches = int(ceil(len(datasets[i]) / config['batch_size']))
-                total_batches += num_batches
-                # Added by Jorge
-                edge_pred, neg_pred = [], []
-                # --------------
-
-                for (idx, batch) in enumerate(loaders[i]):
-                    adj, features, edge_features, edges, labels, dist, triangles, dnn_features = batch
-                    labels = labels.to(device)
-                    
-                     
-                    features, edge_features = features.to(device), edge_features.to(device)
-                    scores = combined_model(features, edge_features, edges, triangles, dnn_features)
-                     
-                        
-                    loss = criterion(scores, labels.float())  # Loss function for BCE Loss 
-                   
-                    #loss = utils.get_focal_loss_criterion(scores, labels.float())  # Loss function for Focal Loss 
-                    running_loss += loss.item()
-                    total_loss += loss.item()
-                    predictions = (scores >= t).long()
-
-                    # added by Jorge
-                    preds = edges[torch.nonzero(predictions).detach().cpu().numpy(), :]
-                    neg_preds = edges[(predictions == 0).detach().cpu().nonzero(), :]
-                    if neg_preds.shape == (2,):
-                        neg_preds = neg_preds.reshape(1, 1, -1)
-
-                    if len(preds) > 0:
-                        for pred in preds:
-                            edge_pred.append([pred[0][0], pred[0][1]])
-
-                    # ---------------
-
-                    num_correct += torch.sum(predictions == labels.long()).item()
-                    total_correct += torch.sum(predictions == labels.long()).item()
-                    num_examples += len(labels)
-                    total_examples += len(labels)
-                    y_true.extend(labels.detach().cpu().numpy())
-                    y_scores.extend(scores.detach().cpu().numpy())
-                    y_pred.extend(predictions.detach().cpu().numpy())
-                    if (idx + 1) % stats_per_batch == 0:
-                        running_loss /= stats_per_batch
-                        accuracy = num_correct / num_examples
-                        print('    Batch {} / {}: loss {:.4f}, accuracy {:.4f}'.format(
-                            idx+1, num_batches, running_loss, accuracy))
-                        if (torch.sum(labels.long() == 0).item() > 0) and (torch.sum(labels.long() == 1).item() > 0):
-                            area = roc_auc_score(labels.detach().cpu().numpy(), scores.detach().cpu().numpy())
-                            print('    ROC-AUC score: {:.4f}'.format(area))
-                        running_loss = 0.0
-                        num_correct, num_examples = 0, 0
+        combined_model.eval()
 
-                running_loss = 0.0
-                num_correct, num_examples = 0, 0
-
-                # export as json for visualization in IntelliGraph JORGE
-                utils.export_prediction_as_json(datasets[i].path[0].replace("_forGraphSAGE_edges.csv", ""), 'testing', edge_pred, neg_pred, config['results_dir'], config['model_id'])
-
-
-            total_loss /= total_batches
-            total_accuracy = total_correct / total_examples
-            print('Loss {:.4f}, accuracy {:.4f}'.format(total_loss, total_accuracy))
-            y_true = np.array(y_true).flatten()
-            y_scores = np.array(y_scores).flatten()
-            y_pred = np.array(y_pred).flatten()
-            report = classification_report(y_true, y_pred, digits=4)
-            area = roc_auc_score(y_true, y_scores)
-            print('ROC-AUC score: {:.4f}'.format(area))
-            print("Threshold: ", t)
-            print('Classification report\n', report)
+        print('--------------------------------')
+        print('Computing ROC-AUC score for the test dataset after training.')
+        results = evaluator.score(loaders, 'test set')
+        evaluator.report(results, datasets, config['threshold'], 'testing', config)
         print('Finished testing.')
         print('--------------------------------')
 
+    evaluator.print_timings()
+    if utils.get_peak_memory() is not None:
+        print('Peak resident memory: {:.0f} MB'.format(utils.get_peak_memory()))
+
 if __name__ == '__main__':
     main()
@@ -80,8 +80,8 @@ class GraphSAGE(nn.Module):
         node_layers : list of numpy array
             node_layers[i] is an array of the nodes in the ith layer of the
             computation graph.
-        mappings : list of dictionary
-            mappings[i] is a dictionary mapping node v (labelled 0 to |V|-1)
+        mappings : list of numpy array
+            mappings[i] is an integer array mapping node v (labelled 0 to |V|-1)
             in node_layers[i] to its position in node_layers[i]. For example,
             if node_layers[i] = [2,5], then mappings[i][2] = 0 and
             mappings[i][5] = 1.
@@ -96,11 +96,9 @@ class GraphSAGE(nn.Module):
         for k in range(self.num_layers):
             nodes = node_layers[k+1]
             mapping = mappings[k]
-            init_mapped_nodes = np.array([mappings[0][v] for v in nodes], dtype=np.int64)
-            cur_mapped_nodes = np.array([mapping[v] for v in nodes], dtype=np.int64)
+            init_mapped_nodes = mappings[0][nodes]
+            cur_mapped_nodes = mapping[nodes]
             cur_rows = rows[init_mapped_nodes]
-            cur_dist = dist[init_mapped_nodes, :]
-            cur_dist = dist[:, init_mapped_nodes]
             aggregate = self.aggregators[k](out, nodes, mapping, cur_rows, dist, mappings[0],
                                             self.num_samples[k])
             if self.agg_class != MeanAggregator:
@@ -198,8 +196,9 @@ class AAGNN(nn.Module):
             An (n' x input_dim) tensor of input node features.
         dist : torch.Tensor
             An (n x n) tensor of distance between pairs of neighboring nodes.
-        adj_relative_cos : Dict[int, Dict[tuple, torch.Tensor]]
-            adj_relative_cos[i][(j, k)] is the cosine value between a pair of relative vectors node(i -> j) and node(i -> k).
+        adj_relative_cos : Dict[int, Dict[tuple, torch.Tensor]] or dict
+            adj_relative_cos[i][(j, k)] is the cosine value between a pair of relative vectors node(i -> j) and node(i -> k),
+            or the same angles as flat tensors, see layers.relative_cos_to_pairs.
         Returns
         -------
         out : torch.Tensor
@@ -256,7 +255,7 @@ class EGNNC(nn.Module):
         features : torch.Tensor
             An (n x input_dim) tensor of input node features.
         edge_features : torch.Tensor
-            An (p x n x n) tensor of edge features.
+            An (p x n x n) tensor of edge features, dense or sparse COO.
         Returns
         -------
         out : torch.Tensor
@@ -359,11 +358,12 @@ class MLPTwoLayers(nn.Module):
 
 
 class CombinedModel(nn.Module):
-    def __init__(self, gnn, classifier, classifier_type = "mlp", device='cpu'):
+    def __init__(self, gnn, classifier, classifier_type = "mlp", device='cpu', ntn=None):
         super(CombinedModel, self).__init__()
         self.gnn = gnn
         self.classifier = classifier
         self.classifier_type = classifier_type
+        self.ntn = ntn  # layers.BiTensorNetworkModule of the mlp_bi_ntn classifier, trained with it
         self.sigmoid = nn.Sigmoid()
         self.device = device
          
@@ -371,15 +371,54 @@ class CombinedModel(nn.Module):
     def forward(self, features, edge_features, edges, triangles, dnn_features = None):
         # Pass graphs through GNN to get node embeddings
         #features, edge_features = features.to(device), edge_features.to(device)
-        out = self.gnn(features, edge_features)
+        out = self.embed(features, edge_features)
         #print("out.shape: ", out.shape)
-        
+
+        return self.score(out, edges, triangles, dnn_features)
+
+    def embed(self, features, edge_features):
+        """
+        Parameters
+        ----------
+        features : torch.Tensor
+            An (n x input_dim) tensor of input node features.
+        edge_features : torch.Tensor
+            An (p x n x n) tensor of edge features, dense or sparse COO.
+        Returns
+        -------
+        out : torch.Tensor
+            Node embeddings of the whole graph. They can be reused by score for every batch of edges of the graph.
+        """
+        return self.gnn(features, edge_features)
+
+    def score(self, out, edges, triangles, dnn_features = None):
+        """
+        Parameters
+        ----------
+        out : torch.Tensor
+            Node embeddings returned by embed.
+        edges : numpy array
+            The edges to score.
+        triangles : numpy array or dict
+            Triangle table of the graph, see utils.get_triangle_index, or a triangles_dict.
+        Returns
+        -------
+        edge_scores : torch.Tensor
+            Probability of each edge being a crossing edge.
+        """
         if self.classifier_type == "mlp":
             out1,out2 = utils.concat_node_representations_double(out, edges, self.device)
  
             score1 = self.classifier(out1)
             score2 = self.classifier(out2)
             edge_scores = self.sigmoid(score1 + score2)
+
+        elif self.classifier_type == "mlp_bi_ntn":
+            out1, out2 = utils.concat_node_respresentations_double_with_biNTN(out, edges, self.ntn, self.device)
+
+            score1 = self.classifier(out1)
+            score2 = self.classifier(out2)
+            edge_scores = self.sigmoid(score1 + score2)
         
         elif self.classifier_type == "cnn_kites":
             out = utils.kite_motifs(out, edges, triangles, self.device, UNIVARIANT = True) #if univariant we have multiple outputs
@@ -45,8 +45,9 @@ class EAAGNN(nn.Module):
             An (n' x input_dim) tensor of input node features.
         adj: torch.Tensor
             An adjancy matrix of the graph.
-        adj_relative_cos : Dict[int, Dict[tuple, torch.Tensor]]
-            adj_relative_cos[i][(j, k)] is the cosine value between a pair of relative vectors node(i -> j) and node(i -> k).
+        adj_relative_cos : Dict[int, Dict[tuple, torch.Tensor]] or dict
+            adj_relative_cos[i][(j, k)] is the cosine value between a pair of relative vectors node(i -> j) and node(i -> k),
+            or the same angles as flat tensors, see layers.relative_cos_to_pairs.
         Returns
         -------
         out : torch.Tensor
@@ -97,8 +98,9 @@ class EAACGNN(nn.Module):
             An (n' x input_dim) tensor of input node features.
         adj: torch.Tensor
             An adjancy matrix of the graph.
-        adj_relative_cos : Dict[int, Dict[tuple, torch.Tensor]]
-            adj_relative_cos[i][(j, k)] is the cosine value between a pair of relative vectors node(i -> j) and node(i -> k).
+        adj_relative_cos : Dict[int, Dict[tuple, torch.Tensor]] or dict
+            adj_relative_cos[i][(j, k)] is the cosine value between a pair of relative vectors node(i -> j) and node(i -> k),
+            or the same angles as flat tensors, see layers.relative_cos_to_pairs.
         Returns
         -------
         out : torch.Tensor
@@ -1,9 +1,13 @@
 import argparse
+import hashlib
 import importlib
 import json
 import sys
 from xmlrpc.client import boolean
 import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 # import cv2
 import matplotlib.pyplot as plt
@@ -19,7 +23,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from itertools import combinations
+from itertools import chain, combinations
 
 import networkx as nx
 
@@ -298,7 +302,149 @@ def get_dataset(args, dataset_folder, setPath=None, add_self_edges=False, is_deb
     return datasets
 
 
-def get_dataset_gcn(args, dataset_folder, setPath=None, add_self_edges=False, is_debug=False):
+GRAPH_CACHE_VERSION = 3
+
+
+def get_graph_cache_path(cache_dir, path, **settings):
+    """
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the cached graphs.
+    path : list
+        Dataset path [name, edge_path, node_path].
+    settings : dict
+        Any further settings the preprocessed graph depends on, e.g. mode or the edge channels.
+    Returns
+    -------
+    cache_path : str
+        Directory of the cache entry, keyed by the content of both CSV files, the settings and GRAPH_CACHE_VERSION.
+    """
+    h = hashlib.sha1()
+    for fname in path[1:3]:
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    h.update(json.dumps(dict(settings, version=GRAPH_CACHE_VERSION), sort_keys=True).encode())
+    return os.path.join(cache_dir, '{}_{}'.format(path[0], h.hexdigest()[:16]))
+
+
+def save_graph_cache(cache_path, graph):
+    """
+    Parameters
+    ----------
+    cache_path : str
+        Directory of the cache entry, see get_graph_cache_path.
+    graph : dict
+        Preprocessed graph. Every numpy array is saved as cache_path/<key>.npy, other values are skipped.
+    """
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=cache_dir)
+    keys = [k for (k, v) in graph.items() if isinstance(v, np.ndarray)]
+    objects = [k for k in keys if graph[k].dtype == object]  # e.g. classes with unmapped cell type names
+    for k in keys:
+        np.save(os.path.join(tmp_path, k + '.npy'), graph[k])
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'version': GRAPH_CACHE_VERSION, 'arrays': keys, 'objects': objects}, f)
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:  # Written meanwhile by another run
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_graph_cache(cache_path):
+    """
+    Parameters
+    ----------
+    cache_path : str
+        Directory of the cache entry, see get_graph_cache_path.
+    Returns
+    -------
+    graph : dict or None
+        The cached arrays, memory-mapped read-only, or None if there is no valid entry.
+    """
+    meta_path = os.path.join(cache_path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta['version'] != GRAPH_CACHE_VERSION:
+        return None
+    # Object arrays are pickled and cannot be memory-mapped.
+    return {k: np.load(os.path.join(cache_path, k + '.npy'), mmap_mode=None if k in meta['objects'] else 'r',
+                       allow_pickle=k in meta['objects']) for k in meta['arrays']}
+
+
+def get_peak_memory():
+    """
+    Returns
+    -------
+    peak : float or None
+        Peak resident memory of the process in MB, None if it cannot be measured on this platform.
+    """
+    try:
+        import resource  # POSIX only
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        memory = psutil.Process().memory_info()
+        # peak_wset is the peak working set on Windows, other platforms only report the current one.
+        return getattr(memory, 'peak_wset', memory.rss) / 1024**2
+    # ru_maxrss is in bytes on macOS and in KB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024**2 if sys.platform == 'darwin' else 1024)
+
+
+def get_graph_seed(name, seed=0):
+    """
+    Parameters
+    ----------
+    name : str
+        Name of the graph.
+    seed : int
+        Base seed. Default: 0.
+    Returns
+    -------
+    graph_seed : int
+        A seed depending only on the graph name and the base seed.
+    """
+    return int(hashlib.sha1('{}:{}'.format(seed, name).encode()).hexdigest()[:8], 16)
+
+
+def load_dataset_graph(path, mode, add_self_edges=False, cache_dir=None):
+    """
+    Reads the graph of a KIGraphDatasetSUBGCN with the numpy RNG seeded by get_graph_seed, so that the sampled
+    negative examples do not depend on which graphs were read before or in which process. The RNG state of the
+    caller is restored.
+
+    Parameters
+    ----------
+    path : list
+        Name of the graph and paths of its edges and nodes files.
+    mode : str
+        One of train, val or test.
+    add_self_edges : bool
+        Whether to add a (v, v) edge for every node. Default: False.
+    cache_dir : str
+        Directory of the preprocessed graph cache, None to always read the CSV files. Default: None.
+    Returns
+    -------
+    graph : dict
+        The preprocessed graph, see KIGraphDatasetSUBGCN.load_graph.
+    """
+    class_attr = getattr(importlib.import_module('datasets.link_prediction'), 'KIGraphDatasetSUBGCN')
+    state = np.random.get_state()
+    np.random.seed(get_graph_seed(path[0]))
+    try:
+        return class_attr.load_graph(path, mode, add_self_edges=add_self_edges, cache_dir=cache_dir)
+    finally:
+        np.random.set_state(state)
+
+
+def get_dataset_gcn(args, dataset_folder, setPath=None, add_self_edges=False, is_debug=False, sparse=False, cache_dir=None, workers=1,
+                    max_resident=-1):
     """
     Parameters
     ----------
@@ -306,6 +452,15 @@ def get_dataset_gcn(args, dataset_folder, setPath=None, add_self_edges=False, is
         Tuple of task, dataset name and other arguments required by the dataset constructor.
     setPath: list
         List of path data, example ['P7_HE_Default_Extended_3_1', (0, 2000, 0, 2000), 'datasets/annotations/P7_annotated/P7_HE_Default_Extended_3_1.txt']
+    sparse : bool
+        Whether the datasets keep their edge features as sparse COO tensors. Default: False.
+    cache_dir : str
+        Directory of the preprocessed graph cache, None to always rebuild the graphs from the CSV files. Default: None.
+    workers : int
+        Number of processes reading the graphs. The datasets do not depend on it. Default: 1.
+    max_resident : int
+        Maximum number of datasets with their edge features built at the same time, they are built when the
+        dataset is first collated. -1 builds them all upfront and keeps them. Default: -1.
     Returns
     -------
     dataset : torch.utils.data.Dataset
@@ -357,25 +512,30 @@ def get_dataset_gcn(args, dataset_folder, setPath=None, add_self_edges=False, is
 
 
     if setPath == None:
-        if mode == 'train':
-            for path in train_paths:
-                class_attr = getattr(importlib.import_module('datasets.link_prediction'), 'KIGraphDatasetSUBGCN')
-                dataset = class_attr(path, mode, num_layers, add_self_edges)
-                datasets.append(dataset)
-        elif mode == 'val':
-            for path in val_paths:
-                class_attr = getattr(importlib.import_module('datasets.link_prediction'), 'KIGraphDatasetSUBGCN')
-                dataset = class_attr(path, mode, num_layers, add_self_edges)
-                datasets.append(dataset)
-        elif mode == 'test':
-            for path in test_paths:
-                class_attr = getattr(importlib.import_module('datasets.link_prediction'), 'KIGraphDatasetSUBGCN')
-                dataset = class_attr(path, mode, num_layers, add_self_edges)
-                datasets.append(dataset)
+        paths = {'train': train_paths, 'val': val_paths, 'test': test_paths}.get(mode, [])
     else:
-        class_attr = getattr(importlib.import_module('datasets.link_prediction'), 'KIGraphDatasetSUBGCN')
-        dataset = class_attr(setPath, mode, num_layers)
-        datasets.append(dataset)
+        paths, add_self_edges = [setPath], False
+
+    # The graphs are read in parallel and set up here, in the sorted order of the paths.
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        graphs = executor.map(load_dataset_graph, paths, [mode] * len(paths), [add_self_edges] * len(paths),
+                              [cache_dir] * len(paths))
+    else:
+        executor = None
+        graphs = (load_dataset_graph(path, mode, add_self_edges, cache_dir) for path in paths)
+
+    link_prediction = importlib.import_module('datasets.link_prediction')
+    residency = link_prediction.GraphResidency(max_resident) if max_resident > 0 else None
+    class_attr = getattr(link_prediction, 'KIGraphDatasetSUBGCN')
+    try:
+        for path, graph in zip(paths, graphs):
+            dataset = class_attr(path, mode, num_layers, add_self_edges=add_self_edges, sparse=sparse,
+                                 cache_dir=cache_dir, graph=graph, residency=residency)
+            datasets.append(dataset)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
     return datasets
 
@@ -524,6 +684,48 @@ def normalize_edge_features_rows(edge_features):
     return np.divide(edge_features, deno, where = deno != 0)
 
 
+def normalize_sparse_edge_features_rows(edge_index, edge_attr, num_nodes):
+    """
+    Parameters
+    ----------
+    edge_index : numpy array
+        2d numpy array (2 x E). edge_index[:, e] is the (row, column) of the eth edge.
+    edge_attr : numpy array
+        2d numpy array (P x E). edge_attr[p, e] is the value of the eth edge in pth channel.
+    num_nodes : int
+        Number of nodes of the graph.
+    Returns
+    -------
+    edge_attr_normed : numpy array
+        edge_attr normalized along rows, the sparse counterpart of normalize_edge_features_rows.
+    """
+    rows = edge_index[0]
+    deno = np.vstack([np.bincount(rows, weights=np.abs(attr), minlength=num_nodes) for attr in edge_attr])
+    deno = deno[:, rows]
+    return np.divide(edge_attr, deno, out=np.zeros_like(edge_attr, dtype=np.float64), where=deno != 0)
+
+
+def to_sparse_edge_features(edge_index, edge_attr, num_nodes):
+    """
+    Parameters
+    ----------
+    edge_index : numpy array
+        2d numpy array (2 x E). edge_index[:, e] is the (row, column) of the eth edge.
+    edge_attr : numpy array
+        2d numpy array (P x E). edge_attr[p, e] is the value of the eth edge in pth channel.
+    num_nodes : int
+        Number of nodes of the graph.
+    Returns
+    -------
+    edge_features : torch.Tensor
+        A coalesced sparse COO float tensor (P x N x N).
+    """
+    channel, num_edges = edge_attr.shape
+    indices = np.vstack((np.repeat(np.arange(channel), num_edges), np.tile(edge_index, channel)))
+    return torch.sparse_coo_tensor(torch.from_numpy(indices), torch.from_numpy(edge_attr.reshape(-1)).float(),
+                                   (channel, num_nodes, num_nodes)).coalesce()
+
+
 def normalize_edge_feature_doubly_stochastic(edge_features):
     """
     Parameters
@@ -550,38 +752,86 @@ def normalize_edge_feature_doubly_stochastic(edge_features):
     return edge_features_normed
 
 
-def get_relative_cos_list(adj_list, coordinates):
+RELATIVE_COS_CACHE_VERSION = 1
+
+
+def get_relative_cos_key(degrees, neighbours, coordinates):
+    """
+    Parameters
+    ----------
+    degrees : numpy array
+        Number of neighbours of every node.
+    neighbours : numpy array
+        Neighbours of all the nodes, one node after the other.
+    coordinates : numpy array
+        x/y coordinates of nodes.
+    Returns
+    -------
+    key : str
+        Hash of the graph and RELATIVE_COS_CACHE_VERSION, a cached result is only used if its key matches.
+    """
+    h = hashlib.sha1(str(RELATIVE_COS_CACHE_VERSION).encode())
+    for a in (degrees, neighbours, coordinates):
+        a = np.ascontiguousarray(a)
+        h.update(str((a.dtype.str, a.shape)).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+def get_relative_cos_list(adj_list, coordinates, cache_path=None):
     """
     Parameters
     ----------
     adj_list : List
-        dictionary of adjacent list
+        adj_list[i] is the list of the neighbours of node i.
     coordinates : torch.FloatTensor (n x 2)
         x/y coordinates of nodes
-    device : string
-        'cpu' or 'cuda:0'. Default: 'cpu'.
+    cache_path : str
+        .npz file caching the result with the key of its graph, see get_relative_cos_key. It is read if the key
+        matches adj_list and coordinates, and written otherwise. None disables the cache. Default: None.
     Returns
     ----------
-    adj_relative_cos : Dict {int: Dict{tuple: torch.Tensor}}
-        adj_relative_cos[i][(j, k)] is the cosine value between a pair of relative vectors node(i -> j) and node(i -> k).
+    adj_relative_cos : dict
+        The cosine between the relative vectors node(i -> j) and node(i -> k) of every pair (j, k) of neighbours of
+        every node i, as the flat tensors of layers.relative_cos_to_pairs: nodes, center, first, second and cos.
+        The pairs of a node follow itertools.combinations(adj_list[i], 2).
     """
-    nodes = [i for i in range(len(adj_list))]
-    relative_coords = {n: {} for n in nodes}
-
-    for node, adj_nodes in enumerate(adj_list):
-        for adj_node in adj_nodes:
-            relative_coords[node][adj_node] = coordinates[adj_node] - coordinates[node]    
-
-    adj_relative_cos =  {n: {} for n in nodes}
-
-    for node, adj_nodes in enumerate(adj_list):
-        combs = combinations(adj_nodes, 2)
-        for pair_nodes in list(combs):
-            coor1 = relative_coords[node][pair_nodes[0]].float()
-            coor2 = relative_coords[node][pair_nodes[1]].float()
-            adj_relative_cos[node][pair_nodes] = (torch.sum(coor1 * coor2) / (torch.linalg.norm(coor1) * torch.linalg.norm(coor2)))
-
-    return adj_relative_cos
+    coordinates = np.asarray(coordinates)
+    degrees = np.array([len(adj_nodes) for adj_nodes in adj_list], dtype=np.int64)
+
+    if cache_path is not None:
+        key = get_relative_cos_key(degrees, np.fromiter(chain.from_iterable(adj_list), dtype=np.int64,
+                                                        count=degrees.sum()), coordinates)
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                if 'key' in cached.files and str(cached['key']) == key:
+                    return {k: torch.from_numpy(cached[k]) for k in cached.files if k != 'key'}
+
+    # All the nodes of a given degree have the same number of pairs, so each degree is one broadcast.
+    center, first, second, cos = [], [], [], []
+    for degree in np.unique(degrees[degrees >= 2]):
+        nodes = np.flatnonzero(degrees == degree)
+        neighbours = np.array([adj_list[node] for node in nodes], dtype=np.int64).reshape(len(nodes), degree)
+        relative = (coordinates[neighbours] - coordinates[nodes][:, None]).astype(np.float32)
+        norm = np.sqrt(np.sum(relative * relative, axis=2))
+        p, q = np.triu_indices(degree, 1)  # the order of itertools.combinations
+        center.append(np.repeat(nodes, len(p)))
+        first.append(neighbours[:, p].ravel())
+        second.append(neighbours[:, q].ravel())
+        cos.append((np.sum(relative[:, p] * relative[:, q], axis=2) / (norm[:, p] * norm[:, q])).ravel())
+
+    center = np.concatenate(center) if center else np.zeros(0, dtype=np.int64)
+    order = np.argsort(center, kind='stable')
+    adj_relative_cos = {'nodes': np.arange(len(adj_list), dtype=np.int64), 'center': center[order],
+                        'first': np.concatenate(first)[order] if first else np.zeros(0, dtype=np.int64),
+                        'second': np.concatenate(second)[order] if second else np.zeros(0, dtype=np.int64),
+                        'cos': np.concatenate(cos)[order] if cos else np.zeros(0, dtype=np.float32)}
+
+    if cache_path is not None:
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez(tmp_path, key=np.array(key), **adj_relative_cos)
+        os.replace(tmp_path, cache_path)
+    return {k: torch.from_numpy(v) for (k, v) in adj_relative_cos.items()}
 
 def get_scores_multiplication(features):
     """
@@ -604,19 +854,17 @@ def concat_node_representations(features, edges, device="cpu"):
     ----------
     features : torch.Tensor
         features[i] is the representation of node i.
+    edges : numpy array or torch.LongTensor
+        A (B x 2) array of edges.
     device : string
         'cpu' or 'cuda:0'. Default: 'cpu'.
     Returns
     ----------
     out: torch.Tensor
-        Concatinated features.
+        Concatinated features. out[e] is [features[u], features[v]] for edge e = (u, v).
     """
-    out = torch.FloatTensor().to(device)
-    for node1, node2 in edges:
-        node12 = torch.cat((features[node1], features[node2])).reshape(1, -1)
-        out = torch.cat((out, node12), dim=0)
-
-    return out
+    edges = torch.as_tensor(edges, dtype=torch.long).reshape(-1, 2).to(device)
+    return features[edges].reshape(len(edges), -1)
 
 
 def concat_node_representations_double(features, edges, device="cpu"):
@@ -625,149 +873,138 @@ def concat_node_representations_double(features, edges, device="cpu"):
     ----------
     features : torch.Tensor
         features[i] is the representation of node i.
+    edges : numpy array or torch.LongTensor
+        A (B x 2) array of edges.
     device : string
         'cpu' or 'cuda:0'. Default: 'cpu'.
     Returns
     ----------
     out1: torch.Tensor
-        Concatinated features.
+        Concatinated features. out1[e] is [features[u], features[v]] for edge e = (u, v).
     out2: torch.Tensor
-        Concatinated features.
+        Concatinated features in the other orientation, [features[v], features[u]].
     """
-    out1 = torch.FloatTensor().to(device)
-    out2 = torch.FloatTensor().to(device)
+    edges = torch.as_tensor(edges, dtype=torch.long).reshape(-1, 2).to(device)
+    nodes = features[edges]  # (B x 2 x d), gathered once for both orientations
 
-    for node1, node2 in edges:
-
-        ### Get edge features here 
-        #edge12 = edge_features[:, node1, node2]
-        #edge21 = edge_features[:, node2, node1]
-        #temp = np.zeros(124) ### adding padding to make edge feature + padding = 128
-        #temp = temp.astype(np.float)
-        #temp = torch.from_numpy(temp).type(torch.FloatTensor)
-
-        node12 = torch.cat((features[node1], features[node2])).reshape(1, -1)
-        node21 = torch.cat((features[node2], features[node1])).reshape(1, -1)
-
-        ### Add edge features to the node dimensions
-
-        #node12 = torch.cat((features[node1], features[node2], edge12, temp)).reshape(1,-1)
-        #node21 = torch.cat((features[node2], features[node1], edge21,temp)).reshape(1,-1)
-        
-        out1 = torch.cat((out1, node12), dim=0)
-        #print('<<<<< Out put concat shape ' + str(out1.shape))
-        out2 = torch.cat((out2, node21), dim=0)
+    ### Edge features could be appended here, e.g. edge_features[:, u, v] to out1 and edge_features[:, v, u] to out2
+    out1 = nodes.reshape(len(edges), -1)
+    out2 = nodes.flip(1).reshape(len(edges), -1)
 
     return out1, out2
 
 
 
-def concat_node_respresentations_double_with_biNTN(features, edges,  device="cpu"):
+def concat_node_respresentations_double_with_biNTN(features, edges, ntn_layer, device="cpu"):
     """
     Parameters
     ----------
     features : torch.Tensor
         features[i] is the representation of node i.
+    edges : numpy array or torch.LongTensor
+        A (B x 2) array of edges.
+    ntn_layer : layers.BiTensorNetworkModule
+        The tensor network scoring the node pairs, trained with the classifier.
     device : string
         'cpu' or 'cuda:0'. Default: 'cpu'.
     Returns
     ----------
     out1: torch.Tensor
-        Concatinated features.
+        Concatinated features. out1[e] is [features[u], features[v], ntn_layer(features[u], features[v])] for
+        edge e = (u, v).
     out2: torch.Tensor
-        Concatinated features.
+        Concatinated features in the other orientation, [features[v], features[u], ntn_layer(features[v], features[u])].
     """
-    out1 = torch.FloatTensor().to(device)
-    out2 = torch.FloatTensor().to(device)
+    edges = torch.as_tensor(edges, dtype=torch.long).reshape(-1, 2).to(device)
+    nodes = features[edges]  # (B x 2 x d), gathered once for both orientations
+    node1, node2 = nodes[:, 0], nodes[:, 1]
 
-    ntn_layer = layers.BiTensorNetworkModule()
+    out1 = torch.cat((node1, node2, ntn_layer(node1, node2)), dim=1)
+    out2 = torch.cat((node2, node1, ntn_layer(node2, node1)), dim=1)
 
-    '''
-    attention = layers.AttentionModule()
-    ntn_layer = layers.TenorNetworkModule()
-    node_list = {}
-    emd_list = torch.FloatTensor().to(device)
-    for node1,node2 in edges:
+    return out1, out2
 
-        if node1 not in node_list.keys(): 
-            node_list[node1] = 0
+ 
 
-        if node2 not in node_list.keys(): 
-            node_list[node2] = 0
-        
-    emd_list = torch.empty(size=(len(node_list), 64))
-    counter = 0
-    for eachKey in node_list.keys():
-        
-        emd_list[counter] = features[eachKey]
-        counter = counter +1
-
-
-    attention_emd = attention(emd_list)
-    attention_emd = torch.reshape(attention_emd, (-1,))
-    #print('before sigmoid')
-    #print(attention_emd)
-    attention_emd = torch.sigmoid(attention_emd)
-    #print('after sigmoid')
-    #print(attention_emd)
-    '''
-
-
-    for node1, node2 in edges:
-        ntn_emd_1 = ntn_layer(features[node1], features[node2])
-        ntn_emd_2 = ntn_layer(features[node2], features[node1])
-
-        ntn_emd_1 = torch.reshape(ntn_emd_1, (-1,))
-        ntn_emd_2 = torch.reshape(ntn_emd_2, (-1,))
-        #print('Node shape: '+ str(features[node1].shape))
-        #print('NTN shape: '+ str(ntn_emd.shape))
-        node12 = torch.cat((features[node1], features[node2], ntn_emd_1)).reshape(1, -1)
-        node21 = torch.cat((features[node2], features[node1], ntn_emd_2)).reshape(1, -1)
-        out1 = torch.cat((out1, node12), dim=0)
-        out2 = torch.cat((out2, node21), dim=0)
-        
+def get_triangle_index(tri_edges, tri_nodes):
+    """
+    Parameters
+    ----------
+    tri_edges : numpy array
+        A (T x 2) array of edges, see link_prediction.triangles_dict_to_arrays.
+    tri_nodes : numpy array
+        A (T x 2) array of the two nodes closing a triangle with each edge.
+    Returns
+    ----------
+    triangle_index : numpy array
+        A (T x 4) int64 table sorted by (u, v). Row (u, v, z, w), u < v, means that z and w close a triangle with edge (u, v).
+    """
+    tri_edges = np.sort(np.asarray(tri_edges, dtype=np.int64).reshape(-1, 2), axis=1)
+    triangle_index = np.hstack((tri_edges, np.asarray(tri_nodes, dtype=np.int64).reshape(-1, 2)))
+    return triangle_index[np.lexsort((triangle_index[:, 1], triangle_index[:, 0]))]
 
-    return out1,out2
 
- 
+def get_motif_nodes(edges, triangles):
+    """
+    Parameters
+    ----------
+    edges : numpy array
+        A (B x 2) array of edges.
+    triangles : numpy array or dict
+        Table returned by get_triangle_index, or a triangles_dict (slower, the table is rebuilt on every call).
+    Returns
+    ----------
+    u, v, z, w : numpy array
+        Endpoints of the edges and the two nodes closing a triangle with them. Edges without triangles are padded with z, w = u, v.
+    """
+    if isinstance(triangles, dict):
+        triangles = get_triangle_index(*link_prediction.triangles_dict_to_arrays(triangles))
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    u, v = edges[:, 0], edges[:, 1]
+
+    keys = (triangles[:, 0] << 32) | triangles[:, 1]
+    edge_keys = (np.minimum(u, v) << 32) | np.maximum(u, v)
+    pos = np.searchsorted(keys, edge_keys)
+    found = np.zeros(len(edges), dtype=bool)
+    inside = pos < len(keys)
+    found[inside] = keys[pos[inside]] == edge_keys[inside]
+
+    z, w = u.copy(), v.copy()
+    z[found], w[found] = triangles[pos[found], 2], triangles[pos[found], 3]
+
+    count = int(np.sum(~found))
+    if count > 0:
+        #print("------ Padding ------")
+        for (a, b) in edges[~found].tolist():
+            print("Edge: ", (a, b))
+        print("Padding count: ", count)
+
+    return u, v, z, w
+
 
 def triangle_motifs(features, edges, triangles, device="cpu"):
-   
-    _u = torch.FloatTensor().to(device)
-    _v = torch.FloatTensor().to(device)
-    _z = torch.FloatTensor().to(device)
-    _w = torch.FloatTensor().to(device)
- 
+    """
+    Parameters
+    ----------
+    features : torch.Tensor
+        features[i] is the representation of node i.
+    edges : numpy array
+        A (B x 2) array of edges.
+    triangles : numpy array or dict
+        Table returned by get_triangle_index, or a triangles_dict.
+    device : string
+        'cpu' or 'cuda:0'. Default: 'cpu'.
+    Returns
+    ----------
+    tri1, tri2 : torch.Tensor
+        (B x 3 x d) stacks of the (u, v, z) and (u, v, w) triangles of each edge.
+    """
     # Normalization
     #features = (features - features.mean(dim=0))/features.std(dim=0)
-    count = 0
-    for u, v in edges:
-        
-        t12 = triangles.get(frozenset((u,v)))
-    
-        if not t12 is None:
-            z, w = t12[0], t12[1]
-            # for zero-padding use torch.zeros(embedding_dimension)
-        else:
-            #print("------ Padding ------")
-            print("Edge: ", (u,v))
-            count += 1
-            z, w = u, v
-
-        _u = torch.cat((_u, features[u].reshape(1, -1)), dim=0)
-        _v = torch.cat((_v, features[v].reshape(1, -1)), dim=0)
-        _z = torch.cat((_z, features[int(z)].reshape(1, -1)), dim=0)
-        _w = torch.cat((_w, features[int(w)].reshape(1, -1)), dim=0)
-        
-        
+    _u, _v, _z, _w = [features.index_select(0, torch.from_numpy(idx).to(device)) for idx in get_motif_nodes(edges, triangles)]
 
-    if count> 0:
-        print("Padding count: ", count)
-    
     tri1 = torch.stack([_u,_v,_z], dim=1)
     tri2 = torch.stack([_u,_v,_w], dim=1)
-    tri1 = tri1.permute(0,1,2)#.view(-1, 4, 8, 16)
-    tri2 = tri2.permute(0,1,2) 
 
     # univariant
     #tri11 = torch.stack([_u,_v,_z], dim=1)
@@ -780,49 +1017,34 @@ def triangle_motifs(features, edges, triangles, device="cpu"):
 
  
 def kite_motifs(features, edges, triangles, device="cpu",UNIVARIANT=False):
-   
-    _u = torch.FloatTensor().to(device)
-    _v = torch.FloatTensor().to(device)
-    _z = torch.FloatTensor().to(device)
-    _w = torch.FloatTensor().to(device)
- 
-    count = 0
-    for u, v in edges:
-        
-        t12 = triangles.get(frozenset((u,v)))
- 
-        if not t12 is None:
-            z, w = t12[0], t12[1]
-            # for zero-padding use torch.zeros(embedding_dimension)
-        else:
-            #print("------ Padding ------")
-            print("Edge: ", (u,v))
-            count += 1
-            z, w = u, v
-
-        _u = torch.cat((_u, features[u].reshape(1, -1)), dim=0)
-        _v = torch.cat((_v, features[v].reshape(1, -1)), dim=0)
-        _z = torch.cat((_z, features[int(z)].reshape(1, -1)), dim=0)
-        _w = torch.cat((_w, features[int(w)].reshape(1, -1)), dim=0)
-
-    if count> 0:
-        print("Padding count: ", count)
-    
+    """
+    Parameters
+    ----------
+    features : torch.Tensor
+        features[i] is the representation of node i.
+    edges : numpy array
+        A (B x 2) array of edges.
+    triangles : numpy array or dict
+        Table returned by get_triangle_index, or a triangles_dict.
+    device : string
+        'cpu' or 'cuda:0'. Default: 'cpu'.
+    UNIVARIANT : bool
+        Whether to also return the kites with z and w swapped. Default: False.
+    Returns
+    ----------
+    input_data : tuple of torch.Tensor
+        (B x 4 x d) stacks of the (u, v, z, w) and (v, u, z, w) kites of each edge, followed by (u, v, w, z) and (v, u, w, z) if UNIVARIANT.
+    """
+    _u, _v, _z, _w = [features.index_select(0, torch.from_numpy(idx).to(device)) for idx in get_motif_nodes(edges, triangles)]
 
     input_data1 = torch.stack([_u,_v,_z,_w], dim=1)
-    input_data1 = input_data1.permute(0,1,2)#.view(-1, 4, 8, 16)
-    
     input_data2 = torch.stack([_v,_u,_z,_w], dim=1)
-    input_data2 = input_data2.permute(0,1,2)
     
     if not UNIVARIANT:
         return input_data1, input_data2
 
     input_data3 = torch.stack([_u,_v,_w,_z], dim=1)
-    input_data3 = input_data3.permute(0,1,2)
-    
     input_data4 = torch.stack([_v,_u,_w,_z], dim=1)
-    input_data4 = input_data4.permute(0,1,2)
 
     return input_data1, input_data2, input_data3, input_data4
  
@@ -894,7 +1116,7 @@ def parse_args():
     parser.add_argument('--num_samples', type=int, default=-1,
                         help='number of neighbors to sample, default=-1')
     parser.add_argument('--classifier', type=str,
-                        choices=['pos_sig', 'neg_sig', 'mlp', 'cnn'],
+                        choices=['pos_sig', 'neg_sig', 'mlp', 'mlp_bi_ntn', 'cnn'],
                         default='mlp',
                         help='classifier type, default: mlp')
     parser.add_argument('--model_id', type=str,
@@ -910,6 +1132,25 @@ def parse_args():
     parser.add_argument('--weight_decay', type=float, default=5e-4,
                         help='weight decay, default=5e-4')
 
+    parser.add_argument('--sparse', action='store_true',
+                        help='keep edge features as sparse tensors instead of dense (p x n x n) arrays, default: False')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='directory of the preprocessed graph cache, default: None (no cache)')
+    parser.add_argument('--load_workers', type=int, default=1,
+                        help='number of processes reading the graphs, default: 1')
+    parser.add_argument('--max_resident_graphs', type=int, default=-1,
+                        help='maximum number of graphs with their edge features in memory, -1 for all, default: -1')
+    parser.add_argument('--resample_negatives', action='store_true',
+                        help='draw fresh negative training examples every epoch, default: False')
+    parser.add_argument('--roc_threshold', action='store_true',
+                        help='also evaluate the threshold maximising TPR - FPR on the ROC curve, default: False')
+    parser.add_argument('--forward', type=str,
+                        choices=['batch', 'graph'],
+                        default='batch',
+                        help='run the GNN once per minibatch (batch) or once per graph and optimiser step (graph), default: batch')
+    parser.add_argument('--batches_per_step', type=int, default=-1,
+                        help='with --forward graph, minibatches scored against one GNN forward per optimiser step, -1 for the whole graph, default=-1')
+
     parser.add_argument('--debug', type=bool, default=False,
                         help="whether debug mode, default: False")
 